@@ -0,0 +1,283 @@
+"""Versioned store of Kolejka tools (kolejka-judge, kolejka-client) used by package builds."""
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import secrets
+import shutil
+import stat
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import aiohttp
+
+from .executors import Executors, default_executors
+from .metrics import MetricsRegistry, registry
+
+
+class ArtifactStore:
+    """
+    Every fetched set of artifacts is stored in its own immutable directory
+    versions/<version>, where version is derived from checksums of the artifacts, so
+    fetching unchanged artifacts publishes nothing new. Published version is pointed
+    to by the 'current' symlink, which is swapped atomically. Builds link to the version
+    directory itself (not to 'current'), so they never see a toolchain that is being
+    replaced. Versions that are not current and not referenced by any build are removed
+    by collect_garbage.
+    Store may be shared by many broker processes. Builds in progress reference their
+    version with a locked ref file (released also when the process dies), and acquiring
+    of versions and garbage collection exclude each other with a lock file.
+    """
+
+    class ArtifactError(Exception):
+        pass
+
+    CURRENT = 'current'
+    VERSIONS = 'versions'
+    MANIFEST = 'manifest.json'
+    REFS = 'refs'
+    GC_LOCK = '.gc.lock'
+    BUILDING = '.building'  # suffix of refs of builds in progress
+
+    def __init__(self,
+                 root_dir: Path,
+                 sources: dict[str, str],
+                 logger: logging.Logger,
+                 checksums: dict[str, str] | None = None,
+                 gc_min_age: float = 3600.0,
+                 executors: Executors = default_executors,
+                 metrics: MetricsRegistry = registry):
+        """
+        :param sources: artifact name -> URL it is fetched from
+        :param checksums: artifact name -> expected sha256, for artifacts pinned to a version
+        :param gc_min_age: versions younger than that (in seconds) are never collected
+        """
+        self.root_dir = root_dir
+        self.sources = sources
+        self.logger = logger
+        self.checksums = checksums or {}
+        self.gc_min_age = gc_min_age
+        self.executors = executors
+        self._lock = asyncio.Lock()
+        # version -> locked refs (descriptor, path) of builds in progress
+        self._in_use: dict[str, list[tuple[int, Path]]] = {}
+        # metrics
+        self._fetches = metrics.counter('artifacts.fetches')
+        self._fetch_failures = metrics.counter('artifacts.fetch_failed')
+        self._published = metrics.counter('artifacts.published')
+        self._collected = metrics.counter('artifacts.collected')
+
+    @property
+    def versions_dir(self) -> Path:
+        return self.root_dir / self.VERSIONS
+
+    def current_version(self) -> str | None:
+        """Version pointed to by 'current' or None if nothing was published yet."""
+        try:
+            return Path(os.readlink(self.root_dir / self.CURRENT)).name
+        except FileNotFoundError:
+            return None
+
+    def version_path(self, version: str) -> Path:
+        return self.versions_dir / version
+
+    # fetching ==========================================================================
+
+    async def _download(self, session: aiohttp.ClientSession, name: str) -> bytes:
+        async with session.get(self.sources[name]) as response:
+            if response.status != 200:
+                raise self.ArtifactError(f"Fetching '{name}' failed with status {response.status}")
+            return await response.read()
+
+    def _store(self, artifacts: dict[str, bytes]) -> str:
+        """Verifies and stores artifacts as a new version (if it is not stored yet)."""
+        manifest = {}
+        for name, content in sorted(artifacts.items()):
+            digest = hashlib.sha256(content).hexdigest()
+            expected = self.checksums.get(name)
+            if expected is not None and expected != digest:
+                raise self.ArtifactError(f"Checksum of '{name}' is {digest}, expected {expected}")
+            manifest[name] = digest
+        version = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+        version_path = self.version_path(version)
+        if version_path.is_dir():
+            return version
+
+        self.versions_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.versions_dir / f'.{version}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir()
+        for name, content in artifacts.items():
+            path = tmp_path / name
+            path.write_bytes(content)
+            path.chmod(path.stat().st_mode | stat.S_IEXEC)
+        (tmp_path / self.REFS).mkdir()
+        (tmp_path / self.MANIFEST).write_text(json.dumps(manifest, indent=2))
+        try:
+            tmp_path.rename(version_path)
+        except OSError:
+            # stored concurrently by another broker instance
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return version
+
+    def _publish(self, version: str):
+        tmp_link = self.root_dir / f'.{self.CURRENT}.{os.getpid()}.tmp'
+        tmp_link.unlink(missing_ok=True)
+        os.symlink(Path(self.VERSIONS) / version, tmp_link)
+        os.replace(tmp_link, self.root_dir / self.CURRENT)
+
+    async def refresh(self) -> str:
+        """Fetches artifacts and publishes them, if they changed. Returns current version."""
+        async with self._lock:
+            self._fetches.inc()
+            try:
+                async with aiohttp.ClientSession() as session:
+                    contents = await asyncio.gather(*(self._download(session, name)
+                                                      for name in self.sources))
+                version = await self.executors.run_io(self._store, dict(zip(self.sources, contents)))
+            except Exception:
+                self._fetch_failures.inc()
+                raise
+            if version != self.current_version():
+                await self.executors.run_io(self._publish, version)
+                self._published.inc()
+                self.logger.info("Kolejka artifacts version %s published", version)
+            return version
+
+    async def ensure(self) -> str:
+        """Returns current version, fetching artifacts only if nothing was published yet."""
+        version = self.current_version()
+        if version is not None and self.version_path(version).is_dir():
+            return version
+        return await self.refresh()
+
+    def verify(self, version: str) -> bool:
+        """Checks artifacts of version against checksums in its manifest."""
+        version_path = self.version_path(version)
+        try:
+            manifest = json.loads((version_path / self.MANIFEST).read_text())
+            return all(hashlib.sha256((version_path / name).read_bytes()).hexdigest() == digest
+                       for name, digest in manifest.items())
+        except (OSError, ValueError):
+            return False
+
+    # references ========================================================================
+
+    def _gc_locked(self, func, *args):
+        """Calls func holding the lock excluding garbage collection (of all processes)."""
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.root_dir / self.GC_LOCK, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return func(*args)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reference(self, version: str) -> tuple[int, Path] | None:
+        """Creates locked ref of a build in progress. Returns None if version was removed."""
+        refs_path = self.version_path(version) / self.REFS
+        if not refs_path.is_dir():
+            return None
+        ref = refs_path / f'{os.getpid()}-{secrets.token_hex(4)}{self.BUILDING}'
+        fd = os.open(ref, os.O_WRONLY | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd, ref
+
+    async def acquire(self) -> str:
+        """
+        Returns version a build should link to. The version is protected from garbage
+        collection (of any process) until release is called.
+        """
+        while True:
+            version = await self.ensure()
+            reference = await self.executors.run_io(self._gc_locked, self._reference, version)
+            if reference is not None:
+                break
+            # collected by other process right after it stopped being current
+            await self.refresh()
+        self._in_use.setdefault(version, []).append(reference)
+        return version
+
+    def release(self, version: str, build_path: Path | None = None):
+        """Ends use of version acquired for build (which references it, if it succeeded)."""
+        if build_path is not None:
+            ref_name = hashlib.sha1(str(build_path).encode()).hexdigest()
+            (self.version_path(version) / self.REFS / ref_name).write_text(str(build_path))
+        fd, ref = self._in_use[version].pop()
+        if not self._in_use[version]:
+            del self._in_use[version]
+        ref.unlink(missing_ok=True)
+        os.close(fd)
+
+    @staticmethod
+    def _in_progress(ref: Path) -> bool:
+        """Checks if ref of a build in progress is still locked by its process."""
+        try:
+            fd = os.open(ref, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def _is_referenced(self, version: str) -> bool:
+        """Removes references of builds that no longer link to version and checks the rest."""
+        version_path = self.version_path(version).resolve()
+        referenced = False
+        for ref in (self.version_path(version) / self.REFS).iterdir():
+            if ref.name.endswith(self.BUILDING):
+                if self._in_progress(ref):
+                    referenced = True
+                else:  # process of the build died
+                    ref.unlink(missing_ok=True)
+                continue
+            build_path = Path(ref.read_text())
+            links = [p for p in build_path.glob('*/kolejka-*') if p.is_symlink()]
+            if any(p.resolve().parent == version_path for p in links):
+                referenced = True
+            else:
+                ref.unlink(missing_ok=True)
+        return referenced
+
+    def _collect_garbage(self) -> list[str]:
+        if not self.versions_dir.is_dir():
+            return []
+        current = self.current_version()
+        collected = []
+        for version_path in self.versions_dir.iterdir():
+            version = version_path.name
+            if version.startswith('.') or version == current:
+                continue
+            if time.time() - version_path.stat().st_mtime < self.gc_min_age:
+                continue
+            if self._is_referenced(version):
+                continue
+            shutil.rmtree(version_path)
+            collected.append(version)
+        return collected
+
+    async def collect_garbage(self) -> list[str]:
+        """Removes versions no build references. Returns removed versions."""
+        async with self._lock:
+            collected = await self.executors.run_io(self._gc_locked, self._collect_garbage)
+        for version in collected:
+            self._collected.inc()
+            self.logger.info("Kolejka artifacts version %s removed", version)
+        return collected
+
+    async def daemon(self, interval: timedelta):
+        """Launch this method as a separate task to refresh artifacts and collect old versions."""
+        while True:
+            await asyncio.sleep(interval.total_seconds())
+            try:
+                await self.refresh()
+                await self.collect_garbage()
+            except Exception as e:
+                self.logger.error("Refreshing Kolejka artifacts failed: %s", str(e), exc_info=True)
@@ -0,0 +1,237 @@
+"""Circuit breaker around Kolejka, with new submits held in a durable buffer while it is open."""
+import asyncio
+import json
+import logging
+import time
+from enum import Enum
+from typing import Awaitable, Callable
+
+from baca2PackageManager.broker_communication import BacaToBroker
+
+from .datamaster import SetSubmitInterface, TaskSubmitInterface
+from .durable_queue import DurableQueue
+from .messenger import KolejkaMessengerInterface
+from .metrics import MetricsRegistry, registry
+from .retry import is_transient
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures. While open, calls are rejected
+    without trying them. After recovery_timeout it becomes half-open and lets calls
+    through again - the first success closes it, a failure opens it again with the
+    recovery timeout doubled (up to max_recovery_timeout).
+    """
+
+    class State(Enum):
+        CLOSED = 0
+        HALF_OPEN = 1
+        OPEN = 2
+
+    def __init__(self,
+                 name: str,
+                 failure_threshold: int,
+                 recovery_timeout: float,
+                 max_recovery_timeout: float,
+                 logger: logging.Logger,
+                 metrics: MetricsRegistry = registry):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_recovery_timeout = recovery_timeout
+        self.max_recovery_timeout = max_recovery_timeout
+        self.logger = logger
+        self.recovery_timeout = recovery_timeout
+        self._state = self.State.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        # metrics
+        self._state_gauge = metrics.gauge(f'breaker.{name}.state')
+        self._opened = metrics.counter(f'breaker.{name}.opened')
+        self._rejected = metrics.counter(f'breaker.{name}.rejected')
+
+    @property
+    def state(self) -> State:
+        if self._state == self.State.OPEN and self.retry_in() == 0:
+            self._set_state(self.State.HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state: State):
+        if state != self._state:
+            self.logger.warning("Circuit breaker '%s': %s -> %s", self.name, self._state.name, state.name)
+        self._state = state
+        self._state_gauge.set(state.value)
+
+    def retry_in(self) -> float:
+        """Seconds until open breaker becomes half-open."""
+        if self._state != self.State.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.recovery_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Tells if a call can be made. Rejected calls are counted."""
+        if self.state == self.State.OPEN:
+            self._rejected.inc()
+            return False
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        if self._state != self.State.CLOSED:
+            self.recovery_timeout = self.base_recovery_timeout
+            self._set_state(self.State.CLOSED)
+
+    def record_failure(self):
+        self._failures += 1
+        if self._state == self.State.HALF_OPEN:
+            self.recovery_timeout = min(self.recovery_timeout * 2, self.max_recovery_timeout)
+            self._open()
+        elif self._state == self.State.CLOSED and self._failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._opened.inc()
+        self._set_state(self.State.OPEN)
+
+
+def is_outage(error: BaseException) -> bool:
+    """Tells Kolejka being unavailable apart from failures of single set submits."""
+    return is_transient(error) or (error.__cause__ is not None and is_transient(error.__cause__))
+
+
+class BreakingKolejkaMessenger(KolejkaMessengerInterface):
+    """
+    Kolejka messenger guarded by a circuit breaker. Set submits are not sent (and no
+    Kolejka tools are run for them) while the breaker is open - they fail right away
+    with KolejkaUnavailable. Only sending counts as a call of the breaker.
+    """
+
+    class KolejkaUnavailable(KolejkaMessengerInterface.KolejkaTransientError):
+        pass
+
+    def __init__(self, messenger: KolejkaMessengerInterface, breaker: CircuitBreaker):
+        self.messenger = messenger
+        self.breaker = breaker
+
+    async def send(self, set_submit: SetSubmitInterface):
+        if not self.breaker.allow():
+            raise self.KolejkaUnavailable(f"Kolejka is unavailable (circuit breaker '{self.breaker.name}' open)")
+        try:
+            await self.messenger.send(set_submit)
+        except Exception as e:
+            if is_outage(e):
+                self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+
+    async def get_results(self, set_submit: SetSubmitInterface):
+        await self.messenger.get_results(set_submit)
+
+    async def poll(self, set_submit: SetSubmitInterface) -> bool:
+        return await self.messenger.poll(set_submit)
+
+
+class DispatchBuffer:
+    """
+    Holds new submits in a durable queue while Kolejka is unavailable (its breaker is not
+    closed, or submits held before are still waiting), so they are not failed. Submits
+    that failed because of an outage are held as well, at most max_attempts times.
+    Held submits are replayed once the breaker lets calls through: while it is half-open
+    one at a time, each waiting for the outcome of the previous one, and after it closes
+    at replay_rate submits per second, so recovered Kolejka is not stampeded.
+    """
+
+    def __init__(self,
+                 breaker: CircuitBreaker,
+                 queue: DurableQueue,
+                 replay_rate: float,
+                 logger: logging.Logger,
+                 max_attempts: int = 3,
+                 metrics: MetricsRegistry = registry):
+        self.breaker = breaker
+        self.queue = queue
+        self.replay_rate = replay_rate
+        self.logger = logger
+        self.max_attempts = max_attempts
+        self._replays: set[asyncio.Task] = set()
+        # metrics
+        self._held = metrics.counter('dispatch_buffer.held')
+        self._replayed = metrics.counter('dispatch_buffer.replayed')
+        self._overflow = metrics.counter('dispatch_buffer.overflow')
+
+    @staticmethod
+    def entry(task_submit: TaskSubmitInterface | BacaToBroker, attempts: int = 0) -> dict:
+        """What is needed to create task submit (again)."""
+        return {
+            'submit_id': task_submit.submit_id,
+            'package_path': str(task_submit.package_path),
+            'commit_id': task_submit.commit_id,
+            'submit_path': str(task_submit.submit_path),
+            'attempts': attempts,
+        }
+
+    def holding(self) -> bool:
+        return self.breaker.state != CircuitBreaker.State.CLOSED or self.queue.pending > 0
+
+    async def _put(self, entry: dict) -> bool:
+        try:
+            await self.queue.put(json.dumps(entry).encode())
+        except DurableQueue.QueueFull as e:
+            self._overflow.inc()
+            self.logger.warning("Submit '%s' not held: %s", entry['submit_id'], str(e))
+            return False
+        self._held.inc()
+        self.logger.info("Submit '%s' held until Kolejka is available", entry['submit_id'])
+        return True
+
+    async def hold(self, entry: dict) -> bool:
+        """Holds new submit if Kolejka is unavailable. Returns False if it should be processed now."""
+        if not self.holding():
+            return False
+        return await self._put(entry)
+
+    async def hold_failed(self, entry: dict, error: Exception) -> bool:
+        """
+        Holds submit that failed with error, if it was caused by an outage of Kolejka.
+        Returns False if submit should be failed. Only submits with no set sent to Kolejka
+        may be held, as the replayed submit gets the same set submit ids.
+        """
+        if not is_outage(error) or entry['attempts'] + 1 >= self.max_attempts:
+            return False
+        return await self._put({**entry, 'attempts': entry['attempts'] + 1})
+
+    async def _replay(self, dispatch: Callable[[dict], Awaitable], key: str, entry: dict):
+        self._replayed.inc()
+        try:
+            await dispatch(entry)
+        except asyncio.CancelledError:
+            self.queue.nack(key)  # replayed again after restart
+            raise
+        except Exception as e:
+            self.logger.error("Replay of submit '%s' failed: %s", entry['submit_id'], str(e), exc_info=True)
+        await self.queue.ack(key)
+
+    async def run(self, dispatch: Callable[[dict], Awaitable]):
+        """Replays held submits with dispatch(entry). Launch as a separate task."""
+        try:
+            while True:
+                await self.queue.wait()
+                if self.breaker.state == CircuitBreaker.State.OPEN:
+                    await asyncio.sleep(max(self.breaker.retry_in(), 0.1))
+                    continue
+                item = await self.queue.get()
+                if item is None:
+                    continue
+                key, data = item
+                entry = json.loads(data)
+                if self.breaker.state == CircuitBreaker.State.HALF_OPEN:
+                    # probe - its outcome closes or opens the breaker
+                    await self._replay(dispatch, key, entry)
+                    continue
+                task = asyncio.create_task(self._replay(dispatch, key, entry))
+                self._replays.add(task)
+                task.add_done_callback(self._replays.discard)
+                await asyncio.sleep(1 / self.replay_rate)
+        finally:
+            for task in self._replays:
+                task.cancel()
@@ -1,3 +1,4 @@
+import copy
 import os
 from pathlib import Path
 
@@ -5,6 +6,8 @@ from baca2PackageManager import Package, TSet, TestF
 from yaml import dump
 import settings
 
+from .planner import PlannedTask, TaskPlan
+from .resources import ResourceEstimator
 from .yaml_tags import get_dumper, File
 
 INCLUDE_TAG = '0tag::include'
@@ -18,14 +21,27 @@ class Builder:
         # 'source_verifier': 'verifier',
         # 'source_name': 'basename',
     }
-    IGNORED_KEYS = ['name', 'points', 'weight', 'tests']
-
-    def __init__(self, package: Package, enable_shortcut: bool = True) -> None:
+    IGNORED_KEYS = ['name', 'points', 'weight', 'tests', 'kolejka_limits']
+    # judge running tests of a task at once, on all cpus of the task
+    PARALLEL_JUDGE = 'parallel'
+
+    def __init__(self,
+                 package: Package,
+                 enable_shortcut: bool = True,
+                 plan: TaskPlan | None = None,
+                 kolejka_src: Path | None = None,
+                 resources: ResourceEstimator | None = None) -> None:
         self.package = package
+        self.plan = plan
+        # without estimator every task gets KOLEJKA_DEFAULT_LIMITS
+        self.resources = resources
+        # directory with kolejka-judge and kolejka-client (a version of ArtifactStore)
+        self.kolejka_src = kolejka_src or settings.KOLEJKA_SRC_DIR / 'current'
         self.build_namespace = settings.BUILD_NAMESPACE
         self.build_path = None
         self.enable_shortcut = enable_shortcut
         self.common_path = None
+        self.kolejka_config = None
         self.source_size = package.get('source_size')
 
     @property
@@ -52,16 +68,13 @@ class Builder:
             'kolejka': {
                 'image': 'kolejka/satori:judge',
                 'exclusive': False,
-                'requires': ['cpu:xeon e3-1270 v5'],
+                'requires': self.package.get('kolejka_requires') or settings.KOLEJKA_REQUIRES,
                 'collect': ['log.zip'],
                 'limits': {
-                    'time': '600s',
-                    'memory': '10G',
+                    **settings.KOLEJKA_DEFAULT_LIMITS,
                     'swap': 0,
                     'cpus': self.package['cpus'],
                     'network': self.package['network'],
-                    'storage': '5G',
-                    'workspace': '5G',
                 }
             }
         }
@@ -72,6 +85,7 @@ class Builder:
                     'execute_time_cpu': '/io/executor/run/cpu_time',
                     'execute_memory': '/io/executor/run/memory',
                     'compile_log': 'str:/builder/**/stdout,/builder/**/stderr',
+                    'compile_time': 'str:/builder/**/real_time',
                     'tool_log': 'str:/io/generator/**/stderr,/io/verifier/**/stdout,'
                                 '/io/verifier/**/stderr,/io/hinter/**/stderr',
                     'checker_log': 'str:/io/checker/**/stdout,/io/checker/**/stderr',
@@ -105,12 +119,14 @@ class Builder:
 
     def _create_common(self,
                        test_yaml: dict,
-                       judge_type: str = 'main'):
+                       judge_type: str = settings.DEFAULT_JUDGE):
+        if judge_type not in settings.JUDGES:
+            raise ValueError(f"Unknown judge '{judge_type}' (available: {list(settings.JUDGES)})")
         self.common_path = self.build_path / 'common'
         self.common_path.mkdir()
 
-        os.symlink(settings.KOLEJKA_SRC_DIR / 'kolejka-judge', self.common_path / 'kolejka-judge')
-        os.symlink(settings.KOLEJKA_SRC_DIR / 'kolejka-client', self.common_path / 'kolejka-client')
+        os.symlink(self.kolejka_src / 'kolejka-judge', self.common_path / 'kolejka-judge')
+        os.symlink(self.kolejka_src / 'kolejka-client', self.common_path / 'kolejka-client')
         os.symlink(settings.JUDGES[judge_type], self.common_path / 'judge.py')
         self.create_path_from_config(test_yaml, 'checker')
         self.create_path_from_config(test_yaml, 'verifier')
@@ -118,28 +134,63 @@ class Builder:
 
         self.to_yaml(test_yaml, self.common_path / 'test.yaml')
 
+    def task_kolejka_config(self, tests: list[TestF], t_sets: list[TSet]) -> dict | None:
+        """
+        Kolejka config of a task with given tests of given sets, with limits of its resource
+        profile overridden by 'kolejka_limits' of the package and of the sets. None if
+        resource profiles are disabled.
+        """
+        if self.resources is None:
+            return None
+        judge_type = self.package.get('judge') or settings.DEFAULT_JUDGE
+        parallel = self.package['cpus'] if judge_type == self.PARALLEL_JUDGE else 1
+        config = copy.deepcopy(self.kolejka_config)
+        config['limits'].update(self.resources.profile(tests, parallel=parallel).limits())
+        for overrides in [self.package.get('kolejka_limits')] + [t_set.get('kolejka_limits') for t_set in t_sets]:
+            config['limits'].update(overrides or {})
+        return config
+
     def build(self):
         self.build_path = self.package.prepare_build(self.build_namespace)
 
         test_yaml = self._generate_test_yaml()
-        self._create_common(test_yaml)
+        self.kolejka_config = test_yaml['kolejka']
+        self._create_common(test_yaml, self.package.get('judge') or settings.DEFAULT_JUDGE)
 
         for t_set in self.package.sets():
-            set_builder = SetBuilder(self.package, t_set, self.build_path)
+            set_builder = SetBuilder(self.package, t_set, self.build_path,
+                                     self.task_kolejka_config(t_set.tests(), [t_set]))
             set_builder.build()
 
+        if self.plan is not None:
+            for planned_task in self.plan.tasks:
+                if not planned_task.is_whole_set:
+                    t_sets = [self.package.sets(name) for name in planned_task.set_names]
+                    tests = [self.package.sets(t.set_name).tests(t.test_name) for t in planned_task.tests]
+                    PlannedTaskBuilder(self.package, planned_task, self.build_path,
+                                       self.task_kolejka_config(tests, t_sets)).build()
+
+        # stored last, so only complete builds have a plan
+        plan = self.plan or TaskPlan.identity([t_set['name'] for t_set in self.package.sets()])
+        plan.save(self.build_path)
+
 
 class SetBuilder:
-    def __init__(self, package: Package, t_set: TSet, build_path: Path) -> None:
+    def __init__(self, package: Package, t_set: TSet, build_path: Path,
+                 kolejka_config: dict | None = None) -> None:
         self.package = package
         self.t_set = t_set
         self.name = t_set['name']
         self.build_path = build_path / self.name
+        # replaces Kolejka config of common test.yaml (with limits of this set)
+        self.kolejka_config = kolejka_config
 
     def _generate_test_yaml(self):
         test_yaml = {
             INCLUDE_TAG: '../common/test.yaml',
         }
+        if self.kolejka_config is not None:
+            test_yaml['kolejka'] = self.kolejka_config
         if self.t_set.get('environment') is not None:
             env = self.t_set._path / self.t_set['environment']
             os.symlink(env, self.build_path / env.name)
@@ -154,17 +205,19 @@ class SetBuilder:
                 test_yaml[key] = v
         return test_yaml
 
-    def _add_test(self, test_yaml: dict, test: TestF, include_test: bool = True):
+    def _add_test(self, test_yaml: dict, test: TestF, include_test: bool = True,
+                  name: str | None = None, include: str = 'test.yaml'):
+        name = name or test['name']
         single_test = {}
         if include_test:
-            single_test[INCLUDE_TAG] = 'test.yaml'
+            single_test[INCLUDE_TAG] = include
 
         if test.get('input') is not None:
-            test_filename = test['name'] + '.in'
+            test_filename = name + '.in'
             os.symlink(test['input'], self.build_path / test_filename)
             single_test['input'] = File(test_filename)
         if test.get('output') is not None:
-            test_filename = test['name'] + '.out'
+            test_filename = name + '.out'
             os.symlink(test['output'], self.build_path / test_filename)
             single_test['hint'] = File(test_filename)
 
@@ -176,7 +229,7 @@ class SetBuilder:
                                                      'verifier', 'hinter']:
                 single_test[key] = v
 
-        test_yaml[test['name']] = single_test
+        test_yaml[name] = single_test
 
     def build(self):
         os.mkdir(self.build_path)
@@ -189,3 +242,31 @@ class SetBuilder:
 
         Builder.to_yaml(test_yaml, self.build_path / 'test.yaml')
         Builder.to_yaml(tests_yaml, self.build_path / 'tests.yaml')
+
+
+class PlannedTaskBuilder(SetBuilder):
+    """Builds Kolejka task of a set shard or of a bundle of sets. Sets have to be built first."""
+
+    def __init__(self, package: Package, planned_task: PlannedTask, build_path: Path,
+                 kolejka_config: dict | None = None) -> None:
+        self.package = package
+        self.planned_task = planned_task
+        self.name = planned_task.name
+        self.build_path = build_path / self.name
+        self.t_sets = {name: package.sets(name) for name in planned_task.set_names}
+        # replaces Kolejka config of the sets in every test (one object, dumped once with aliases)
+        self.kolejka_config = kolejka_config
+
+    def build(self):
+        os.mkdir(self.build_path)
+
+        tests_yaml = {}
+        for planned_test in self.planned_task.tests:
+            test = self.t_sets[planned_test.set_name].tests(planned_test.test_name)
+            self._add_test(tests_yaml, test,
+                           name=planned_test.kolejka_name,
+                           include=f'../{planned_test.set_name}/test.yaml')
+            if self.kolejka_config is not None:
+                tests_yaml[planned_test.kolejka_name]['kolejka'] = self.kolejka_config
+
+        Builder.to_yaml(tests_yaml, self.build_path / 'tests.yaml')
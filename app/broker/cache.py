@@ -0,0 +1,197 @@
+"""Cache of set results, so unchanged sets of identical solutions are not judged again."""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+
+from baca2PackageManager import Package
+from baca2PackageManager.broker_communication import SetResult
+
+from .datamaster import SetSubmitInterface
+from .executors import Executors, default_executors
+from .metrics import MetricsRegistry, registry
+
+
+class ResultCacheInterface(ABC):
+    """Interface for set result caching."""
+
+    @abstractmethod
+    async def get(self, set_submit: SetSubmitInterface) -> SetResult | None:
+        """Returns cached result of set submit or None if there is none."""
+        pass
+
+    @abstractmethod
+    async def put(self, set_submit: SetSubmitInterface, result: SetResult):
+        """Stores result of set submit."""
+        pass
+
+    @staticmethod
+    def enabled_for(package: Package) -> bool:
+        """Packages can opt out of result caching with 'result_cache: false' in their config."""
+        return package.get('result_cache', True) is not False
+
+
+class ResultCache(ResultCacheInterface):
+    """
+    On-disk set result cache. Results are keyed by hash of the solution file, hash of
+    built set (tests, limits and tools) and hash of the judge. When the cache grows over
+    max_size bytes, least recently used entries are removed.
+    """
+
+    # Results with these statuses are caused by the checking system, not by the solution
+    UNCACHEABLE_STATUSES = {'INT', 'EXT', ''}
+    # Files in common build directory that do not influence results
+    IGNORED_COMMON_FILES = {'kolejka-client'}
+    # Number of directory hashes kept in memory
+    MAX_DIR_HASHES = 256
+
+    def __init__(self,
+                 cache_dir: Path,
+                 max_size: int,
+                 build_namespace: str,
+                 logger: logging.Logger,
+                 metrics: MetricsRegistry = registry,
+                 executors: Executors = default_executors):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.build_namespace = build_namespace
+        self.logger = logger
+        self.executors = executors
+        self._size: int | None = None
+        # (directory, latest mtime of its files, number of files) -> hash, least recently used first
+        self._dir_hashes: OrderedDict[tuple[Path, int, int], str] = OrderedDict()
+        self._dir_hashes_lock = threading.Lock()  # hashes are computed in I/O threads
+        self._lock = asyncio.Lock()
+        # metrics
+        self._hits = metrics.counter('result_cache.hits')
+        self._misses = metrics.counter('result_cache.misses')
+        self._hit_rate = metrics.gauge('result_cache.hit_rate')
+        self._bytes = metrics.gauge('result_cache.bytes')
+        self._evicted = metrics.counter('result_cache.evicted')
+
+    @staticmethod
+    def _hash_files(files: list[Path], base: Path) -> str:
+        hash_obj = hashlib.sha256()
+        for file in sorted(files):
+            hash_obj.update(str(file.relative_to(base)).encode('utf-8'))
+            hash_obj.update(b'\0')
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    hash_obj.update(chunk)
+            hash_obj.update(b'\0')
+        return hash_obj.hexdigest()
+
+    def _dir_hash(self, directory: Path, ignored: set[str] = frozenset()) -> str:
+        """
+        Hash of directory contents. Memoized until any of its files (or files they link to)
+        is modified, added or removed.
+        """
+        files = [f for f in directory.rglob('*') if f.is_file() and f.name not in ignored]
+        memo_key = (directory, max((f.stat().st_mtime_ns for f in files), default=0), len(files))
+        with self._dir_hashes_lock:
+            dir_hash = self._dir_hashes.get(memo_key)
+            if dir_hash is not None:
+                self._dir_hashes.move_to_end(memo_key)
+                return dir_hash
+        dir_hash = self._hash_files(files, directory)
+        with self._dir_hashes_lock:
+            self._dir_hashes[memo_key] = dir_hash
+            while len(self._dir_hashes) > self.MAX_DIR_HASHES:
+                self._dir_hashes.popitem(last=False)
+        return dir_hash
+
+    def _make_key(self, set_submit: SetSubmitInterface) -> str:
+        task_submit = set_submit.task_submit
+        build_path = task_submit.package.build_path(self.build_namespace)
+        with open(task_submit.submit_path, 'rb') as f:
+            solution_hash = hashlib.sha256(f.read()).hexdigest()
+        common_hash = self._dir_hash(build_path / 'common', self.IGNORED_COMMON_FILES)
+        # shards and bundles include configuration of the package sets they come from
+        planned_task = task_submit.plan.task(set_submit.set_name)
+        dir_names = sorted({set_submit.set_name, *planned_task.set_names})
+        set_hash = ':'.join(self._dir_hash(build_path / name) for name in dir_names)
+        return hashlib.sha256(f'{solution_hash}:{set_hash}:{common_hash}'.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f'{key}.json'
+
+    def _update_hit_rate(self):
+        total = self._hits.value + self._misses.value
+        self._hit_rate.set(self._hits.value / total if total else 0.0)
+
+    def _read(self, set_submit: SetSubmitInterface) -> SetResult | None:
+        path = self._entry_path(self._make_key(set_submit))
+        if not path.is_file():
+            return None
+        result = SetResult.model_validate_json(path.read_bytes())
+        os.utime(path)  # mark as recently used
+        return result.model_copy(update={'name': set_submit.set_name})
+
+    def _current_size(self) -> int:
+        if self._size is None:
+            self._size = sum(f.stat().st_size for f in self.cache_dir.rglob('*.json'))
+            self._bytes.set(self._size)
+        return self._size
+
+    def _write(self, set_submit: SetSubmitInterface, result: SetResult):
+        path = self._entry_path(self._make_key(set_submit))
+        data = result.model_dump_json().encode('utf-8')
+        if len(data) > self.max_size:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        size = self._current_size()
+        if path.is_file():
+            size -= path.stat().st_size
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        self._size = size + len(data)
+        if self._size > self.max_size:
+            self._evict()
+        self._bytes.set(self._size)
+
+    def _evict(self):
+        """Removes least recently used entries until the cache takes at most 90% of max_size."""
+        target = int(self.max_size * 0.9)
+        entries = sorted((f.stat().st_mtime, f.stat().st_size, f) for f in self.cache_dir.rglob('*.json'))
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= size
+            self._evicted.inc()
+
+    def _cacheable(self, result: SetResult) -> bool:
+        return bool(result.tests) and all(t.status not in self.UNCACHEABLE_STATUSES
+                                          for t in result.tests.values())
+
+    async def get(self, set_submit: SetSubmitInterface) -> SetResult | None:
+        if not self.enabled_for(set_submit.task_submit.package):
+            return None
+        try:
+            result = await self.executors.run_io(self._read, set_submit)
+        except Exception as e:
+            self.logger.warning("Cannot read cached result of set submit '%s': %s",
+                                set_submit.submit_id, str(e))
+            result = None
+        if result is None:
+            self._misses.inc()
+        else:
+            self._hits.inc()
+        self._update_hit_rate()
+        return result
+
+    async def put(self, set_submit: SetSubmitInterface, result: SetResult):
+        if not self.enabled_for(set_submit.task_submit.package) or not self._cacheable(result):
+            return
+        try:
+            async with self._lock:
+                await self.executors.run_io(self._write, set_submit, result)
+        except Exception as e:
+            self.logger.warning("Cannot cache result of set submit '%s': %s",
+                                set_submit.submit_id, str(e))
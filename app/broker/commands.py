@@ -0,0 +1,260 @@
+"""Running of Python scripts of Kolejka tools (kolejka-client, kolejka-judge)."""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple
+
+from .metrics import MetricsRegistry, registry
+
+
+def default_python_call() -> str:
+    return 'py' if sys.platform.startswith('win') else 'python3'
+
+
+class CommandResult(NamedTuple):
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+
+
+class CommandRunner(ABC):
+    """Runs Python scripts, capturing their output and exit code."""
+
+    @abstractmethod
+    async def run(self, script: Path, *args, stdout: bool = True, stderr: bool = True) -> CommandResult:
+        """
+        Runs script with args. Output that is not captured (stdout or stderr set to False)
+        is discarded. Cancelling the run kills the script.
+        """
+        pass
+
+    async def close(self):
+        pass
+
+
+class SubprocessRunner(CommandRunner):
+    """Starts a new interpreter for every run."""
+
+    def __init__(self, python_call: str | None = None, metrics: MetricsRegistry = registry):
+        self.python_call = python_call or default_python_call()
+        self._run_time = metrics.histogram('commands.run_seconds')
+
+    async def run(self, script: Path, *args, stdout: bool = True, stderr: bool = True) -> CommandResult:
+        start = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            self.python_call, str(script), *map(str, args),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE if stdout else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE if stderr else asyncio.subprocess.DEVNULL
+        )
+        try:
+            out, err = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        finally:
+            self._run_time.observe(time.monotonic() - start)
+        return CommandResult(process.returncode, out or b'', err or b'')
+
+
+class _ForkServer(NamedTuple):
+    process: asyncio.subprocess.Process
+    socket_path: Path
+
+
+class ForkServerRunner(CommandRunner):
+    """
+    Runs scripts by forking them from a fork server (see zygote.py) that has their
+    modules already imported, instead of starting a new interpreter that imports them
+    again for every run. There is a fork server per script (resolved path, so every
+    version of Kolejka tools has its own), the least recently used ones are stopped
+    above max_servers. Scripts whose fork server cannot be started run as subprocesses.
+    """
+
+    ZYGOTE = Path(__file__).with_name('zygote.py')
+
+    class _Unreachable(Exception):
+        pass
+
+    def __init__(self,
+                 logger: logging.Logger,
+                 preload: list[str] = ('kolejka',),
+                 max_servers: int = 4,
+                 python_call: str | None = None,
+                 start_timeout: float = 30.0,
+                 metrics: MetricsRegistry = registry):
+        self.logger = logger
+        self.preload = list(preload)
+        self.max_servers = max_servers
+        self.python_call = python_call or default_python_call()
+        self.start_timeout = start_timeout
+        self._fallback = SubprocessRunner(self.python_call, metrics)
+        self._socket_dir: Path | None = None
+        self._servers: OrderedDict[str, _ForkServer] = OrderedDict()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._broken: set[str] = set()
+        self._stopping: set[asyncio.Task] = set()
+        self._ids = itertools.count(1)
+        # metrics
+        self._run_time = metrics.histogram('commands.run_seconds')
+        self._servers_count = metrics.gauge('commands.forkservers')
+        self._failures = metrics.counter('commands.forkserver_failures')
+
+    async def _start(self, script: str) -> _ForkServer | None:
+        if self._socket_dir is None:
+            # short path - length of unix socket paths is limited
+            self._socket_dir = Path(tempfile.mkdtemp(prefix='broker-zygote-'))
+        socket_path = self._socket_dir / f'{next(self._ids)}.sock'
+        process = await asyncio.create_subprocess_exec(
+            self.python_call, str(self.ZYGOTE), str(socket_path), script, *self.preload,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+        try:
+            async with asyncio.timeout(self.start_timeout):
+                ready = await process.stdout.readline()
+        except TimeoutError:
+            ready = b''
+        if ready.strip() != b'ready':
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            return None
+        self.logger.info("Started fork server of '%s'", script)
+        return _ForkServer(process, socket_path)
+
+    async def _stop(self, server: _ForkServer):
+        # runs already started are finished before the fork server exits
+        if server.process.returncode is None:
+            server.process.terminate()
+        await server.process.wait()
+        server.socket_path.unlink(missing_ok=True)
+
+    def _stop_in_background(self, server: _ForkServer):
+        task = asyncio.create_task(self._stop(server))
+        self._stopping.add(task)
+        task.add_done_callback(self._stopping.discard)
+
+    async def _server(self, script: str) -> _ForkServer | None:
+        if script in self._broken:
+            return None
+        async with self._locks.setdefault(script, asyncio.Lock()):
+            server = self._servers.get(script)
+            if server is not None and server.process.returncode is None:
+                self._servers.move_to_end(script)
+                return server
+            if server is not None:
+                self.logger.warning("Fork server of '%s' exited with %s, restarting it",
+                                    script, server.process.returncode)
+                del self._servers[script]
+            try:
+                server = await self._start(script)
+            except OSError as e:
+                self.logger.warning("Cannot start fork server of '%s': %s", script, str(e))
+                server = None
+            if server is None:
+                self._failures.inc()
+                self._broken.add(script)
+                self.logger.warning("Fork server of '%s' failed to start, it is run as subprocess", script)
+                return None
+            self._servers[script] = server
+            while len(self._servers) > self.max_servers:
+                _, oldest = self._servers.popitem(last=False)
+                self._stop_in_background(oldest)
+            self._servers_count.set(len(self._servers))
+            return server
+
+    async def run(self, script: Path, *args, stdout: bool = True, stderr: bool = True) -> CommandResult:
+        server = await self._server(os.path.realpath(script))
+        if server is not None:
+            start = time.monotonic()
+            try:
+                return await self._run(server, args, stdout, stderr)
+            except self._Unreachable as e:
+                # the fork server died (it is restarted for the next run), the run did not start
+                self._failures.inc()
+                self.logger.warning("Fork server of '%s' is unreachable: %s", script, str(e.__cause__))
+            finally:
+                self._run_time.observe(time.monotonic() - start)
+        return await self._fallback.run(script, *args, stdout=stdout, stderr=stderr)
+
+    @staticmethod
+    async def _read(pipe) -> bytes:
+        if pipe is None:
+            return b''
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            return await reader.read()
+        finally:
+            transport.close()
+
+    @staticmethod
+    async def _exit_code(connection: socket.socket) -> int | None:
+        loop = asyncio.get_running_loop()
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = await loop.sock_recv(connection, 64)
+            if not chunk:
+                return None
+            data += chunk
+        return int(data)
+
+    async def _run(self, server: _ForkServer, args: tuple, stdout: bool, stderr: bool) -> CommandResult:
+        loop = asyncio.get_running_loop()
+        pipes, write_fds = [], []
+        for capture in (stdout, stderr):
+            if capture:
+                r, w = os.pipe()
+                pipes.append(open(r, 'rb', buffering=0))
+            else:
+                w = os.open(os.devnull, os.O_WRONLY)
+                pipes.append(None)
+            write_fds.append(w)
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.setblocking(False)
+        try:
+            try:
+                await loop.sock_connect(connection, str(server.socket_path))
+                request = json.dumps({'args': [str(arg) for arg in args]}).encode() + b'\n'
+                socket.send_fds(connection, [request], write_fds)
+            except OSError as e:
+                raise self._Unreachable() from e
+            finally:
+                # the forked run has its own copies
+                for fd in write_fds:
+                    os.close(fd)
+            out, err, code = await asyncio.gather(self._read(pipes[0]), self._read(pipes[1]),
+                                                  self._exit_code(connection))
+        finally:
+            for pipe in pipes:
+                if pipe is not None:
+                    pipe.close()
+            # closing the connection before the run ends kills it
+            connection.close()
+        if code is None:
+            self._failures.inc()
+            return CommandResult(-1, out, err + b'\nFork server exited during the run')
+        return CommandResult(code, out, err)
+
+    async def close(self):
+        servers = list(self._servers.values())
+        self._servers.clear()
+        self._servers_count.set(0)
+        await asyncio.gather(*map(self._stop, servers), *self._stopping, return_exceptions=True)
+        if self._socket_dir is not None:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            self._socket_dir = None
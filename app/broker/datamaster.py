@@ -10,6 +10,12 @@ from pathlib import Path
 from baca2PackageManager import Package
 from baca2PackageManager.broker_communication import SetResult
 
+from .events import EventBus
+from .executors import Executors, default_executors
+from .planner import TaskPlan, TaskPlanner
+from .state_store import StateStoreInterface
+from .work_units import load_package
+
 
 class StateError(Exception):
     """Raised when state change is illegal."""
@@ -37,6 +43,7 @@ class SetSubmitInterface(ABC):
         self.creation_date = datetime.now()
         self.mod_date = self.creation_date
         self.lock = asyncio.Lock()
+        self._state_changed = asyncio.Event()
         # data fields
         self.set_name = set_name  # not the same as submit_id
 
@@ -52,8 +59,14 @@ class SetSubmitInterface(ABC):
                 raise StateError(msg)
         self.master.logger.info("State of set_submit '%s': %s -> %s",
                                 self.submit_id, self.state.name, new_state.name)
+        event = {'submit_id': self.task_submit.submit_id, 'set': self.set_name,
+                 'from': self.state.name, 'to': new_state.name}
         self.mod_date = datetime.now()
         self.state = new_state
+        self.master.state_changed(self.task_submit, event)
+        # wake up everyone waiting for state change
+        self._state_changed.set()
+        self._state_changed = asyncio.Event()
 
     def requires(self, states: SetState | list[SetState]):
         """Checks if state change is legal. If not, raises StateError."""
@@ -62,6 +75,14 @@ class SetSubmitInterface(ABC):
         if self.state not in states:
             raise StateError(f"Any of {states} is required, but state is {self.state}")
 
+    async def wait_for_state(self, states: SetState | list[SetState], timeout: float | None = None):
+        """Waits until set submit is in any of given states. Raises TimeoutError after timeout seconds."""
+        if isinstance(states, self.SetState):
+            states = [states]
+        async with asyncio.timeout(timeout):
+            while self.state not in states:
+                await self._state_changed.wait()
+
     @property
     def submit_id(self) -> str:
         """Submit_id of set submit."""
@@ -155,8 +176,10 @@ class TaskSubmitInterface(ABC):
                 raise StateError(msg)
         self.master.logger.info("State of task_submit '%s': %s -> %s",
                                 self.submit_id, self.state.name, new_state.name)
+        event = {'submit_id': self.submit_id, 'set': None, 'from': self.state.name, 'to': new_state.name}
         self.mod_date = datetime.now()
         self.state = new_state
+        self.master.state_changed(self, event)
 
     def requires(self, states: TaskState | list[TaskState]):
         """Checks if state change is legal. If not, raises StateError."""
@@ -178,8 +201,11 @@ class TaskSubmitInterface(ABC):
         pass
 
     @abstractmethod
-    async def initialise(self):
-        """Performs initialisation of async data fields."""
+    async def initialise(self, package: Package | None = None):
+        """
+        Performs initialisation of async data fields. Already loaded package can be given
+        to avoid loading it again (e.g. when many submits of the same package are processed).
+        """
         pass
 
     @abstractmethod
@@ -187,6 +213,15 @@ class TaskSubmitInterface(ABC):
         """Checks if all set submits are done."""
         pass
 
+    @property
+    def initialised(self) -> bool:
+        """Tells if set submits of task submit are filled (see initialise)."""
+        try:
+            self.set_submits
+        except ValueError:
+            return False
+        return True
+
     @property
     @abstractmethod
     def package(self) -> Package:
@@ -196,13 +231,27 @@ class TaskSubmitInterface(ABC):
     @property
     @abstractmethod
     def set_submits(self) -> list[SetSubmitInterface]:
-        """List of set submits of task submit."""
+        """
+        List of set submits of task submit. Every set submit is a single Kolejka task,
+        which can be a whole package set, its shard or a bundle of sets (see plan).
+        """
+        pass
+
+    @property
+    @abstractmethod
+    def plan(self) -> TaskPlan:
+        """Plan of Kolejka tasks of task submit."""
         pass
 
     @property
     @abstractmethod
     def results(self) -> dict[str, SetResult]:
-        """List of results of set submits of task submit."""
+        """Results of package sets of task submit (reassembled from results of set submits)."""
+        pass
+
+    @abstractmethod
+    def finished_results(self) -> dict[str, SetResult]:
+        """Results of package sets whose set submits are all done (the rest may still be running)."""
         pass
 
 
@@ -217,26 +266,35 @@ class TaskSubmit(TaskSubmitInterface):
         super().__init__(master, task_submit_id, package_path, commit_id, submit_path)
         self._package: Package = None
         self._sets: list[SetSubmitInterface] = None
+        self._plan: TaskPlan = None
 
     @staticmethod
     def make_set_submit_id(task_submit_id: str, set_name: str) -> str:
         return f"{task_submit_id}_{set_name}"
 
-    async def initialise(self):
+    async def initialise(self, package: Package | None = None):
         async with self.lock:
             if self._sets is not None:
                 raise ValueError("Sets already filled")
             self._sets = []
-            self._package = await asyncio.to_thread(Package, self.package_path, self.commit_id)
-            for t_set in await asyncio.to_thread(self.package.sets):
-                set_submit = self.master.new_set_submit(self, t_set['name'])
+            if package is None:
+                package = await self.master.executors.run_cpu(load_package, self.package_path, self.commit_id)
+            self._package = package
+            self._plan = await self.master.executors.run_io(self.master.plan_package, package)
+            for planned_task in self._plan.tasks:
+                set_submit = self.master.new_set_submit(self, planned_task.name)
                 self._sets.append(set_submit)
+            await self.master.sets_created(self)
 
     def all_checked(self) -> bool:
         if self._sets is None:
             raise ValueError("Sets not filled")
         return all([s.state == SetSubmit.SetState.DONE for s in self.set_submits])
 
+    @property
+    def initialised(self) -> bool:
+        return self._sets is not None
+
     @property
     def package(self) -> Package:
         if self._package is None:
@@ -249,11 +307,39 @@ class TaskSubmit(TaskSubmitInterface):
             raise ValueError("Sets not filled")
         return self._sets.copy()
 
+    @property
+    def plan(self) -> TaskPlan:
+        if self._plan is None:
+            raise ValueError("Plan not filled")
+        return self._plan
+
+    def _assemble_results(self, set_submits: list[SetSubmitInterface]) -> dict[str, SetResult]:
+        results = {}
+        for set_submit in set_submits:
+            planned_task = self.plan.task(set_submit.set_name)
+            result = set_submit.get_result()
+            if planned_task.is_whole_set:
+                results[set_submit.set_name] = result
+                continue
+            for kolejka_name, test_result in result.tests.items():
+                set_name, test_name = planned_task.locate(kolejka_name)
+                set_result = results.setdefault(set_name, SetResult(name=set_name, tests={}))
+                set_result.tests[test_name] = test_result.model_copy(update={'name': test_name})
+        return {name: results[name] for name in self.plan.set_names if name in results}
+
     @property
     def results(self) -> dict[str, SetResult]:
         if not self.all_checked():
             raise ValueError("Sets not filled")
-        return {s.set_name: s.get_result() for s in self.set_submits}
+        return self._assemble_results(self.set_submits)
+
+    def finished_results(self) -> dict[str, SetResult]:
+        done = [s for s in self.set_submits if s.state == SetSubmit.SetState.DONE]
+        done_names = {s.set_name for s in done}
+        finished = [name for name in self.plan.set_names
+                    if all(t.name in done_names for t in self.plan.tasks_of_set(name))]
+        results = self._assemble_results(done)
+        return {name: results[name] for name in finished if name in results}
 
 
 class DataMasterInterface(ABC):
@@ -265,10 +351,70 @@ class DataMasterInterface(ABC):
     def __init__(self,
                  task_submit_t: type[TaskSubmitInterface],
                  set_submit_t: type[SetSubmitInterface],
-                 logger: logging.Logger):
+                 logger: logging.Logger,
+                 planner: TaskPlanner | None = None,
+                 executors: Executors = default_executors,
+                 events: EventBus | None = None,
+                 build_namespace: str | None = None):
         self.task_submit_t = task_submit_t
         self.set_submit_t = set_submit_t
         self.logger = logger
+        self.planner = planner
+        self.executors = executors
+        self.events = events
+        # namespace of package builds, to reuse plans stored with them
+        self.build_namespace = build_namespace
+
+    def plan_package(self, package: Package) -> TaskPlan:
+        """
+        Plans Kolejka tasks of package. Without planner every set is a single task. Plan
+        stored with the package build is used if it was made with current planner settings.
+        """
+        if self.planner is None:
+            return TaskPlan.identity([t_set['name'] for t_set in package.sets()])
+        if self.build_namespace is not None:
+            plan = self.planner.stored_plan(package.build_path(self.build_namespace))
+            if plan is not None:
+                return plan
+        return self.planner.plan(package)
+
+    def state_changed(self, task_submit: 'TaskSubmitInterface', event: dict | None = None):
+        """
+        Called after state of task submit or any of its set submits changes. Event
+        describing the change is published to subscribers of events.
+        """
+        if self.events is not None and event is not None:
+            self.events.publish(event)
+
+    async def sets_created(self, task_submit: 'TaskSubmitInterface'):
+        """Called after set submits of task submit are created, before any of them is sent."""
+        pass
+
+    async def create_task_submit(self,
+                                 task_submit_id: str,
+                                 package_path: Path,
+                                 commit_id: str,
+                                 submit_path: Path) -> 'TaskSubmitInterface':
+        """
+        Creates new task submit like new_task_submit, checking also submits of other broker
+        instances (if any). Used for submits coming from BaCa2.
+        """
+        return self.new_task_submit(task_submit_id, package_path, commit_id, submit_path)
+
+    async def fetch_set_submit(self, submit_id: str, timeout: float | None = None) -> SetSubmitInterface:
+        """
+        Gets set submit by submit_id, also when it is not in local database yet (e.g. it
+        was created by other broker instance). Waits at most timeout seconds for it.
+        """
+        return self.get_set_submit(submit_id)
+
+    async def refresh(self):
+        """Synchronises local database with state shared by other broker instances (if any)."""
+        pass
+
+    async def flush(self):
+        """Waits until all changes of state are written to state shared with other broker instances."""
+        pass
 
     @property
     @abstractmethod
@@ -317,8 +463,12 @@ class DataMaster(DataMasterInterface):
     def __init__(self,
                  task_submit_t: type[TaskSubmitInterface],
                  set_submit_t: type[SetSubmitInterface],
-                 logger: logging.Logger):
-        super().__init__(task_submit_t, set_submit_t, logger)
+                 logger: logging.Logger,
+                 planner: TaskPlanner | None = None,
+                 executors: Executors = default_executors,
+                 events: EventBus | None = None,
+                 build_namespace: str | None = None):
+        super().__init__(task_submit_t, set_submit_t, logger, planner, executors, events, build_namespace)
         self._task_submits: dict[str, TaskSubmit] = {}
         self._set_submits: dict[str, SetSubmit] = {}
 
@@ -352,7 +502,7 @@ class DataMaster(DataMasterInterface):
     def delete_task_submit(self, task_submit: TaskSubmitInterface):
         if task_submit.submit_id not in self.task_submits:
             raise self.DataMasterError(f"Task submit {task_submit.submit_id} does not exist")
-        for set_submit in task_submit.set_submits:
+        for set_submit in task_submit.set_submits if task_submit.initialised else []:
             self._delete_set_submit(set_submit)
         del self.task_submits[task_submit.submit_id]
 
@@ -371,3 +521,266 @@ class DataMaster(DataMasterInterface):
         if submit_id not in self.task_submits:
             raise self.DataMasterError(f"Task submit {submit_id} does not exist")
         return self.task_submits[submit_id]
+
+
+class SharedDataMaster(DataMaster):
+    """
+    DataMaster sharing state of submits with other broker instances through a state store.
+    Every change of state is written to the store, so any instance can pick up a submit
+    when a Kolejka callback for it comes there. The instance that picked up the submit
+    becomes its owner, other instances drop their copies of it on refresh.
+    Store is used from threads only. Changes of state are written in the background, one
+    write per task submit at a time - changes made while a record is being written are
+    coalesced into the next write. Records are created by create_task_submit.
+    """
+
+    EARLY_STATES = (SetSubmitInterface.SetState.INITIAL, SetSubmitInterface.SetState.SENDING_TO_KOLEJKA)
+
+    def __init__(self,
+                 task_submit_t: type[TaskSubmitInterface],
+                 set_submit_t: type[SetSubmitInterface],
+                 logger: logging.Logger,
+                 store: StateStoreInterface,
+                 instance_id: str,
+                 planner: TaskPlanner | None = None,
+                 store_poll_interval: float = 0.2,
+                 executors: Executors = default_executors,
+                 events: EventBus | None = None,
+                 build_namespace: str | None = None):
+        super().__init__(task_submit_t, set_submit_t, logger, planner, executors, events, build_namespace)
+        self.store = store
+        self.instance_id = instance_id
+        self.store_poll_interval = store_poll_interval
+        self._adoptions: dict[str, asyncio.Task] = {}
+        # task submit id -> (task submit, whether its record is to be deleted) waiting to be written
+        self._pending: dict[str, tuple[TaskSubmitInterface, bool]] = {}
+        self._writers: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def _task_key(submit_id: str) -> str:
+        return f'task.{submit_id}'
+
+    @staticmethod
+    def _set_key(submit_id: str) -> str:
+        return f'set.{submit_id}'
+
+    def _record(self, task_submit: TaskSubmitInterface) -> dict:
+        try:
+            set_submits = task_submit.set_submits
+        except ValueError:  # not initialised yet
+            set_submits = []
+        sets = {}
+        for set_submit in set_submits:
+            try:
+                status_code = set_submit.get_status_code()
+            except ValueError:
+                status_code = None
+            try:
+                result = set_submit.get_result().model_dump()
+            except ValueError:
+                result = None
+            sets[set_submit.set_name] = {'state': set_submit.state.name,
+                                         'status_code': status_code,
+                                         'result': result}
+        return {'submit_id': task_submit.submit_id,
+                'package_path': str(task_submit.package_path),
+                'commit_id': task_submit.commit_id,
+                'submit_path': str(task_submit.submit_path),
+                'state': task_submit.state.name,
+                'creation_date': task_submit.creation_date.isoformat(),
+                'owner': self.instance_id,
+                'sets': sets}
+
+    def _owned(self, record: dict | None) -> bool:
+        return record is None or record['owner'] == self.instance_id
+
+    def _schedule(self, task_submit: TaskSubmitInterface, delete: bool = False):
+        """Schedules writing (or deleting) of record of task submit in the background."""
+        submit_id = task_submit.submit_id
+        pending = self._pending.get(submit_id)
+        if pending is None or not pending[1]:  # deletion is never overwritten
+            self._pending[submit_id] = (task_submit, delete)
+        if submit_id not in self._writers:
+            self._writers[submit_id] = asyncio.get_running_loop().create_task(self._writer(submit_id))
+
+    async def _writer(self, submit_id: str):
+        try:
+            while submit_id in self._pending:
+                task_submit, delete = self._pending.pop(submit_id)
+                try:
+                    if delete:
+                        await self._delete_record(task_submit)
+                    else:
+                        await self._write_record(task_submit)
+                except Exception as e:
+                    self.logger.error("Error while storing task submit '%s': %s", submit_id, str(e), exc_info=True)
+        finally:
+            self._writers.pop(submit_id, None)
+
+    async def _write_record(self, task_submit: TaskSubmitInterface):
+        # snapshot of the latest state, taken when it is written
+        new_record = self._record(task_submit)
+
+        def update(record: dict | None) -> dict | None:
+            if record is None:  # finished by other instance
+                return None
+            if not self._owned(record):
+                self.logger.warning("Task submit '%s' was taken over by instance '%s'",
+                                    task_submit.submit_id, record['owner'])
+                return None
+            return new_record
+
+        await asyncio.to_thread(self.store.update, self._task_key(task_submit.submit_id), update)
+
+    async def _delete_record(self, task_submit: TaskSubmitInterface):
+        task_key = self._task_key(task_submit.submit_id)
+        set_ids = [s.submit_id for s in task_submit.set_submits] if task_submit.initialised else []
+
+        def delete():
+            if not self._owned(self.store.get(task_key)):
+                return
+            for set_id in set_ids:
+                self.store.delete(self._set_key(set_id))
+            self.store.delete(task_key)
+
+        await asyncio.to_thread(delete)
+
+    def state_changed(self, task_submit: TaskSubmitInterface, event: dict | None = None):
+        super().state_changed(task_submit, event)
+        # dropped and deleted copies are not written
+        if self.task_submits.get(task_submit.submit_id) is task_submit:
+            self._schedule(task_submit)
+
+    async def flush(self):
+        while self._writers:
+            await asyncio.gather(*self._writers.values())
+
+    async def create_task_submit(self,
+                                 task_submit_id: str,
+                                 package_path: Path,
+                                 commit_id: str,
+                                 submit_path: Path) -> TaskSubmitInterface:
+        task_submit = self.new_task_submit(task_submit_id, package_path, commit_id, submit_path)
+        new_record = self._record(task_submit)
+
+        def create(record: dict | None) -> dict | None:
+            if record is not None:
+                raise self.DataMasterError(f"Task submit {task_submit_id} already exists")
+            return new_record
+
+        try:
+            await asyncio.to_thread(self.store.update, self._task_key(task_submit_id), create)
+        except self.DataMasterError:
+            self._forget_task_submit(task_submit)
+            raise
+        return task_submit
+
+    async def sets_created(self, task_submit: TaskSubmitInterface):
+        # sets can be found by other instances before they are sent
+        indexes = {self._set_key(s.submit_id): {'task': task_submit.submit_id, 'set': s.set_name}
+                   for s in task_submit.set_submits}
+
+        def put():
+            for key, index in indexes.items():
+                self.store.put(key, index)
+
+        await asyncio.to_thread(put)
+
+    def delete_task_submit(self, task_submit: TaskSubmitInterface):
+        super().delete_task_submit(task_submit)
+        self._schedule(task_submit, delete=True)
+
+    def _forget_task_submit(self, task_submit: TaskSubmitInterface):
+        """Removes task submit from local database only."""
+        super().delete_task_submit(task_submit)
+
+    async def fetch_set_submit(self, submit_id: str, timeout: float | None = None) -> SetSubmitInterface:
+        if submit_id in self.set_submits:
+            task_submit = self.set_submits[submit_id].task_submit
+            record = await asyncio.to_thread(self.store.get, self._task_key(task_submit.submit_id))
+            if record is not None and record['owner'] == self.instance_id:
+                return self.set_submits[submit_id]
+            # local copy is stale - the submit was taken over or finished by other instance
+            self.logger.info("Local copy of task submit '%s' is stale (owner: %s), dropping it",
+                             task_submit.submit_id, record['owner'] if record is not None else None)
+            if task_submit.submit_id in self.task_submits:
+                self._forget_task_submit(task_submit)
+        index = await asyncio.to_thread(self.store.get, self._set_key(submit_id))
+        if index is None:
+            raise self.DataMasterError(f"Set submit {submit_id} does not exist")
+        task_id = index['task']
+        # callbacks of many sets of one task submit can come at once, it is adopted once
+        adoption = self._adoptions.get(task_id)
+        if adoption is None:
+            adoption = asyncio.create_task(self._adopt(task_id, index['set'], timeout))
+            adoption.add_done_callback(lambda _: self._adoptions.pop(task_id, None))
+            self._adoptions[task_id] = adoption
+        await asyncio.shield(adoption)
+        return self.get_set_submit(submit_id)
+
+    async def _adopt(self, task_id: str, set_name: str, timeout: float | None):
+        """
+        Takes over task submit from other broker instance, once all of its sets were sent
+        to Kolejka - the owner is not sending any of them anymore, so none of its state
+        changes are lost.
+        """
+        record = None
+        try:
+            async with asyncio.timeout(timeout):
+                while True:
+                    record = await asyncio.to_thread(self.store.get, self._task_key(task_id))
+                    if record is None:
+                        raise self.DataMasterError(f"Task submit {task_id} does not exist")
+                    sets = record['sets']
+                    if set_name in sets and all(self._set_state(s) not in self.EARLY_STATES
+                                                for s in sets.values()):
+                        break
+                    await asyncio.sleep(self.store_poll_interval)
+        except TimeoutError:
+            owner = record['owner'] if record is not None else None
+            raise self.DataMasterError(f"Sets of task submit {task_id} "
+                                       f"not sent to Kolejka by instance '{owner}' in time")
+
+        previous_owner = record['owner']
+
+        def take_over(current: dict | None) -> dict | None:
+            nonlocal previous_owner
+            if current is None:
+                raise self.DataMasterError(f"Task submit {task_id} does not exist")
+            previous_owner = current['owner']
+            return {**current, 'owner': self.instance_id}
+
+        record = await asyncio.to_thread(self.store.update, self._task_key(task_id), take_over)
+        self.logger.info("Task submit '%s' taken over from instance '%s'", task_id, previous_owner)
+        task_submit = DataMaster.new_task_submit(self, task_id, Path(record['package_path']),
+                                                 record['commit_id'], Path(record['submit_path']))
+        try:
+            await task_submit.initialise()
+            for set_submit in task_submit.set_submits:
+                set_record = record['sets'][set_submit.set_name]
+                set_submit.state = self._set_state(set_record)
+                if set_record['status_code'] is not None:
+                    set_submit.set_status_code(set_record['status_code'])
+                if set_record['result'] is not None:
+                    set_submit.set_result(SetResult.model_validate(set_record['result']))
+        except Exception:
+            self._forget_task_submit(task_submit)
+            raise
+        task_submit.state = TaskSubmitInterface.TaskState[record['state']]
+        task_submit.creation_date = datetime.fromisoformat(record['creation_date'])
+
+    @staticmethod
+    def _set_state(set_record: dict) -> SetSubmitInterface.SetState:
+        return SetSubmitInterface.SetState[set_record['state']]
+
+    async def refresh(self):
+        for task_submit in list(self.task_submits.values()):
+            record = await asyncio.to_thread(self.store.get, self._task_key(task_submit.submit_id))
+            if record is None:
+                self.logger.info("Task submit '%s' was finished by other instance, dropping local copy",
+                                 task_submit.submit_id)
+                self._forget_task_submit(task_submit)
+            elif record['owner'] != self.instance_id:
+                self.logger.info("Task submit '%s' is now owned by instance '%s', dropping local copy",
+                                 task_submit.submit_id, record['owner'])
+                self._forget_task_submit(task_submit)
@@ -0,0 +1,244 @@
+"""Bounded on-disk queue of messages, kept across restarts of the broker."""
+import asyncio
+import bisect
+import fcntl
+import itertools
+import os
+import secrets
+import time
+from pathlib import Path
+
+from .executors import Executors, default_executors
+from .metrics import MetricsRegistry, registry
+
+
+class DurableQueue:
+    """
+    FIFO queue of messages (bytes) kept in a directory, one file per message. Files are
+    written atomically and synced to disk before put returns, so accepted messages
+    survive a crash. get takes the oldest message without removing it - it is removed
+    by ack once processed, or returned to the front of the queue by nack. Messages
+    taken but not acked before a restart are taken again (at-least-once delivery).
+
+    Directory may be shared by many processes. Messages have unique names and get
+    claims a message with a lock on its file, so every message is taken by one process
+    at a time - the lock is released by nack or when the process dies. Messages put
+    by other processes are found by rescanning the directory every rescan_interval
+    seconds while waiting (limits are checked against messages known to this process).
+    """
+
+    SUFFIX = '.msg'
+    STALE_TMP = 60.0  # seconds, after which unfinished put of any process is removed
+
+    class QueueFull(Exception):
+        pass
+
+    def __init__(self,
+                 directory: Path,
+                 max_items: int,
+                 max_bytes: int | None = None,
+                 name: str = 'durable_queue',
+                 fsync: bool = True,
+                 rescan_interval: float | None = 5.0,
+                 executors: Executors = default_executors,
+                 metrics: MetricsRegistry = registry):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.name = name
+        self.fsync = fsync
+        self.rescan_interval = rescan_interval
+        self.executors = executors
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._pending: list[str] = []  # keys, sorted
+        self._taken: dict[str, int] = {}  # key -> descriptor of locked file
+        self._writing: set[str] = set()
+        self._sizes: dict[str, int] = {}
+        self._token = secrets.token_hex(4)
+        self._counter = itertools.count()
+        self._bytes = 0
+        self._not_empty = asyncio.Event()
+        # metrics
+        self._items_gauge = metrics.gauge(f'{name}.items')
+        self._bytes_gauge = metrics.gauge(f'{name}.bytes')
+
+    def __len__(self) -> int:
+        """Number of messages in the queue, taken ones included."""
+        return len(self._sizes)
+
+    @property
+    def pending(self) -> int:
+        """Number of messages waiting to be taken."""
+        return len(self._pending)
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f'{key}{self.SUFFIX}'
+
+    def _new_key(self) -> str:
+        # ordered by time of put, unique among processes
+        return f'{time.time_ns():020d}-{self._token}-{next(self._counter):08d}'
+
+    def _update_metrics(self):
+        self._items_gauge.set(len(self._sizes))
+        self._bytes_gauge.set(self._bytes)
+        if self._pending:
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
+
+    def _scan(self) -> dict[str, int]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        sizes = {}
+        now = time.time()
+        for path in self.directory.iterdir():
+            try:
+                if path.suffix == self.SUFFIX:
+                    sizes[path.stem] = path.stat().st_size
+                elif path.name.endswith('.tmp') and now - path.stat().st_mtime > self.STALE_TMP:
+                    path.unlink(missing_ok=True)  # interrupted put
+            except FileNotFoundError:  # acked by other process
+                pass
+        return sizes
+
+    async def load(self):
+        """Reads the queue from disk. Called by other methods when needed."""
+        async with self._load_lock:
+            if self._loaded:
+                return
+            self._sizes = await self.executors.run_io(self._scan)
+            self._pending = sorted(self._sizes)
+            self._bytes = sum(self._sizes.values())
+            self._loaded = True
+            self._update_metrics()
+
+    async def rescan(self):
+        """Updates the queue with messages put and removed by other processes."""
+        await self.load()
+        sizes = await self.executors.run_io(self._scan)
+        for key in list(self._sizes):
+            if key not in sizes and key not in self._taken and key not in self._writing:
+                self._forget(key)
+        for key, size in sizes.items():
+            if key not in self._sizes:
+                self._sizes[key] = size
+                self._bytes += size
+                bisect.insort(self._pending, key)
+        self._update_metrics()
+
+    def _forget(self, key: str):
+        self._bytes -= self._sizes.pop(key, 0)
+        index = bisect.bisect_left(self._pending, key)
+        if index < len(self._pending) and self._pending[index] == key:
+            del self._pending[index]
+
+    def _write(self, key: str, data: bytes):
+        path = self._path(key)
+        tmp = path.with_name(f'{path.name}.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+        if self.fsync:
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    async def put(self, data: bytes) -> str:
+        """Stores message at the end of the queue. Raises QueueFull if limits would be exceeded."""
+        await self.load()
+        if len(self._sizes) >= self.max_items:
+            raise self.QueueFull(f"Queue '{self.name}' has {len(self._sizes)} messages")
+        if self.max_bytes is not None and self._bytes + len(data) > self.max_bytes:
+            raise self.QueueFull(f"Queue '{self.name}' has {self._bytes} bytes")
+        key = self._new_key()
+        # reserved before writing, so concurrent puts cannot exceed the limits
+        self._sizes[key] = len(data)
+        self._bytes += len(data)
+        self._writing.add(key)
+        try:
+            await self.executors.run_io(self._write, key, data)
+        except BaseException:
+            del self._sizes[key]
+            self._bytes -= len(data)
+            raise
+        finally:
+            self._writing.discard(key)
+        bisect.insort(self._pending, key)
+        self._update_metrics()
+        return key
+
+    def _claim(self, key: str) -> tuple[int, bytes] | None:
+        """Locks file of message. Returns its descriptor and content, or None if it is taken or removed."""
+        try:
+            fd = os.open(self._path(key), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.fstat(fd).st_nlink == 0:  # acked before it was locked
+                os.close(fd)
+                return None
+            with open(fd, 'rb', closefd=False) as f:
+                return fd, f.read()
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        except BaseException:
+            os.close(fd)
+            raise
+
+    async def get(self) -> tuple[str, bytes] | None:
+        """Takes the oldest pending message. Returns its key and content, or None if there is none."""
+        await self.load()
+        while self._pending:
+            key = self._pending.pop(0)
+            self._update_metrics()
+            claimed = await self.executors.run_io(self._claim, key)
+            if claimed is None:
+                # taken or acked by other process, found again by rescan if it is nacked
+                self._forget(key)
+                self._update_metrics()
+                continue
+            fd, data = claimed
+            self._taken[key] = fd
+            return key, data
+        return None
+
+    async def wait(self):
+        """Waits until there is a pending message."""
+        await self.load()
+        while not self._pending:
+            try:
+                await asyncio.wait_for(self._not_empty.wait(), self.rescan_interval)
+            except asyncio.TimeoutError:
+                await self.rescan()
+
+    async def ack(self, key: str):
+        """Removes taken message from the queue."""
+        if key not in self._taken:
+            return
+        await self.executors.run_io(self._path(key).unlink, True)
+        os.close(self._taken.pop(key))
+        self._bytes -= self._sizes.pop(key)
+        self._update_metrics()
+
+    def close(self):
+        """Returns all taken messages to the queue, releasing them for other processes."""
+        for key in list(self._taken):
+            self.nack(key)
+
+    def nack(self, key: str):
+        """Returns taken message to the queue, in its original place."""
+        if key in self._taken:
+            os.close(self._taken.pop(key))
+            bisect.insort(self._pending, key)
+            self._update_metrics()
@@ -0,0 +1,81 @@
+"""In-process publishing of submit state changes to subscribers (see /events)."""
+import asyncio
+import itertools
+from datetime import datetime
+
+from .metrics import MetricsRegistry, registry
+
+
+class Subscription:
+    """Events of chosen task submits (or of all of them) buffered for one subscriber."""
+
+    def __init__(self, submit_ids: set[str] | None, buffer_size: int):
+        self.submit_ids = submit_ids
+        self.dropped = False
+        self._queue: asyncio.Queue[dict | None] = asyncio.Queue(buffer_size)
+
+    def matches(self, event: dict) -> bool:
+        return self.submit_ids is None or event['submit_id'] in self.submit_ids
+
+    async def get(self, timeout: float | None = None) -> dict | None:
+        """
+        Next event. Returns None if the subscription was dropped, raises TimeoutError
+        if there was no event for timeout seconds.
+        """
+        async with asyncio.timeout(timeout):
+            return await self._queue.get()
+
+
+class EventBus:
+    """
+    Publishes events to all matching subscriptions. Publishing never waits - when buffer
+    of a subscriber is full, the subscriber is too slow and is dropped (it can subscribe
+    again), so slow consumers never hold back the broker or other consumers.
+    """
+
+    class TooManySubscribers(Exception):
+        pass
+
+    def __init__(self, buffer_size: int, max_subscribers: int, metrics: MetricsRegistry = registry):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._subscriptions: set[Subscription] = set()
+        self._ids = itertools.count(1)
+        # metrics
+        self._published = metrics.counter('events.published')
+        self._subscribers = metrics.gauge('events.subscribers')
+        self._dropped = metrics.counter('events.dropped_subscribers')
+
+    def subscribe(self, submit_ids: set[str] | None = None) -> Subscription:
+        """Subscribes to events of given task submits (all of them if None)."""
+        if len(self._subscriptions) >= self.max_subscribers:
+            raise self.TooManySubscribers(f"Limit of {self.max_subscribers} subscribers reached")
+        subscription = Subscription(submit_ids, self.buffer_size)
+        self._subscriptions.add(subscription)
+        self._subscribers.set(len(self._subscriptions))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscriptions.discard(subscription)
+        self._subscribers.set(len(self._subscriptions))
+
+    def _drop(self, subscription: Subscription):
+        self.unsubscribe(subscription)
+        subscription.dropped = True
+        self._dropped.inc()
+        # buffered events are lost anyway - make room for the end of subscription
+        while not subscription._queue.empty():
+            subscription._queue.get_nowait()
+        subscription._queue.put_nowait(None)
+
+    def publish(self, event: dict):
+        """Publishes event (with 'submit_id' key) to subscribers. Adds 'id' and 'time' to it."""
+        event = {'id': next(self._ids), 'time': datetime.now().isoformat(), **event}
+        self._published.inc()
+        for subscription in list(self._subscriptions):
+            if not subscription.matches(event):
+                continue
+            try:
+                subscription._queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._drop(subscription)
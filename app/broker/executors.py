@@ -0,0 +1,77 @@
+"""Executors running blocking work outside of the event loop."""
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from .metrics import MetricsRegistry, registry
+
+T = TypeVar('T')
+
+
+class Executors:
+    """
+    Separate pools for I/O-bound and CPU-bound work. CPU-bound work runs in a process
+    pool, so it does not compete for the GIL with request handling - functions and
+    arguments sent there have to be picklable (see work_units). Without CPU workers
+    CPU-bound work runs in the I/O pool.
+    """
+
+    def __init__(self,
+                 io_workers: int | None,
+                 cpu_workers: int,
+                 metrics: MetricsRegistry = registry,
+                 mp_start_method: str = 'forkserver'):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.mp_start_method = mp_start_method
+        self._io_pool: ThreadPoolExecutor | None = None
+        self._cpu_pool: ProcessPoolExecutor | None = None
+        # metrics
+        self._run_time = {kind: metrics.histogram(f'executors.{kind}.run_seconds') for kind in ('io', 'cpu')}
+        self._in_flight = {kind: metrics.gauge(f'executors.{kind}.in_flight') for kind in ('io', 'cpu')}
+
+    @property
+    def io_pool(self) -> Executor:
+        # pools are created lazily, so no threads or processes are started on import
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(self.io_workers, thread_name_prefix='broker-io')
+        return self._io_pool
+
+    @property
+    def cpu_pool(self) -> Executor:
+        if self.cpu_workers <= 0:
+            return self.io_pool
+        if self._cpu_pool is None:
+            self._cpu_pool = ProcessPoolExecutor(self.cpu_workers,
+                                                 mp_context=multiprocessing.get_context(self.mp_start_method))
+        return self._cpu_pool
+
+    async def _run(self, kind: str, pool: Executor, func: Callable[..., T], *args: Any) -> T:
+        start = time.monotonic()
+        self._in_flight[kind].inc()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+        finally:
+            self._in_flight[kind].dec()
+            self._run_time[kind].observe(time.monotonic() - start)
+
+    async def run_io(self, func: Callable[..., T], *args: Any) -> T:
+        """Runs blocking I/O-bound func(*args) in the thread pool."""
+        return await self._run('io', self.io_pool, func, *args)
+
+    async def run_cpu(self, func: Callable[..., T], *args: Any) -> T:
+        """Runs CPU-bound func(*args) in the process pool. Func has to be a picklable work unit."""
+        return await self._run('cpu', self.cpu_pool, func, *args)
+
+    def shutdown(self, wait: bool = True):
+        for pool in (self._cpu_pool, self._io_pool):
+            if pool is not None:
+                pool.shutdown(wait=wait, cancel_futures=True)
+        self._cpu_pool = None
+        self._io_pool = None
+
+
+# Used by components that are not given executors explicitly - equivalent to asyncio.to_thread
+default_executors = Executors(io_workers=None, cpu_workers=0)
@@ -1,34 +1,136 @@
 """Main class for handling broker's logic."""
 import asyncio
 import logging
-from datetime import timedelta
+import re
+from datetime import datetime, timedelta
+from pathlib import Path
 
-from baca2PackageManager import Package
+from baca2PackageManager import Package, TSet, TestF
+from baca2PackageManager.broker_communication import SetResult, TestResult
 
+from .breaker import is_outage
+from .cache import ResultCacheInterface
 from .messenger import KolejkaMessengerInterface, BacaMessengerInterface, PackageManagerInterface
 from .datamaster import DataMasterInterface, SetSubmitInterface, TaskSubmitInterface
+from .metrics import MetricsRegistry, registry
+from .outbox import ResultOutbox
+from .planner import TaskPlan
+from .streaming import ResultStreamer
+
+
+class DispatchLimit:
+    """
+    Limit of submits dispatched to Kolejka and not finished yet. Intake jobs are taken
+    from the queue only while there is room, so submits wait in the fair queue rather
+    than in Kolejka, and a bulk rejudge cannot get ahead of submits of higher classes.
+    """
+
+    def __init__(self, max_outstanding: int, metrics: MetricsRegistry = registry):
+        if max_outstanding < 1:
+            raise ValueError("Dispatch limit has to be at least 1")
+        self.max_outstanding = max_outstanding
+        self._submits: set[str] = set()
+        self._reserved = 0
+        self._room = asyncio.Event()
+        # metrics
+        self._outstanding = metrics.gauge('dispatch.outstanding')
+
+    @property
+    def outstanding(self) -> int:
+        """Number of submits dispatched (or being dispatched) and not finished."""
+        return len(self._submits) + self._reserved
+
+    def _changed(self):
+        self._outstanding.set(len(self._submits))
+        if self.outstanding < self.max_outstanding:
+            self._room.set()
+
+    async def reserve(self):
+        """Waits until there is room for one more submit and reserves it."""
+        while self.outstanding >= self.max_outstanding:
+            self._room.clear()
+            await self._room.wait()
+        self._reserved += 1
+        self._changed()
+
+    def release(self):
+        """Releases reservation (submit dispatched by the job is counted by add)."""
+        self._reserved -= 1
+        self._changed()
+
+    def add(self, submit_id: str):
+        self._submits.add(submit_id)
+        self._changed()
+
+    def discard(self, submit_id: str):
+        self._submits.discard(submit_id)
+        self._changed()
+
+    def retain(self, submit_ids):
+        """Forgets submits that are not in submit_ids (e.g. taken over by other instance)."""
+        self._submits.intersection_update(submit_ids)
+        self._changed()
 
 
 class BrokerMaster:
     """Main class for handling broker's logic."""
 
+    # Status of tests whose solution failed to compile
+    COMPILE_ERROR_STATUS = 'CME'
+    # Status of tests of sets that failed in Kolejka after all retries
+    INTERNAL_ERROR_STATUS = 'INT'
+    # settings of tests that affect compilation of the solution (see judges/judge_main.py)
+    COMPILE_KEYS = ('environment', 'makefile', 'basename', 'regex_count', 'source_size', 'binary_size',
+                    'compile_time', 'compile_memory', 'c_standard', 'cpp_standard', 'gcc_arguments')
+    DEFAULT_COMPILE_TIME = '10s'
+    # compilation that took this part of its time limit may have been killed, so it may pass elsewhere
+    COMPILE_TIMEOUT_FRACTION = 0.9
+
     def __init__(self,
                  data_master: DataMasterInterface,
                  kolejka_messenger: KolejkaMessengerInterface,
                  baca_messenger: BacaMessengerInterface,
                  package_manager: PackageManagerInterface,
-                 logger: logging.Logger):
+                 logger: logging.Logger,
+                 result_cache: ResultCacheInterface | None = None,
+                 streamer: ResultStreamer | None = None,
+                 outbox: ResultOutbox | None = None,
+                 dispatch_limit: DispatchLimit | None = None):
         self.kolejka_messenger = kolejka_messenger
         self.baca_messenger = baca_messenger
         self.data_master = data_master
         self.package_manager = package_manager
         self.logger = logger
+        self.result_cache = result_cache
+        self.streamer = streamer
+        self.outbox = outbox
+        self.dispatch_limit = dispatch_limit
+        # set submit id -> (time of next poll, current polling backoff)
+        self._poll_schedule: dict[str, tuple[datetime, timedelta]] = {}
+        # commit path -> lock, so one package commit is never built twice at once
+        self._build_locks: dict[Path, asyncio.Lock] = {}
+        # commit path -> number of builds started, to detect builds during checks
+        self._build_counts: dict[Path, int] = {}
 
     async def process_new_task_submit(self, task_submit: TaskSubmitInterface):
-        """Sends all sets to kolejka and changes state of task submit to AWAITING_SETS."""
+        """
+        Sends all sets to kolejka and changes state of task submit to AWAITING_SETS.
+        Sets with cached results are not sent, they are marked as DONE right away.
+        Sets that could not be sent after all retries (transient errors) are failed alone,
+        with internal errors as results, if any other set got to Kolejka. Otherwise, the first
+        error is raised once sending of all sets is finished, so it is known which sets got to Kolejka.
+        """
 
         async def kolejka_send_task(set_submit: SetSubmitInterface):
             async with set_submit.lock:
+                if self.result_cache is not None:
+                    result = await self.result_cache.get(set_submit)
+                    if result is not None:
+                        set_submit.set_result(result)
+                        set_submit.change_state(set_submit.SetState.DONE,
+                                                requires=set_submit.SetState.INITIAL)
+                        self.logger.info("Set submit '%s' result taken from cache", set_submit.submit_id)
+                        return
                 set_submit.change_state(set_submit.SetState.SENDING_TO_KOLEJKA,
                                         requires=set_submit.SetState.INITIAL)
                 await self.kolejka_messenger.send(set_submit)
@@ -37,50 +139,213 @@ class BrokerMaster:
 
         async with task_submit.lock:
             task_submit.change_state(task_submit.TaskState.AWAITING_SETS, requires=task_submit.TaskState.INITIAL)
+            if self.dispatch_limit is not None:
+                self.dispatch_limit.add(task_submit.submit_id)
             tasks = [kolejka_send_task(s) for s in task_submit.set_submits]
-            await asyncio.gather(*tasks)
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            failed = [(s, e) for s, e in zip(task_submit.set_submits, results) if isinstance(e, BaseException)]
+            if not failed:
+                return
+            dispatched = any(s.state == s.SetState.AWAITING_KOLEJKA for s in task_submit.set_submits)
+            if not dispatched or not all(is_outage(e) for _, e in failed):
+                raise failed[0][1]
+            for set_submit, error in failed:
+                async with set_submit.lock:
+                    self._fail_set_submit(set_submit, error)
 
     async def trash_task_submit(self, task_submit: TaskSubmitInterface, error: Exception | None):
         """
         Changes state of task submit to ERROR, sends error message to BaCa2 if error != None
-        and deletes task submit from database.
+        and deletes task submit from database. Task submit does not have to be initialised.
         """
         self.logger.info("Trashing task submit '%s'", task_submit.submit_id)
         async with task_submit.lock:
             if task_submit.submit_id not in self.data_master.task_submits:
                 self.logger.warning("Task submit '%s' already deleted", task_submit.submit_id)
                 return
-            if not all(s.submit_id in self.data_master.set_submits for s in task_submit.set_submits):
+            set_submits = task_submit.set_submits if task_submit.initialised else []
+            if not all(s.submit_id in self.data_master.set_submits for s in set_submits):
                 self.logger.critical("Task submit '%s' has set submits that are not in database",
                                      task_submit.submit_id)
                 return
             task_submit.change_state(task_submit.TaskState.ERROR, requires=None)
-            task_submit.change_set_states(SetSubmitInterface.SetState.ERROR, requires=None)
+            for set_submit in set_submits:
+                set_submit.change_state(SetSubmitInterface.SetState.ERROR, requires=None)
             self.data_master.delete_task_submit(task_submit)
+            if self.dispatch_limit is not None:
+                self.dispatch_limit.discard(task_submit.submit_id)
+            if self.streamer is not None:
+                await self.streamer.close(task_submit)
             if error is not None:
                 await self.baca_messenger.send_error(task_submit, error)
 
-    async def process_finished_set_submit(self, set_submit: SetSubmitInterface):
-        """Gets results from kolejka and changes state of set submit to DONE."""
+    async def process_finished_set_submit(self, set_submit: SetSubmitInterface) -> bool:
+        """
+        Gets results from kolejka and changes state of set submit to DONE. Returns False
+        (and does nothing) if set submit has already been finished. If the solution failed
+        to compile, remaining sets compiled the same way are finished right away. With result
+        streaming, results of sets finished this way are sent to BaCa2 right away.
+        In active mode all sets have already been executed by then, so only fetching of
+        their results is saved, not Kolejka time.
+        """
+        if not await self._finish_set_submit(set_submit):
+            return False
+        if self._is_compile_error(set_submit):
+            await self._skip_remaining_sets(set_submit)
+        if self.streamer is not None:
+            await self.streamer.stream(set_submit.task_submit)
+        return True
+
+    async def _finish_set_submit(self, set_submit: SetSubmitInterface) -> bool:
         async with set_submit.lock:
+            if set_submit.state in (set_submit.SetState.WAITING_FOR_RESULTS, set_submit.SetState.DONE):
+                self.logger.info("Set submit '%s' already finished", set_submit.submit_id)
+                return False
             set_submit.change_state(set_submit.SetState.WAITING_FOR_RESULTS,
                                     requires=set_submit.SetState.AWAITING_KOLEJKA)
-            await self.kolejka_messenger.get_results(set_submit)
+            try:
+                await self.kolejka_messenger.get_results(set_submit)
+            except Exception as e:
+                if not is_outage(e):
+                    raise
+                self._fail_set_submit(set_submit, e)
+                return True
             set_submit.change_state(set_submit.SetState.DONE,
                                     requires=set_submit.SetState.WAITING_FOR_RESULTS)
+            if self.result_cache is not None:
+                await self.result_cache.put(set_submit, set_submit.get_result())
             self.logger.info("Set submit '%s' finished in %s",
                              set_submit.submit_id, set_submit.mod_date - set_submit.creation_date)
+            return True
+
+    def _is_compile_error(self, set_submit: SetSubmitInterface) -> bool:
+        try:
+            result = set_submit.get_result()
+        except ValueError:  # no result available
+            return False
+        tests = result.tests.values()
+        return bool(tests) and all(t.status == self.COMPILE_ERROR_STATUS for t in tests)
+
+    @staticmethod
+    def _seconds(value) -> float | None:
+        """Parses time like 10, '10s' or '1500ms'. Returns None if it is not a time."""
+        match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*(ms|s)?\s*', str(value))
+        if match is None:
+            return None
+        seconds = float(match[1])
+        return seconds / 1000 if match[2] == 'ms' else seconds
+
+    @staticmethod
+    def _tests(set_submit: SetSubmitInterface) -> list[tuple[TSet, TestF]]:
+        """Tests of set submit, with their sets."""
+        package = set_submit.task_submit.package
+        planned_task = set_submit.task_submit.plan.task(set_submit.set_name)
+        if planned_task.is_whole_set:
+            t_set = package.sets(set_submit.set_name)
+            return [(t_set, test) for test in t_set.tests()]
+        return [(package.sets(t.set_name), package.sets(t.set_name).tests(t.test_name))
+                for t in planned_task.tests]
+
+    def _compile_config(self, package: Package, t_set: TSet, test: TestF) -> dict:
+        """
+        Compilation settings of test as seen by the judge: package-wide regex_count, settings of
+        the set and test-level settings overriding them.
+        """
+        config = {k: t_set.get(k) for k in self.COMPILE_KEYS}
+        if config['regex_count'] is None:
+            config['regex_count'] = package.get('regex_count')
+        config.update({k: test.get(k) for k in self.COMPILE_KEYS if test.get(k) is not None})
+        if config['environment'] is not None:  # relative to directory of the set
+            config['environment'] = t_set._path / config['environment']
+        return config
+
+    def _compile_configs(self, set_submit: SetSubmitInterface) -> set[tuple[str, ...]]:
+        """Different ways the solution is compiled in tests of set submit."""
+        package = set_submit.task_submit.package
+        return {tuple(str(v) for v in self._compile_config(package, t_set, test).values())
+                for t_set, test in self._tests(set_submit)}
+
+    def _compile_timed_out(self, set_submit: SetSubmitInterface) -> bool:
+        """Checks if compilation may have been killed for exceeding its time limit."""
+        package = set_submit.task_submit.package
+        limits = [self._seconds(self._compile_config(package, t_set, test)['compile_time']
+                                or self.DEFAULT_COMPILE_TIME)
+                  for t_set, test in self._tests(set_submit)]
+        times = [self._seconds(t.logs.get('compile_time')) for t in set_submit.get_result().tests.values()
+                 if t.logs and t.logs.get('compile_time')]
+        limits = [limit for limit in limits if limit is not None]
+        times = [t for t in times if t is not None]
+        return bool(limits and times) and max(times) >= self.COMPILE_TIMEOUT_FRACTION * min(limits)
+
+    def _fail_set_submit(self, set_submit: SetSubmitInterface, error: BaseException):
+        """
+        Finishes set submit (whose lock is held) with internal errors of all its tests,
+        so the rest of its task submit is not trashed with it.
+        """
+        self.logger.error("Set submit '%s' failed after all retries: %s", set_submit.submit_id, str(error))
+        set_submit.set_result(self._status_result(set_submit, self.INTERNAL_ERROR_STATUS,
+                                                  {'error': str(error)}))
+        set_submit.change_state(set_submit.SetState.DONE, requires=None)
+
+    def _status_result(self, set_submit: SetSubmitInterface, status: str, logs: dict[str, str]) -> SetResult:
+        """Result of set submit with the same status of all of its tests."""
+        planned_task = set_submit.task_submit.plan.task(set_submit.set_name)
+        if planned_task.is_whole_set:
+            t_set = set_submit.task_submit.package.sets(set_submit.set_name)
+            names = [t['name'] for t in t_set.tests()]
+        else:
+            names = [t.kolejka_name for t in planned_task.tests]
+        tests = {name: TestResult(name=name, status=status, logs=logs) for name in names}
+        return SetResult(name=set_submit.set_name, tests=tests)
+
+    async def _skip_remaining_sets(self, set_submit: SetSubmitInterface):
+        """
+        Finishes unfinished sets of task submit that compile the solution the same way as
+        set_submit with compile errors, without waiting for Kolejka. Their callbacks are
+        dropped when they come. Nothing is skipped if compilation may have timed out.
+        """
+        task_submit = set_submit.task_submit
+        if self._compile_timed_out(set_submit):
+            self.logger.info("Compilation of task submit '%s' may have timed out, no sets skipped",
+                             task_submit.submit_id)
+            return
+        configs = self._compile_configs(set_submit)
+        compile_errors = list(set_submit.get_result().tests.values())
+        logs = {'compile_log': (compile_errors[0].logs or {}).get('compile_log', '')}
+        skipped = []
+        for other in task_submit.set_submits:
+            if other is set_submit or not self._compile_configs(other) <= configs:
+                continue
+            # waits until set submit that is being sent gets to Kolejka
+            async with other.lock:
+                if other.state in (other.SetState.DONE, other.SetState.ERROR):
+                    continue
+                other.set_result(self._status_result(other, self.COMPILE_ERROR_STATUS, logs))
+                other.change_state(other.SetState.DONE, requires=None)
+                skipped.append(other.set_name)
+        if skipped:
+            self.logger.info("Solution of task submit '%s' failed to compile, skipped sets: %s",
+                             task_submit.submit_id, skipped)
 
     async def process_finished_task_submit(self, task_submit: TaskSubmitInterface):
-        """Sends task submit to BaCa2 and deletes it from database. All set submits must be checked before calling."""
+        """
+        Sends task submit to BaCa2 and deletes it from database. All set submits must be checked before calling.
+        With outbox, results are stored in it and delivered later (sent directly only if it is full).
+        """
         if not task_submit.all_checked():
             raise ValueError("Not all sets checked")
         task_submit.change_state(task_submit.TaskState.SENDING_TO_BACA2, requires=task_submit.TaskState.AWAITING_SETS)
-        await self.baca_messenger.send(task_submit)
+        if self.streamer is not None:
+            # partial results that are being sent go before the final ones
+            await self.streamer.close(task_submit)
+        if self.outbox is None or not await self.outbox.put(task_submit):
+            await self.baca_messenger.send(task_submit)
         self.logger.info("Task submit '%s' finished in %s",
                          task_submit.submit_id, task_submit.mod_date - task_submit.creation_date)
         task_submit.change_state(task_submit.TaskState.DONE, requires=task_submit.TaskState.SENDING_TO_BACA2)
         self.data_master.delete_task_submit(task_submit)
+        if self.dispatch_limit is not None:
+            self.dispatch_limit.discard(task_submit.submit_id)
 
     async def if_all_checked_process_finished_task_submit(self, task_submit: TaskSubmitInterface):
         """Checks if all sets are checked and if so, calls process_finished_task_submit."""
@@ -90,15 +355,38 @@ class BrokerMaster:
                                  task_submit.submit_id)
                 await self.process_finished_task_submit(task_submit)
 
-    async def process_package(self, package: Package):
-        """Builds package if needed."""
-        if not await self.package_manager.check_build(package) or self.package_manager.force_rebuild:
+    async def process_package(self, package: Package, plan: TaskPlan | None = None) -> bool:
+        """
+        Builds package if needed (with Kolejka tasks of plan, if given - e.g. the plan
+        submits were initialised with). Returns True if package was built.
+        """
+        force_rebuild = self.package_manager.force_rebuild
+        path = package.commit_path
+        lock = self._build_locks.setdefault(path, asyncio.Lock())
+        checked = False
+        if not force_rebuild and not lock.locked():
+            builds = self._build_counts.get(path, 0)
+            built = await self.package_manager.check_build(package)
+            # partially built package may look built - not trusted if a build started meanwhile
+            if not lock.locked() and self._build_counts.get(path, 0) == builds:
+                if built:
+                    return False
+                checked = True
+        waited = lock.locked()
+        async with lock:
+            if not force_rebuild and (waited or not checked) and await self.package_manager.check_build(package):
+                return False  # built while waiting for the lock
+            self._build_counts[path] = self._build_counts.get(path, 0) + 1
             self.logger.info("Building package '%s'", package.name)
-            await self.package_manager.build_package(package)
+            await self.package_manager.build_package(package, plan)
             self.logger.info("Package '%s' built successfully", package.name)
+            return True
 
     async def _deletion_daemon_body(self, task_submit_timeout: timedelta):
         self.logger.info("Running deletion daemon")
+        await self.data_master.refresh()
+        if self.dispatch_limit is not None:
+            self.dispatch_limit.retain(self.data_master.task_submits)
         to_be_deleted = []
         for task_submit in self.data_master.task_submits.values():
             if task_submit.mod_date - task_submit.creation_date >= task_submit_timeout:
@@ -113,11 +401,82 @@ class BrokerMaster:
         for task_submit in to_be_deleted:
             await self.trash_task_submit(task_submit, None)
 
-    async def deletion_daemon(self, task_submit_timeout: timedelta, interval: int):
+    async def deletion_daemon(self, task_submit_timeout: timedelta, interval: int | timedelta):
+        if isinstance(interval, timedelta):
+            interval = interval.total_seconds()
         while True:
             await self._deletion_daemon_body(task_submit_timeout)
             await asyncio.sleep(interval)
 
-    async def start_daemons(self, task_submit_timeout: timedelta, interval: int):
-        """Launch this method as a separate task to start daemons."""
-        await asyncio.gather(self.deletion_daemon(task_submit_timeout, interval))
+    async def _poll_set_submit(self, set_submit: SetSubmitInterface):
+        """Asks Kolejka for results of set submit and processes them if they are ready."""
+        try:
+            if not await self.kolejka_messenger.poll(set_submit):
+                return False
+            self.logger.info("Set submit '%s' found finished by polling", set_submit.submit_id)
+            await self.process_finished_set_submit(set_submit)
+            await self.if_all_checked_process_finished_task_submit(set_submit.task_submit)
+        except Exception as e:
+            self.logger.error("Error while polling set submit '%s': %s",
+                              set_submit.submit_id, str(e), exc_info=True)
+            await self.trash_task_submit(set_submit.task_submit, e)
+        return True
+
+    async def _polling_daemon_body(self,
+                                   min_age: timedelta,
+                                   batch_size: int,
+                                   max_backoff: timedelta):
+        await self.data_master.refresh()
+        now = datetime.now()
+        awaiting = {s.submit_id: s for s in self.data_master.set_submits.values()
+                    if s.state == s.SetState.AWAITING_KOLEJKA}
+        # forget set submits that are not waiting anymore
+        for submit_id in set(self._poll_schedule) - set(awaiting):
+            del self._poll_schedule[submit_id]
+
+        due = [s for s in awaiting.values()
+               if now - s.mod_date >= min_age
+               and self._poll_schedule.get(s.submit_id, (now, min_age))[0] <= now]
+        due.sort(key=lambda s: s.mod_date)
+        due = due[:batch_size]
+        if not due:
+            return
+        self.logger.info("Polling Kolejka for %s set submits waiting for callback", len(due))
+
+        finished = await asyncio.gather(*[self._poll_set_submit(s) for s in due])
+        for set_submit, is_finished in zip(due, finished):
+            if is_finished:
+                self._poll_schedule.pop(set_submit.submit_id, None)
+                continue
+            _, backoff = self._poll_schedule.get(set_submit.submit_id, (now, min_age))
+            self._poll_schedule[set_submit.submit_id] = (now + backoff, min(backoff * 2, max_backoff))
+
+    async def polling_daemon(self,
+                             interval: timedelta,
+                             min_age: timedelta,
+                             batch_size: int,
+                             max_backoff: timedelta):
+        """
+        Fallback for lost Kolejka callbacks. Set submits waiting for a callback longer than
+        min_age are polled (at most batch_size at once), each with exponential backoff.
+        """
+        while True:
+            await self._polling_daemon_body(min_age, batch_size, max_backoff)
+            await asyncio.sleep(interval.total_seconds())
+
+    async def start_daemons(self,
+                            task_submit_timeout: timedelta,
+                            interval: int | timedelta,
+                            polling_interval: timedelta | None = None,
+                            polling_min_age: timedelta = timedelta(minutes=1),
+                            polling_batch_size: int = 50,
+                            polling_max_backoff: timedelta = timedelta(minutes=5)):
+        """
+        Launch this method as a separate task to start daemons. Polling daemon is started
+        only if polling_interval is given.
+        """
+        daemons = [self.deletion_daemon(task_submit_timeout, interval)]
+        if polling_interval is not None:
+            daemons.append(self.polling_daemon(polling_interval, polling_min_age,
+                                               polling_batch_size, polling_max_backoff))
+        await asyncio.gather(*daemons)
@@ -1,29 +1,29 @@
 """Module for communication with KOLEJKA and BaCa2 and package managing."""
-import os
+import hashlib
+import secrets
 import shutil
-import stat
-import subprocess
-import sys
 from abc import ABC, abstractmethod
-from copy import deepcopy
-import asyncio
 from datetime import datetime
 from pathlib import Path
 import logging
 import traceback
 
-import requests
-import yaml
 import aiohttp
+import pydantic
+import pydantic_core
 from baca2PackageManager import Package
 from baca2PackageManager.broker_communication import BrokerToBaca, make_hash, BrokerToBacaError, \
-    SetResult, TestResult
+    SetResult
 
-from .builder import Builder
+from .artifacts import ArtifactStore
+from .commands import CommandRunner, SubprocessRunner
 from .datamaster import TaskSubmitInterface, SetSubmitInterface
-from .yaml_tags import get_loader
-
-import logging
+from .executors import Executors, default_executors
+from .metrics import MetricsRegistry, registry
+from .planner import TaskPlan, TaskPlanner
+from .resources import ResourceEstimator
+from .retry import Retrier, TransientError
+from .work_units import build_package, parse_results
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +33,10 @@ class KolejkaMessengerInterface(ABC):
     class KolejkaCommunicationError(Exception):
         pass
 
+    class KolejkaTransientError(KolejkaCommunicationError, TransientError):
+        """Failure that is worth retrying, e.g. Kolejka server being unreachable."""
+        pass
+
     @abstractmethod
     async def send(self, set_submit: SetSubmitInterface):
         """Sends set submit to KOLEJKA."""
@@ -43,6 +47,13 @@ class KolejkaMessengerInterface(ABC):
         """Retrieves results of set submit from KOLEJKA."""
         pass
 
+    async def poll(self, set_submit: SetSubmitInterface) -> bool:
+        """
+        Checks if set submit is finished in KOLEJKA (used when its callback is lost).
+        By default, set submits are never reported as finished.
+        """
+        return False
+
 
 class KolejkaMessenger(KolejkaMessengerInterface):
     """Class for KOLEJKA communication for when ACTIVE_WAIT is disabled."""
@@ -52,13 +63,18 @@ class KolejkaMessenger(KolejkaMessengerInterface):
                  build_namespace: str,
                  kolejka_conf: Path,
                  kolejka_callback_url_prefix: str,
-                 logger: logging.Logger):
+                 logger: logging.Logger,
+                 retrier: Retrier | None = None,
+                 executors: Executors = default_executors,
+                 runner: CommandRunner | None = None):
         self.submits_dir = submits_dir
         self.build_namespace = build_namespace
         self.kolejka_conf = kolejka_conf
-        self.python_call: str = 'py' if sys.platform.startswith('win') else 'python3'
+        self.runner = runner if runner is not None else SubprocessRunner()
         self.kolejka_callback_url_prefix = kolejka_callback_url_prefix
         self.logger = logger
+        self.retrier = retrier if retrier is not None else Retrier({}, None, logger)
+        self.executors = executors
 
     def get_kolejka_client(self, package: Package) -> Path:
         return package.build_path(self.build_namespace) / 'common' / 'kolejka-client'
@@ -82,49 +98,47 @@ class KolejkaMessenger(KolejkaMessengerInterface):
         except Exception as e:
             raise self.KolejkaCommunicationError("Cannot communicate with KOLEJKA.") from e
 
-    async def _send_inner(self, set_submit: SetSubmitInterface):
+    async def _create_task(self, set_submit: SetSubmitInterface, task_dir: Path):
         task_submit = set_submit.task_submit
-
-        task_dir = self.submits_dir / task_submit.submit_id / f'{set_submit.set_name}.task'
         set_id = task_submit.make_set_submit_id(task_submit.submit_id, set_submit.set_name)
         callback_url = self.kolejka_callback_url(set_id)
 
-        cmd_judge = [self.python_call,
-                     self.get_kolejka_judge(task_submit.package),
-                     'task',
-                     '--callback', callback_url,
-                     '--library-path', self.get_kolejka_judge(task_submit.package),
-                     self.get_judge_py(task_submit.package),
-                     task_submit.package.build_path(
-                         self.build_namespace) / set_submit.set_name / "tests.yaml",
-                     task_submit.submit_path,
-                     task_dir]
-
-        judge_future = await asyncio.create_subprocess_shell(subprocess.list2cmdline(cmd_judge),
-                                                             stderr=asyncio.subprocess.PIPE)
-        _, stderr = await judge_future.communicate()
-
-        if judge_future.returncode != 0:
+        judge = await self.runner.run(self.get_kolejka_judge(task_submit.package),
+                                      'task',
+                                      '--callback', callback_url,
+                                      '--library-path', self.get_kolejka_judge(task_submit.package),
+                                      self.get_judge_py(task_submit.package),
+                                      task_submit.package.build_path(
+                                          self.build_namespace) / set_submit.set_name / "tests.yaml",
+                                      task_submit.submit_path,
+                                      task_dir,
+                                      stdout=False)
+
+        # task creation is local - failing again with the same input is expected
+        if judge.returncode != 0:
             raise self.KolejkaCommunicationError(
-                f'KOLEJKA judge failed to create task; stderr:\n{stderr.decode()}')
-
-        cmd_client = [self.python_call,
-                      self.get_kolejka_client(task_submit.package),
-                      '--config-file', self.kolejka_conf,
-                      'task', 'put',
-                      task_dir]
-
-        client_future = await asyncio.create_subprocess_shell(subprocess.list2cmdline(cmd_client),
-                                                              stdout=asyncio.subprocess.PIPE,
-                                                              stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await client_future.communicate()
-        result_code = stdout.decode('utf-8').strip()
+                f'KOLEJKA judge failed to create task; stderr:\n{judge.stderr.decode()}')
 
-        if client_future.returncode != 0:
-            raise self.KolejkaCommunicationError(
+    async def _put_task(self, set_submit: SetSubmitInterface, task_dir: Path) -> str:
+        task_submit = set_submit.task_submit
+        client = await self.runner.run(self.get_kolejka_client(task_submit.package),
+                                       '--config-file', self.kolejka_conf,
+                                       'task', 'put',
+                                       task_dir)
+        result_code = client.stdout.decode('utf-8').strip()
+
+        if client.returncode != 0:
+            raise self.KolejkaTransientError(
                 f'KOLEJKA client failed to communicate with KOLEJKA server. '
-                f'stderr:\n{stderr.decode()}')
+                f'stderr:\n{client.stderr.decode()}')
+        return result_code
 
+    async def _send_inner(self, set_submit: SetSubmitInterface):
+        task_dir = self.submits_dir / set_submit.task_submit.submit_id / f'{set_submit.set_name}.task'
+        await self.retrier.run('create', f"set submit '{set_submit.submit_id}'",
+                               self._create_task, set_submit, task_dir)
+        result_code = await self.retrier.run('put', f"set submit '{set_submit.submit_id}'",
+                                             self._put_task, set_submit, task_dir)
         set_submit.set_status_code(result_code)
 
     async def get_results(self, set_submit: SetSubmitInterface):
@@ -138,117 +152,100 @@ class KolejkaMessenger(KolejkaMessengerInterface):
             self.logger.error(str(e))
             raise self.KolejkaCommunicationError("Cannot communicate with KOLEJKA.") from e
 
+    async def poll(self, set_submit: SetSubmitInterface) -> bool:
+        # a single attempt with the deadline of the stage - there is no 'poll' retry policy,
+        # as polling is repeated anyway
+        return await self.retrier.run('poll', f"set submit '{set_submit.submit_id}'",
+                                      self._poll_inner, set_submit)
+
+    def _poll_dir(self, set_submit: SetSubmitInterface) -> Path:
+        """Directory of results downloaded by poll, it appears only once they are complete."""
+        return self.submits_dir / set_submit.task_submit.submit_id / f'{set_submit.set_name}.poll'
+
+    async def _poll_inner(self, set_submit: SetSubmitInterface) -> bool:
+        poll_dir = self._poll_dir(set_submit)
+        if poll_dir.is_dir():
+            return True
+        # downloaded apart from results of callbacks, which may be downloaded at the same time
+        tmp_dir = poll_dir.with_name(f'.{poll_dir.name}.{secrets.token_hex(4)}')
+        try:
+            result_get = await self.runner.run(self.get_kolejka_client(set_submit.task_submit.package),
+                                               '--config-file', self.kolejka_conf,
+                                               'result', 'get',
+                                               set_submit.get_status_code(),
+                                               tmp_dir,
+                                               stdout=False, stderr=False)
+
+            # result get fails until the task is finished
+            if result_get.returncode != 0:
+                return False
+            if not poll_dir.is_dir():
+                tmp_dir.rename(poll_dir)
+            return True
+        finally:
+            await self.executors.run_io(shutil.rmtree, tmp_dir, True)
+
     async def _get_results_inner(self, set_submit: SetSubmitInterface,
                                  result_code: str) -> SetResult:
         result_dir = self.submits_dir / set_submit.task_submit.submit_id / f'{set_submit.set_name}.result'
 
-        result_get = [self.python_call,
-                      self.get_kolejka_client(set_submit.task_submit.package),
-                      '--config-file', self.kolejka_conf,
-                      'result', 'get',
-                      result_code,
-                      result_dir]
-
-        result_future = await asyncio.create_subprocess_shell(
-            subprocess.list2cmdline(result_get),
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.PIPE
-        )
-        _, stderr = await result_future.communicate()
-
-        if result_future.returncode != 0:
-            raise self.KolejkaCommunicationError(
-                f'KOLEJKA client failed to get results; stderr:\n{stderr.decode()}')
+        poll_dir = self._poll_dir(set_submit)
+        if poll_dir.is_dir():
+            result_dir = poll_dir
+        else:
+            await self.retrier.run('get', f"set submit '{set_submit.submit_id}'",
+                                   self._download_results, result_code, result_dir,
+                                   set_submit.task_submit.package)
+        return await self.executors.run_cpu(parse_results, set_submit.set_name, result_dir)
 
-        return self._parse_results(set_submit, result_dir)
+    async def _download_results(self, result_code: str, result_dir: Path, package: Package):
+        result_get = await self.runner.run(self.get_kolejka_client(package),
+                                           '--config-file', self.kolejka_conf,
+                                           'result', 'get',
+                                           result_code,
+                                           result_dir,
+                                           stdout=False)
 
-    @staticmethod
-    def _parse_results(set_submit: SetSubmitInterface, result_dir: Path) -> SetResult:
-        results_yaml = result_dir / 'results' / 'results.yaml'
-        with open(results_yaml) as f:
-            content: dict = yaml.load(f, Loader=get_loader())
-        tests = {}
-        for key, val in content.items():
-            satori = val['satori']
-
-            logs = {}
-            logs_names = ['compile_log', 'checker_log']
-            for log_name in logs_names:
-                logs[log_name] = satori.get(log_name, '')
-
-            tmp = TestResult(
-                name=key,
-                status=satori.get('status'),
-                time_real=float(satori.get('execute_time_real', '-1.0 ')[:-1]),
-                time_cpu=float(satori.get('execute_time_cpu', '-1.0 ')[:-1]),
-                runtime_memory=int(satori.get('execute_memory', '-1 ')[:-1]),
-                answer=satori.get('answer', ''),
-                logs=logs,
-            )
-            tests[key] = tmp
-        return SetResult(name=set_submit.set_name, tests=tests)
+        if result_get.returncode != 0:
+            raise self.KolejkaTransientError(
+                f'KOLEJKA client failed to get results; stderr:\n{result_get.stderr.decode()}')
 
 
 class KolejkaMessengerActiveWait(KolejkaMessenger):
     """Class for KOLEJKA communication for when ACTIVE_WAIT is enabled."""
 
     async def _send_inner(self, set_submit: SetSubmitInterface):
-        task_submit = set_submit.task_submit
-
-        task_dir = self.submits_dir / task_submit.submit_id / f'{set_submit.set_name}.task'
-        set_id = task_submit.make_set_submit_id(task_submit.submit_id, set_submit.set_name)
-        callback_url = self.kolejka_callback_url(set_id)
-
-        cmd_judge = [self.python_call,
-                     self.get_kolejka_judge(task_submit.package),
-                     'task',
-                     '--callback', callback_url,
-                     '--library-path', self.get_kolejka_judge(task_submit.package),
-                     self.get_judge_py(task_submit.package),
-                     task_submit.package.build_path(
-                         self.build_namespace) / set_submit.set_name / "tests.yaml",
-                     task_submit.submit_path,
-                     task_dir]
-
-        judge_future = await asyncio.create_subprocess_shell(subprocess.list2cmdline(cmd_judge),
-                                                             stderr=asyncio.subprocess.PIPE)
-        _, stderr = await judge_future.communicate()
-
-        if judge_future.returncode != 0:
-            raise self.KolejkaCommunicationError(
-                f'KOLEJKA judge failed to create task; stderr:\n{stderr.decode()}')
-
-        set_submit.set_result(await self.results_task(set_submit))
+        task_dir = self.submits_dir / set_submit.task_submit.submit_id / f'{set_submit.set_name}.task'
+        await self.retrier.run('create', f"set submit '{set_submit.submit_id}'",
+                               self._create_task, set_submit, task_dir)
+        set_submit.set_result(await self.retrier.run('execute', f"set submit '{set_submit.submit_id}'",
+                                                     self.results_task, set_submit))
 
     async def get_results(self, set_submit: SetSubmitInterface):
         pass  # results are retrieved in send
 
+    async def poll(self, set_submit: SetSubmitInterface) -> bool:
+        return False  # there are no callbacks to lose
+
     async def results_task(self, set_submit: SetSubmitInterface) -> SetResult:
         task_submit = set_submit.task_submit
         task_dir = self.submits_dir / task_submit.submit_id / f'{set_submit.set_name}.task'
         result_dir = self.submits_dir / set_submit.task_submit.submit_id / f'{set_submit.set_name}.result'
 
-        cmd_client_active_wait = [
-            self.python_call,
+        client_active_wait = await self.runner.run(
             self.get_kolejka_client(task_submit.package),
             '--config-file', self.kolejka_conf,
             'execute',
             task_dir,
-            result_dir
-        ]
-
-        result_future = await asyncio.create_subprocess_shell(
-            subprocess.list2cmdline(cmd_client_active_wait),
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.PIPE
+            result_dir,
+            stdout=False
         )
-        _, stderr = await result_future.communicate()
 
-        if result_future.returncode != 0:
-            raise self.KolejkaCommunicationError(
-                f'KOLEJKA client failed to get results; stderr:\n{stderr.decode()}')
+        if client_active_wait.returncode != 0:
+            raise self.KolejkaTransientError(
+                f'KOLEJKA client failed to get results; stderr:\n{client_active_wait.stderr.decode()}')
 
-        results = self._parse_results(set_submit, result_dir)
+        results = await self.executors.run_cpu(parse_results, set_submit.set_name, result_dir)
         return results
 
 
@@ -268,44 +265,175 @@ class BacaMessengerInterface(ABC):
         """Sends error message to BaCa2."""
         pass
 
+    async def send_partial(self, task_submit: TaskSubmitInterface, results: dict[str, SetResult],
+                           sequence: int):
+        """
+        Sends results of sets finished before the whole task submit (see ResultStreamer).
+        Messengers without partial delivery do nothing.
+        """
+        pass
+
+    @abstractmethod
+    async def encode(self, task_submit: TaskSubmitInterface) -> bytes:
+        """Final message with results of task submit, serialised for send_encoded (see ResultOutbox)."""
+        pass
+
+    @abstractmethod
+    async def send_encoded(self, submit_id: str, data: bytes) -> int:
+        """Sends message made by encode to BaCa2. Returns status code of the response."""
+        pass
+
+
+class BrokerToBacaPartial(BrokerToBaca):
+    """
+    Results of some sets of a submit. Messages of one submit are numbered with consecutive
+    sequence numbers, each one carries sets that were not sent before. Results of a set
+    never change, so a message can safely be applied more than once.
+    """
+    sequence: int
+
+
+def encode_message(message: pydantic.BaseModel) -> tuple[bytes, str]:
+    """
+    Serialises message to JSON once, with the compiled pydantic serializer. Returns
+    serialised message and its sha256.
+    """
+    data = pydantic_core.to_json(message)
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def client_timeout(seconds: float | None) -> aiohttp.ClientTimeout:
+    """Deadline of a whole request, aiohttp default if not given."""
+    return aiohttp.ClientTimeout(total=seconds) if seconds is not None else aiohttp.client.DEFAULT_TIMEOUT
+
 
 class BacaMessenger(BacaMessengerInterface):
+    # Messages with more tests than that are serialised outside of the event loop
+    OFFLOAD_TESTS = 1000
 
     def __init__(self, baca_success_url: str, baca_failure_url: str, password: str,
-                 logger: logging.Logger):
+                 logger: logging.Logger, executors: Executors = default_executors,
+                 baca_partial_url: str | None = None,
+                 offload_tests: int = OFFLOAD_TESTS,
+                 timeouts: dict[str, float] | None = None,
+                 metrics: MetricsRegistry = registry):
         self.baca_success_url = baca_success_url
         self.baca_failure_url = baca_failure_url
+        self.baca_partial_url = baca_partial_url
         self.password = password
         self.logger = logger
+        self.executors = executors
+        self.offload_tests = offload_tests
+        # deadlines of requests per kind: 'send', 'partial' and 'error'
+        self.timeouts = timeouts or {}
+        self.metrics = metrics
+
+    def _timed_out(self, stage: str):
+        self.metrics.counter(f'timeouts.baca.{stage}').inc()
+        self.logger.warning("Request '%s' to baCa2 exceeded its deadline of %ss and was aborted",
+                            stage, self.timeouts.get(stage))
 
     async def send(self, task_submit) -> int:
         try:
-            return await self._send_to_baca(task_submit, self.baca_success_url, self.password)
+            return await self._send_to_baca(task_submit, self.baca_success_url, self.password,
+                                            self.executors, self.offload_tests, self.timeouts.get('send'))
+        except TimeoutError as e:
+            self._timed_out('send')
+            raise self.BacaMessengerError("Cannot communicate with baCa2.") from e
         except Exception as e:
             raise self.BacaMessengerError("Cannot communicate with baCa2.") from e
 
+    async def encode(self, task_submit: TaskSubmitInterface) -> bytes:
+        data, _, _ = await self._encode_results(task_submit, self.password, self.executors, self.offload_tests)
+        return data
+
+    async def send_encoded(self, submit_id: str, data: bytes) -> int:
+        try:
+            return await self._post(self.baca_success_url, data, self.timeouts.get('send'))
+        except TimeoutError as e:
+            self._timed_out('send')
+            raise self.BacaMessengerError("Cannot communicate with baCa2.") from e
+        except aiohttp.ClientError as e:
+            raise self.BacaMessengerError("Cannot communicate with baCa2.") from e
+
+    async def send_partial(self, task_submit: TaskSubmitInterface, results: dict[str, SetResult],
+                           sequence: int):
+        if self.baca_partial_url is None:
+            return
+        message = BrokerToBacaPartial.model_construct(
+            pass_hash=make_hash(self.password, task_submit.submit_id),
+            submit_id=task_submit.submit_id,
+            results=results,
+            sequence=sequence,
+        )
+        if sum(len(r.tests) for r in results.values()) > self.offload_tests:
+            data, _ = await self.executors.run_io(encode_message, message)
+        else:
+            data, _ = encode_message(message)
+        try:
+            async with aiohttp.ClientSession(timeout=client_timeout(self.timeouts.get('partial'))) as session:
+                async with session.post(url=self.baca_partial_url,
+                                        verify_ssl=False,
+                                        headers={'content-type': 'application/json'},
+                                        data=data) as response:
+                    status_code = response.status
+        except TimeoutError as e:
+            self._timed_out('partial')
+            raise self.BacaMessengerError("Cannot communicate with baCa2.") from e
+        except aiohttp.ClientError as e:
+            raise self.BacaMessengerError("Cannot communicate with baCa2.") from e
+        if status_code != 200:
+            raise self.BacaMessengerError(f'Failed to send partial results to baCa2. Status code: {status_code}')
+
     async def send_error(self, task_submit: TaskSubmitInterface, error: Exception) -> bool:
         try:
             return await self._send_error_to_baca(task_submit, error, self.baca_failure_url,
-                                                  self.password)
+                                                  self.password, self.timeouts.get('error'))
+        except TimeoutError:
+            self._timed_out('error')
+            return False
         except aiohttp.ClientError:
             return False
 
     @staticmethod
-    async def _send_to_baca(task_submit: TaskSubmitInterface, baca_url: str, password: str):
-        message = BrokerToBaca(
-            pass_hash=make_hash(password, task_submit.submit_id),
-            submit_id=task_submit.submit_id,
-            results=deepcopy(task_submit.results),
-        )
+    async def _encode_results(task_submit: TaskSubmitInterface, password: str,
+                              executors: Executors = default_executors,
+                              offload_tests: int = OFFLOAD_TESTS) -> tuple[bytes, str, int]:
+        """Returns serialised message, its sha256 and number of tests in it."""
+        def encode() -> tuple[bytes, str]:
+            # results are freshly assembled and not modified later, so they are not copied
+            message = BrokerToBaca.model_construct(
+                pass_hash=make_hash(password, task_submit.submit_id),
+                submit_id=task_submit.submit_id,
+                results=task_submit.results,
+            )
+            return encode_message(message)
 
-        logger.warning(f'Sending results to baCa2: {message.model_dump_json()}')
-        async with aiohttp.ClientSession() as session:
+        tests = sum(len(s.get_result().tests) for s in task_submit.set_submits)
+        if tests > offload_tests:
+            data, digest = await executors.run_io(encode)
+        else:
+            data, digest = encode()
+        return data, digest, tests
+
+    @staticmethod
+    async def _post(baca_url: str, data: bytes, timeout: float | None = None) -> int:
+        async with aiohttp.ClientSession(timeout=client_timeout(timeout)) as session:
             async with session.post(url=baca_url,
                                     verify_ssl=False,
                                     headers={'content-type': 'application/json'},
-                                    data=message.model_dump_json()) as response:
-                status_code = response.status
+                                    data=data) as response:
+                return response.status
+
+    @staticmethod
+    async def _send_to_baca(task_submit: TaskSubmitInterface, baca_url: str, password: str,
+                            executors: Executors = default_executors,
+                            offload_tests: int = OFFLOAD_TESTS,
+                            timeout: float | None = None):
+        data, digest, tests = await BacaMessenger._encode_results(task_submit, password, executors, offload_tests)
+        logger.info("Sending results of '%s' to baCa2: %s tests, %s bytes, sha256 %s",
+                    task_submit.submit_id, tests, len(data), digest[:16])
+        status_code = await BacaMessenger._post(baca_url, data, timeout)
 
         if status_code != 200:
             raise ConnectionError(f'Failed to send results to baCa2. Status code: {status_code}')
@@ -316,7 +444,8 @@ class BacaMessenger(BacaMessengerInterface):
     async def _send_error_to_baca(task_submit: TaskSubmitInterface,
                                   error: Exception,
                                   baca_url: str,
-                                  password: str) -> bool:
+                                  password: str,
+                                  timeout: float | None = None) -> bool:
         message = BrokerToBacaError(
             pass_hash=make_hash(password, task_submit.submit_id),
             submit_id=task_submit.submit_id,
@@ -326,7 +455,7 @@ class BacaMessenger(BacaMessengerInterface):
                     traceback.format_exception(type(error), error, error.__traceback__))
             }
         )
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(timeout=client_timeout(timeout)) as session:
             async with session.post(url=baca_url,
                                     verify_ssl=False,
                                     headers={'content-type': 'application/json'},
@@ -348,50 +477,46 @@ class PackageManagerInterface(ABC):
         pass
 
     @abstractmethod
-    async def build_package(self, package: Package):
-        """Builds package."""
+    async def build_package(self, package: Package, plan: TaskPlan | None = None):
+        """Builds package with Kolejka tasks of plan (planned while building if not given)."""
         pass
 
 
 class PackageManager(PackageManagerInterface):
 
     def __init__(self,
-                 kolejka_src_dir: Path,
+                 artifacts: ArtifactStore,
                  build_namespace: str,
-                 force_rebuild: bool):
+                 force_rebuild: bool,
+                 planner: TaskPlanner | None = None,
+                 resources: ResourceEstimator | None = None,
+                 executors: Executors = default_executors):
         super().__init__(force_rebuild)
-        self.kolejka_src_dir = kolejka_src_dir
+        self.artifacts = artifacts
         self.build_namespace = build_namespace
+        self.planner = planner
+        self.resources = resources
+        self.executors = executors
 
-    def refresh_kolejka_src(self, add_executable_attr: bool = True):  # TODO: change to async?
-        if self.kolejka_src_dir.is_dir():
-            shutil.rmtree(self.kolejka_src_dir)
-        self.kolejka_src_dir.mkdir()
-
-        kolejka_judge = requests.get('https://kolejka.matinf.uj.edu.pl/kolejka-judge').content
-        kolejka_client = requests.get('https://kolejka.matinf.uj.edu.pl/kolejka-client').content
-
-        kolejka_judge_path = self.kolejka_src_dir / 'kolejka-judge'
-        kolejka_client_path = self.kolejka_src_dir / 'kolejka-client'
-
-        with open(kolejka_judge_path, mode='wb') as judge:
-            judge.write(kolejka_judge)
-        with open(kolejka_client_path, mode='wb') as client:
-            client.write(kolejka_client)
-
-        if add_executable_attr:
-            current_judge = os.stat(kolejka_judge_path)
-            current_client = os.stat(kolejka_client_path)
-
-            os.chmod(kolejka_judge_path, current_judge.st_mode | stat.S_IEXEC)
-            os.chmod(kolejka_client_path, current_client.st_mode | stat.S_IEXEC)
+    def _check_build(self, package: Package) -> bool:
+        if not package.check_build(self.build_namespace):
+            return False
+        if self.planner is None:
+            return True
+        # build has to be planned with current planner settings and contain all its Kolejka tasks
+        build_path = package.build_path(self.build_namespace)
+        plan = self.planner.stored_plan(build_path)
+        return plan is not None and all((build_path / t.name).is_dir() for t in plan.tasks)
 
     async def check_build(self, package: Package) -> bool:
-        return await asyncio.to_thread(package.check_build, self.build_namespace)
+        return await self.executors.run_io(self._check_build, package)
 
-    async def build_package(self, package: Package):
-        if self.force_rebuild:
-            await asyncio.to_thread(self.refresh_kolejka_src)
-
-        build_pkg = Builder(package)
-        await asyncio.to_thread(build_pkg.build)
+    async def build_package(self, package: Package, plan: TaskPlan | None = None):
+        version = await self.artifacts.acquire()
+        build_path = None
+        try:
+            await self.executors.run_cpu(build_package, package, self.planner,
+                                         self.artifacts.version_path(version), self.resources, plan)
+            build_path = package.build_path(self.build_namespace)
+        finally:
+            self.artifacts.release(version, build_path)
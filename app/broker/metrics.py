@@ -0,0 +1,127 @@
+"""In-process metrics of the broker."""
+import threading
+from collections import deque
+
+
+class Counter:
+    """Monotonically increasing value."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int | float = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int | float:
+        return self._value
+
+    def snapshot(self) -> int | float:
+        return self._value
+
+
+class Gauge:
+    """Value that can go up and down."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value: int | float):
+        self._value = value
+
+    def inc(self, amount: int | float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: int | float = 1):
+        self.inc(-amount)
+
+    @property
+    def value(self) -> int | float:
+        return self._value
+
+    def snapshot(self) -> int | float:
+        return self._value
+
+
+class Histogram:
+    """Distribution of observed values. Percentiles are computed over the most recent samples."""
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, max_samples: int = 1024):
+        self._samples: deque[float] = deque(maxlen=max_samples)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._samples.append(value)
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def percentile(self, percent: float) -> float:
+        """Returns given percentile of recent samples (0.0 if there are no samples)."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, int(round(percent / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self) -> dict[str, float]:
+        out = {
+            'count': self._count,
+            'sum': self._sum,
+            'max': self._max,
+        }
+        for percent in self.PERCENTILES:
+            out[f'p{percent}'] = self.percentile(percent)
+        return out
+
+
+class MetricsRegistry:
+    """Named collection of metrics. Metrics are created on first use."""
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, metric_t: type):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_t()
+                self._metrics[name] = metric
+        if not isinstance(metric, metric_t):
+            raise TypeError(f"Metric '{name}' is a {type(metric).__name__}, not a {metric_t.__name__}")
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get(name, Gauge)
+
+    def histogram(self, name: str) -> Histogram:
+        return self._get(name, Histogram)
+
+    def snapshot(self) -> dict:
+        """Returns current values of all metrics, sorted by name."""
+        with self._lock:
+            items = sorted(self._metrics.items())
+        return {name: metric.snapshot() for name, metric in items}
+
+
+# Registry used by default by all broker components
+registry = MetricsRegistry()
@@ -0,0 +1,176 @@
+"""Durable outbox of results for BaCa2, delivered by retry workers."""
+import asyncio
+import logging
+import time
+from pathlib import Path
+
+from .datamaster import TaskSubmitInterface
+from .durable_queue import DurableQueue
+from .executors import Executors, default_executors
+from .messenger import BacaMessengerInterface
+from .metrics import MetricsRegistry, registry
+from .retry import RetryPolicy
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit adapted by AIMD: every success raises it by 1/limit (about one per
+    round of requests), every failure cuts it by decrease, down to 1.
+    """
+
+    def __init__(self, initial: int, maximum: int, decrease: float = 0.5):
+        self.maximum = maximum
+        self.decrease = decrease
+        self.limit = float(min(initial, maximum))
+        self.in_flight = 0
+        self._released = asyncio.Event()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            self._released.clear()
+            await self._released.wait()
+        self.in_flight += 1
+
+    def release(self, success: bool | None):
+        """Releases a slot. success is None if the outcome of the call is unknown (it was cancelled)."""
+        self.in_flight -= 1
+        if success:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        elif success is not None:
+            self.limit = max(1.0, self.limit * self.decrease)
+        self._released.set()
+
+
+class ResultOutbox:
+    """
+    Results of finished task submits are serialised and stored in a durable queue, so
+    task submits can be deleted right away. Workers deliver them to BaCa2 - a result is
+    removed from the queue only after BaCa2 accepts it (status 200), so results survive
+    BaCa2 being unavailable and restarts of the broker. Failed deliveries are retried
+    with jittered exponential backoff, and the number of concurrent deliveries is adapted
+    to BaCa2 (see AdaptiveLimit). Results rejected by BaCa2 with a client error (other
+    than 408 and 429) are never retried, they are moved to rejected_dir.
+    """
+
+    # client errors that are worth retrying
+    RETRY_STATUSES = (408, 429)
+
+    def __init__(self,
+                 baca_messenger: BacaMessengerInterface,
+                 queue: DurableQueue,
+                 logger: logging.Logger,
+                 workers: int = 16,
+                 initial_concurrency: int = 4,
+                 backoff: RetryPolicy = RetryPolicy(0, 1.0, 300.0),  # attempts are unlimited
+                 rejected_dir: Path | None = None,
+                 executors: Executors = default_executors,
+                 metrics: MetricsRegistry = registry):
+        self.baca_messenger = baca_messenger
+        self.queue = queue
+        self.logger = logger
+        self.workers = workers
+        self.limit = AdaptiveLimit(initial_concurrency, workers)
+        self.backoff = backoff
+        self.rejected_dir = rejected_dir
+        self.executors = executors
+        # metrics
+        self._delivered = metrics.counter('outbox.delivered')
+        self._retries = metrics.counter('outbox.retries')
+        self._rejected = metrics.counter('outbox.rejected')
+        self._overflow = metrics.counter('outbox.overflow')
+        self._concurrency = metrics.gauge('outbox.concurrency')
+        self._in_flight = metrics.gauge('outbox.in_flight')
+        self._delivery_time = metrics.histogram('outbox.delivery_seconds')
+
+    async def put(self, task_submit: TaskSubmitInterface) -> bool:
+        """
+        Stores results of task submit for delivery. Returns False if the outbox is full
+        (results are not stored then, they have to be sent directly).
+        """
+        data = await self.baca_messenger.encode(task_submit)
+        try:
+            await self.queue.put(task_submit.submit_id.encode() + b'\n' + data)
+        except DurableQueue.QueueFull as e:
+            self._overflow.inc()
+            self.logger.warning("Results of '%s' not stored in outbox: %s", task_submit.submit_id, str(e))
+            return False
+        return True
+
+    def _update_metrics(self):
+        self._concurrency.set(int(self.limit.limit))
+        self._in_flight.set(self.limit.in_flight)
+
+    async def _send(self, submit_id: str, data: bytes) -> int | None:
+        """Sends message within the concurrency limit. Returns status code, None if there was no response."""
+        await self.limit.acquire()
+        self._update_metrics()
+        status = None
+        try:
+            status = await self.baca_messenger.send_encoded(submit_id, data)
+        except BacaMessengerInterface.BacaMessengerError as e:
+            self.logger.warning("Delivery of results of '%s' failed: %s", submit_id, str(e))
+        except BaseException:
+            self.limit.release(None)
+            self._update_metrics()
+            raise
+        self.limit.release(status == 200)
+        self._update_metrics()
+        return status
+
+    def _write_rejected(self, submit_id: str, key: str, data: bytes):
+        self.rejected_dir.mkdir(parents=True, exist_ok=True)
+        (self.rejected_dir / f'{key}-{submit_id}.json').write_bytes(data)
+
+    async def _deliver(self, key: str, record: bytes):
+        submit_id, _, data = record.partition(b'\n')
+        submit_id = submit_id.decode()
+        start = time.monotonic()
+        retry = 0
+        while True:
+            status = await self._send(submit_id, data)
+            if status == 200:
+                await self.queue.ack(key)
+                self._delivered.inc()
+                self._delivery_time.observe(time.monotonic() - start)
+                self.logger.info("Results of '%s' delivered to baCa2", submit_id)
+                return
+            if status is not None and 400 <= status < 500 and status not in self.RETRY_STATUSES:
+                self._rejected.inc()
+                self.logger.error("Results of '%s' rejected by baCa2 with status code %s", submit_id, status)
+                if self.rejected_dir is not None:
+                    await self.executors.run_io(self._write_rejected, submit_id, key, data)
+                await self.queue.ack(key)
+                return
+            delay = self.backoff.delay(retry)
+            retry += 1
+            self._retries.inc()
+            self.logger.warning("Delivery of results of '%s' failed (status code %s), retrying in %.1fs",
+                                submit_id, status, delay)
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            await self.queue.wait()
+            item = await self.queue.get()
+            if item is None:
+                continue  # taken by another worker
+            key, record = item
+            try:
+                await self._deliver(key, record)
+            except asyncio.CancelledError:
+                self.queue.nack(key)  # delivered again after restart
+                raise
+            except Exception as e:
+                self.queue.nack(key)
+                self.logger.error("Error while delivering outbox record %s: %s", key, str(e), exc_info=True)
+                await asyncio.sleep(self.backoff.max_delay)
+
+    async def run(self):
+        """Delivers stored results until cancelled. Launch as a separate task."""
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,188 @@
+"""Planning of Kolejka tasks. Huge sets are split into shards and tiny sets are bundled together."""
+import json
+import math
+from pathlib import Path
+from typing import NamedTuple
+
+from baca2PackageManager import Package, TSet, TestF
+
+
+class PlannedTest(NamedTuple):
+    """Test of a planned task and its origin in the package."""
+    kolejka_name: str
+    set_name: str
+    test_name: str
+
+
+class PlannedTask:
+    """Unit of work sent to Kolejka as a single task."""
+
+    # Separator used in names of shards, bundles and bundled tests. Names have to stay
+    # valid in Kolejka callback urls, so only alphanumeric characters and '_' are used.
+    SEPARATOR = '__'
+
+    def __init__(self, name: str, set_names: list[str], tests: list[PlannedTest] | None = None):
+        self.name = name
+        self.set_names = set_names
+        # None means that the task consists of the whole set of the same name
+        self.tests = tests
+        self._by_kolejka_name = {t.kolejka_name: t for t in tests} if tests is not None else None
+
+    @property
+    def is_whole_set(self) -> bool:
+        return self.tests is None
+
+    def locate(self, kolejka_name: str) -> tuple[str, str]:
+        """Returns (set name, test name) of test with given name in this task."""
+        if self._by_kolejka_name is None:
+            return self.name, kolejka_name
+        test = self._by_kolejka_name[kolejka_name]
+        return test.set_name, test.test_name
+
+    def __repr__(self):
+        return f'PlannedTask({self.name!r}, sets={self.set_names})'
+
+
+class TaskPlan:
+    """Kolejka tasks of a package."""
+
+    # File of the plan in package build, it is written once the build is complete
+    FILE = 'plan.json'
+
+    def __init__(self, tasks: list[PlannedTask], set_names: list[str], planner: dict | None = None):
+        self.tasks = tasks
+        self.set_names = set_names
+        # settings of the planner that made the plan (None for identity plans)
+        self.planner = planner
+        self._tasks = {t.name: t for t in tasks}
+
+    def task(self, name: str) -> PlannedTask:
+        return self._tasks[name]
+
+    def tasks_of_set(self, set_name: str) -> list[PlannedTask]:
+        return [t for t in self.tasks if set_name in t.set_names]
+
+    @classmethod
+    def identity(cls, set_names: list[str]) -> 'TaskPlan':
+        """Plan with one Kolejka task per set."""
+        return cls([PlannedTask(name, [name]) for name in set_names], set_names)
+
+    def save(self, build_path: Path):
+        data = {
+            'planner': self.planner,
+            'set_names': self.set_names,
+            'tasks': [{'name': t.name, 'set_names': t.set_names,
+                       'tests': [list(test) for test in t.tests] if t.tests is not None else None}
+                      for t in self.tasks],
+        }
+        (build_path / self.FILE).write_text(json.dumps(data, indent=2))
+
+    @classmethod
+    def load(cls, build_path: Path) -> 'TaskPlan | None':
+        """Plan stored with package build, or None if there is none."""
+        try:
+            data = json.loads((build_path / cls.FILE).read_text())
+        except (OSError, ValueError):
+            return None
+        tasks = [PlannedTask(t['name'], t['set_names'],
+                             [PlannedTest(*test) for test in t['tests']] if t['tests'] is not None else None)
+                 for t in data['tasks']]
+        return cls(tasks, data['set_names'], data['planner'])
+
+
+class TaskPlanner:
+    """
+    Plans Kolejka tasks of a package using estimated cost (in seconds) of its sets. Sets
+    more expensive than shard_cost are split into shards, sets cheaper than bundle_cost
+    are bundled together (up to shard_cost per bundle). Packages can disable planning
+    with 'task_planning: false' in their config.
+    """
+
+    def __init__(self,
+                 shard_cost: float,
+                 bundle_cost: float,
+                 max_shards: int,
+                 test_overhead: float,
+                 cost_per_mb: float):
+        if bundle_cost > shard_cost:
+            raise ValueError("Bundle cost cannot be greater than shard cost")
+        self.shard_cost = shard_cost
+        self.bundle_cost = bundle_cost
+        self.max_shards = max_shards
+        self.test_overhead = test_overhead
+        self.cost_per_mb = cost_per_mb
+
+    @property
+    def settings(self) -> dict:
+        """Settings that plans depend on, stored with plans to tell if they are still valid."""
+        return {'shard_cost': self.shard_cost, 'bundle_cost': self.bundle_cost, 'max_shards': self.max_shards,
+                'test_overhead': self.test_overhead, 'cost_per_mb': self.cost_per_mb}
+
+    def stored_plan(self, build_path: Path) -> TaskPlan | None:
+        """Plan stored with package build, if it was made with the same settings."""
+        plan = TaskPlan.load(build_path)
+        if plan is None or plan.planner != self.settings:
+            return None
+        return plan
+
+    def test_cost(self, test: TestF) -> float:
+        """Estimated cost of a test: its time limit, fixed overhead and input size."""
+        cost = self.test_overhead + float(test.get('time_limit') or 0)
+        if test.get('input') is not None:
+            cost += test['input'].stat().st_size / 1024 ** 2 * self.cost_per_mb
+        return cost
+
+    def _shard(self, t_set: TSet, tests: list[TestF], costs: list[float]) -> list[PlannedTask]:
+        total = sum(costs)
+        shards_count = min(len(tests), self.max_shards, math.ceil(total / self.shard_cost))
+        # longest processing time first - every test goes to the currently cheapest shard
+        shards: list[list[TestF]] = [[] for _ in range(shards_count)]
+        shard_costs = [0.0] * shards_count
+        for cost, test in sorted(zip(costs, tests), key=lambda x: -x[0]):
+            i = shard_costs.index(min(shard_costs))
+            shards[i].append(test)
+            shard_costs[i] += cost
+        out = []
+        for i, shard in enumerate(shards):
+            name = f'{t_set["name"]}{PlannedTask.SEPARATOR}shard{i}'
+            planned = [PlannedTest(t['name'], t_set['name'], t['name'])
+                       for t in sorted(shard, key=lambda t: t['name'])]
+            out.append(PlannedTask(name, [t_set['name']], planned))
+        return out
+
+    def _bundle(self, bundle: list[tuple[TSet, list[TestF]]], index: int) -> PlannedTask:
+        if len(bundle) == 1:
+            return PlannedTask(bundle[0][0]['name'], [bundle[0][0]['name']])
+        name = f'bundle{PlannedTask.SEPARATOR}{index}'
+        planned = []
+        for t_set, tests in bundle:
+            for test in tests:
+                kolejka_name = f'{t_set["name"]}{PlannedTask.SEPARATOR}{test["name"]}'
+                planned.append(PlannedTest(kolejka_name, t_set['name'], test['name']))
+        return PlannedTask(name, [t_set['name'] for t_set, _ in bundle], planned)
+
+    def plan(self, package: Package) -> TaskPlan:
+        t_sets = sorted(package.sets(), key=lambda s: s['name'])
+        set_names = [t_set['name'] for t_set in t_sets]
+        if package.get('task_planning', True) is False:
+            return TaskPlan([PlannedTask(name, [name]) for name in set_names], set_names, self.settings)
+
+        tasks = []
+        bundles: list[list[tuple[TSet, list[TestF]]]] = []
+        bundle_cost = math.inf
+        for t_set in t_sets:
+            tests = t_set.tests()
+            costs = [self.test_cost(test) for test in tests]
+            cost = sum(costs)
+            if cost > self.shard_cost and len(tests) > 1 and self.max_shards > 1:
+                tasks.extend(self._shard(t_set, tests, costs))
+            elif cost < self.bundle_cost:
+                if bundle_cost + cost > self.shard_cost:
+                    bundles.append([])
+                    bundle_cost = 0.0
+                bundles[-1].append((t_set, tests))
+                bundle_cost += cost
+            else:
+                tasks.append(PlannedTask(t_set['name'], [t_set['name']]))
+        tasks.extend(self._bundle(bundle, i) for i, bundle in enumerate(bundles))
+        return TaskPlan(tasks, set_names, self.settings)
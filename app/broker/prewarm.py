@@ -0,0 +1,132 @@
+"""Building of new package commits before their first submits come."""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from .executors import Executors, default_executors
+from .master import BrokerMaster
+from .metrics import MetricsRegistry, registry
+from .work_units import load_package
+
+
+class PackagePrewarmer:
+    """
+    Watches packages directory (<package>/<commit>) and builds commits that are not built
+    yet, most recently modified first, at most concurrency builds at once. The first scan
+    validates builds of all existing commits, next scans look only at new (or modified)
+    commit directories.
+    """
+
+    CONFIG_FILES = ('config.yml', 'config.yaml')
+
+    def __init__(self,
+                 master: BrokerMaster,
+                 packages_dir: Path,
+                 concurrency: int,
+                 logger: logging.Logger,
+                 executors: Executors = default_executors,
+                 metrics: MetricsRegistry = registry):
+        self.master = master
+        self.packages_dir = packages_dir
+        self.concurrency = concurrency
+        self.logger = logger
+        self.executors = executors
+        # commit path -> modification time of commit directory when it was last queued
+        self._seen: dict[Path, float] = {}
+        self._queue: asyncio.PriorityQueue[tuple[float, str, str]] = asyncio.PriorityQueue()
+        self._building: set[Path] = set()
+        self._failed: dict[Path, str] = {}
+        self._last_scan: datetime | None = None
+        # metrics
+        self._queued = metrics.gauge('prewarm.queued')
+        self._built = metrics.counter('prewarm.built')
+        self._up_to_date = metrics.counter('prewarm.up_to_date')
+        self._failures = metrics.counter('prewarm.failed')
+
+    def _discover(self) -> list[tuple[float, Path, str]]:
+        """Returns (modification time, package path, commit) of all commits."""
+        commits = []
+        if not self.packages_dir.is_dir():
+            return commits
+        for package_path in self.packages_dir.iterdir():
+            if not package_path.is_dir() or package_path.name.startswith('.'):
+                continue
+            for commit_path in package_path.iterdir():
+                if commit_path.name.startswith('.') or not commit_path.is_dir():
+                    continue
+                if not any((commit_path / name).is_file() for name in self.CONFIG_FILES):
+                    continue
+                commits.append((commit_path.stat().st_mtime, package_path, commit_path.name))
+        return commits
+
+    async def scan(self) -> int:
+        """Queues commits that were not seen yet. Returns number of queued commits."""
+        commits = await self.executors.run_io(self._discover)
+        queued = 0
+        for mtime, package_path, commit in commits:
+            commit_path = package_path / commit
+            if self._seen.get(commit_path) == mtime:
+                continue
+            self._seen[commit_path] = mtime
+            self._failed.pop(commit_path, None)
+            # newest first
+            self._queue.put_nowait((-mtime, str(package_path), commit))
+            queued += 1
+        self._queued.set(self._queue.qsize())
+        self._last_scan = datetime.now()
+        if queued:
+            self.logger.info("Prewarming: %s package commits queued", queued)
+        return queued
+
+    async def _prewarm(self, package_path: Path, commit: str):
+        commit_path = package_path / commit
+        self._building.add(commit_path)
+        try:
+            package = await self.executors.run_cpu(load_package, package_path, commit)
+            if await self.master.process_package(package):
+                self._built.inc()
+            else:
+                self._up_to_date.inc()
+        except Exception as e:
+            self._failures.inc()
+            self._failed[commit_path] = str(e)
+            self.logger.error("Prewarming of package '%s' (commit %s) failed: %s",
+                              package_path, commit, str(e), exc_info=True)
+        finally:
+            self._building.discard(commit_path)
+
+    async def _worker(self):
+        while True:
+            _, package_path, commit = await self._queue.get()
+            self._queued.set(self._queue.qsize())
+            try:
+                await self._prewarm(Path(package_path), commit)
+            finally:
+                self._queue.task_done()
+
+    async def run(self, interval: timedelta):
+        """Launch this method as a separate task to start prewarming."""
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            while True:
+                await self.scan()
+                await asyncio.sleep(interval.total_seconds())
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def join(self):
+        """Waits until all queued commits are processed."""
+        await self._queue.join()
+
+    def status(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'building': sorted(str(p) for p in self._building),
+            'built': self._built.value,
+            'up_to_date': self._up_to_date.value,
+            'failed': {str(p): error for p, error in self._failed.items()},
+            'last_scan': self._last_scan.isoformat() if self._last_scan else None,
+        }
@@ -0,0 +1,81 @@
+"""Kolejka resource limits of tasks, derived from limits and sizes of their tests."""
+import math
+from typing import NamedTuple
+
+from baca2PackageManager import TestF
+from baca2PackageManager.tools import bytes_from_str
+
+MB = 1024 ** 2
+
+
+class ResourceProfile(NamedTuple):
+    """Resources reserved for a Kolejka task. Time is in seconds, sizes in bytes."""
+    time: float
+    memory: int
+    storage: int
+    workspace: int
+
+    def limits(self) -> dict[str, str]:
+        """Limits in the format of Kolejka task config."""
+        return {
+            'time': f'{math.ceil(self.time)}s',
+            'memory': f'{math.ceil(self.memory / MB)}M',
+            'storage': f'{math.ceil(self.storage / MB)}M',
+            'workspace': f'{math.ceil(self.workspace / MB)}M',
+        }
+
+
+class ResourceEstimator:
+    """
+    Estimates resources of a Kolejka task from its tests. Every test takes its time limit
+    times time_factor and test_overhead seconds (compilation, tools), memory covers the
+    largest memory limit times memory_factor (and compilation), storage and workspace
+    cover test files times storage_factor. Base values are added for the judge itself and
+    results are clamped to the given bounds. Tests run by the parallel judge share time
+    and memory of the task.
+    """
+
+    def __init__(self,
+                 time_factor: float = 2.0,
+                 test_overhead: float = 15.0,
+                 base_time: float = 60.0,
+                 memory_factor: float = 1.5,
+                 compile_memory: str = '1G',
+                 base_memory: str = '512M',
+                 storage_factor: float = 2.0,
+                 base_storage: str = '1G',
+                 min_time: float = 60.0,
+                 max_time: float = 3600.0,
+                 max_memory: str = '16G',
+                 max_storage: str = '20G'):
+        self.time_factor = time_factor
+        self.test_overhead = test_overhead
+        self.base_time = base_time
+        self.memory_factor = memory_factor
+        self.compile_memory = bytes_from_str(compile_memory)
+        self.base_memory = bytes_from_str(base_memory)
+        self.storage_factor = storage_factor
+        self.base_storage = bytes_from_str(base_storage)
+        self.min_time = min_time
+        self.max_time = max_time
+        self.max_memory = bytes_from_str(max_memory)
+        self.max_storage = bytes_from_str(max_storage)
+
+    @staticmethod
+    def files_size(test: TestF) -> int:
+        return sum(test[key].stat().st_size for key in ('input', 'output') if test.get(key) is not None)
+
+    def profile(self, tests: list[TestF], parallel: int = 1) -> ResourceProfile:
+        """Profile of a task with given tests, run by parallel tests at once."""
+        parallel = max(1, min(parallel, len(tests)))
+        time = sum(float(t.get('time_limit') or 0) * self.time_factor + self.test_overhead for t in tests)
+        time = self.base_time + time / parallel
+        test_memory = max((bytes_from_str(str(t['memory_limit'])) for t in tests if t.get('memory_limit')),
+                          default=0)
+        memory = self.base_memory + max(self.compile_memory, int(test_memory * self.memory_factor)) * parallel
+        storage = self.base_storage + int(sum(self.files_size(t) for t in tests) * self.storage_factor)
+        storage = min(storage, self.max_storage)
+        return ResourceProfile(time=min(max(time, self.min_time), self.max_time),
+                               memory=min(memory, self.max_memory),
+                               storage=storage,
+                               workspace=storage)
@@ -0,0 +1,134 @@
+"""Retrying of transient failures and deadlines of stages of communication with Kolejka."""
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, NamedTuple, TypeVar
+
+import aiohttp
+
+from .metrics import MetricsRegistry, registry
+
+T = TypeVar('T')
+
+
+class TransientError(Exception):
+    """Error that may not happen again if the operation is repeated."""
+    pass
+
+
+class DeadlineExceeded(TimeoutError):
+    """Attempt of a stage cancelled at its deadline."""
+    pass
+
+
+def is_transient(error: BaseException) -> bool:
+    """Tells transient errors (network, overloaded server) apart from permanent ones."""
+    return isinstance(error, (TransientError, ConnectionError, TimeoutError, aiohttp.ClientError))
+
+
+class RetryPolicy(NamedTuple):
+    """Retry policy of a single stage. Delays are in seconds."""
+    attempts: int
+    base_delay: float
+    max_delay: float
+
+    def delay(self, retry: int) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+class RetryBudget:
+    """
+    Token bucket shared by all stages. Every retry takes one token, so during an outage
+    retries stop quickly instead of multiplying the load on Kolejka.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # tokens per second
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.refill_rate)
+        self._last = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class Retrier:
+    """
+    Runs stages of Kolejka communication according to their retry policies. Every attempt
+    of a stage with a timeout is cancelled when it takes longer than that (which kills
+    Kolejka tools run by it) and fails with DeadlineExceeded, a transient error - except
+    for stages in no_retry_after_deadline, which are not repeated then.
+    """
+
+    def __init__(self,
+                 policies: dict[str, RetryPolicy],
+                 budget: RetryBudget | None,
+                 logger: logging.Logger,
+                 metrics: MetricsRegistry = registry,
+                 timeouts: dict[str, float] | None = None,
+                 no_retry_after_deadline: set[str] | None = None):
+        self.policies = policies
+        self.budget = budget
+        self.logger = logger
+        self.metrics = metrics
+        self.timeouts = timeouts or {}
+        self.no_retry_after_deadline = no_retry_after_deadline or set()
+        self._budget_exhausted = metrics.counter('retry.budget_exhausted')
+
+    async def _attempt(self, stage: str, description: str, func: Callable[..., Awaitable[T]], *args) -> T:
+        timeout = self.timeouts.get(stage)
+        if timeout is None:
+            return await func(*args)
+        deadline = asyncio.timeout(timeout)
+        try:
+            async with deadline:
+                return await func(*args)
+        except TimeoutError:
+            if not deadline.expired():
+                raise  # timeout of func itself
+            self.metrics.counter(f'timeouts.kolejka.{stage}').inc()
+            raise DeadlineExceeded(f"Stage '{stage}' of {description} exceeded its deadline of {timeout}s")
+
+    async def run(self,
+                  stage: str,
+                  description: str,
+                  func: Callable[..., Awaitable[T]],
+                  *args) -> T:
+        """
+        Awaits func(*args), repeating it after transient errors (expired deadlines included).
+        Stages without a policy are not retried. The last error is raised when attempts
+        or budget run out.
+        """
+        policy = self.policies.get(stage)
+        attempts = policy.attempts if policy is not None else 1
+        retry = 0
+        while True:
+            try:
+                return await self._attempt(stage, description, func, *args)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                if isinstance(e, DeadlineExceeded) and stage in self.no_retry_after_deadline:
+                    raise
+                if retry + 1 >= attempts:
+                    self.metrics.counter(f'retry.{stage}.exhausted').inc()
+                    raise
+                if self.budget is not None and not self.budget.try_acquire():
+                    self._budget_exhausted.inc()
+                    self.logger.warning("Retry budget exhausted, not retrying '%s' of %s",
+                                        stage, description)
+                    raise
+                delay = policy.delay(retry)
+                retry += 1
+                self.metrics.counter(f'retry.{stage}.retries').inc()
+                self.logger.warning("Stage '%s' of %s failed (%s), retry %s/%s in %.1fs",
+                                    stage, description, str(e), retry, attempts - 1, delay)
+                await asyncio.sleep(delay)
@@ -0,0 +1,261 @@
+"""Simulation of Kolejka for experiments with the broker without the real cluster."""
+import asyncio
+import itertools
+import logging
+import math
+import random
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+import aiohttp
+import yaml
+
+from .artifacts import ArtifactStore
+from .datamaster import SetSubmitInterface, TaskSubmitInterface
+from .executors import Executors, default_executors
+from .messenger import KolejkaMessengerInterface
+from .metrics import MetricsRegistry, registry
+from .retry import Retrier
+from .work_units import parse_results
+
+
+class SimulationProfile(NamedTuple):
+    """Behaviour of simulated Kolejka. Times are in (simulated) seconds."""
+    workers: int = 4
+    # mean delay between putting a task and it being waiting for a worker (exponential)
+    queue_delay: float = 2.0
+    # fixed cost of every task on a worker (preparing the environment, compilation)
+    task_overhead: float = 1.0
+    # test execution times are log-normal with median time_fraction * time limit
+    time_fraction: float = 0.2
+    time_sigma: float = 0.5
+    # probabilities
+    failure_rate: float = 0.0  # put of a task fails (transient failure)
+    lost_callback_rate: float = 0.0  # task finishes, but its callback is never sent
+    compile_error_rate: float = 0.0  # per task submit - all its sets fail to compile
+    wrong_answer_rate: float = 0.05  # per test
+    # simulated seconds are multiplied by time_scale (e.g. 0.01 makes simulation 100x faster)
+    time_scale: float = 1.0
+    seed: int | None = None
+
+
+class _SimulatedTask(NamedTuple):
+    set_submit_id: str
+    set_name: str
+    # (test name in results, time limit in seconds, memory limit in bytes)
+    tests: list[tuple[str, float, int]]
+    compile_error: bool
+    result_dir: Path
+    callback_url: str
+    put_time: float
+
+
+def _memory_bytes(limit) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    limit = str(limit or '64M').strip().upper()
+    if limit[-1] in units:
+        return int(float(limit[:-1]) * units[limit[-1]])
+    return int(limit)
+
+
+class KolejkaSimulator(KolejkaMessengerInterface):
+    """
+    Stand-in for KolejkaMessenger. Tasks wait in a queue for one of profile.workers
+    simulated workers, then their tests are "executed" for times drawn from the profile.
+    Results are written to results.yaml in the same format and place as results of real
+    Kolejka tasks, and callbacks are POSTed to the broker like real Kolejka does.
+    """
+
+    def __init__(self,
+                 submits_dir: Path,
+                 kolejka_callback_url_prefix: str,
+                 profile: SimulationProfile,
+                 logger: logging.Logger,
+                 retrier: Retrier | None = None,
+                 executors: Executors = default_executors,
+                 metrics: MetricsRegistry = registry):
+        self.submits_dir = submits_dir
+        self.kolejka_callback_url_prefix = kolejka_callback_url_prefix
+        self.profile = profile
+        self.logger = logger
+        self.retrier = retrier if retrier is not None else Retrier({}, None, logger)
+        self.executors = executors
+        self.random = random.Random(profile.seed)
+        self._queue: asyncio.Queue[_SimulatedTask] | None = None
+        self._workers: list[asyncio.Task] = []
+        self._background: set[asyncio.Task] = set()
+        self._task_ids = itertools.count(1)
+        # set submit id -> result dir of finished tasks
+        self._finished: dict[str, Path] = {}
+        # metrics
+        self._queued = metrics.gauge('simulator.queued')
+        self._running = metrics.gauge('simulator.running')
+        self._completed = metrics.counter('simulator.completed')
+        self._failures = metrics.counter('simulator.failures')
+        self._lost = metrics.counter('simulator.lost_callbacks')
+        self._queue_time = metrics.histogram('simulator.queue_seconds')
+
+    def kolejka_callback_url(self, submit_id: str) -> str:
+        mid = '' if self.kolejka_callback_url_prefix.endswith('/') else '/'
+        return self.kolejka_callback_url_prefix + mid + str(submit_id)
+
+    async def _sleep(self, seconds: float):
+        await asyncio.sleep(seconds * self.profile.time_scale)
+
+    def _compile_error(self, task_submit: TaskSubmitInterface) -> bool:
+        # the same for all sets of a submit
+        draw = random.Random(f'{self.profile.seed}-{task_submit.submit_id}').random()
+        return draw < self.profile.compile_error_rate
+
+    @staticmethod
+    def _tests(set_submit: SetSubmitInterface) -> list[tuple[str, float, int]]:
+        task_submit = set_submit.task_submit
+        t_sets = {t_set['name']: t_set for t_set in task_submit.package.sets()}
+        planned_task = task_submit.plan.task(set_submit.set_name)
+        if planned_task.is_whole_set:
+            located = [(t['name'], set_submit.set_name, t['name'])
+                       for t in t_sets[set_submit.set_name].tests()]
+        else:
+            located = planned_task.tests
+        out = []
+        for kolejka_name, set_name, test_name in located:
+            test = next(t for t in t_sets[set_name].tests() if t['name'] == test_name)
+            out.append((kolejka_name, float(test.get('time_limit') or 1.0), _memory_bytes(test.get('memory_limit'))))
+        return out
+
+    # sending ===========================================================================
+
+    def _start_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.profile.workers)]
+
+    async def _put_task(self, task: _SimulatedTask) -> str:
+        if self.random.random() < self.profile.failure_rate:
+            self._failures.inc()
+            raise self.KolejkaTransientError('Simulated failure of task put')
+        background = asyncio.create_task(self._enqueue(task))
+        self._background.add(background)
+        background.add_done_callback(self._background.discard)
+        return f'simulated-{next(self._task_ids)}'
+
+    async def send(self, set_submit: SetSubmitInterface):
+        self._start_workers()
+        task_submit = set_submit.task_submit
+        task = _SimulatedTask(
+            set_submit_id=set_submit.submit_id,
+            set_name=set_submit.set_name,
+            tests=self._tests(set_submit),
+            compile_error=self._compile_error(task_submit),
+            result_dir=self.submits_dir / task_submit.submit_id / f'{set_submit.set_name}.result',
+            callback_url=self.kolejka_callback_url(set_submit.submit_id),
+            put_time=time.monotonic(),
+        )
+        try:
+            result_code = await self.retrier.run('put', f"set submit '{set_submit.submit_id}'",
+                                                 self._put_task, task)
+        except self.KolejkaCommunicationError:
+            raise
+        except Exception as e:
+            raise self.KolejkaCommunicationError("Cannot communicate with KOLEJKA.") from e
+        set_submit.set_status_code(result_code)
+
+    async def _enqueue(self, task: _SimulatedTask):
+        await self._sleep(self.random.expovariate(1 / self.profile.queue_delay)
+                          if self.profile.queue_delay > 0 else 0)
+        self._queue.put_nowait(task)
+        self._queued.set(self._queue.qsize())
+
+    # execution =========================================================================
+
+    def _execute(self, task: _SimulatedTask) -> tuple[dict, float]:
+        """Returns content of results.yaml and simulated execution time of task."""
+        results = {}
+        duration = self.profile.task_overhead
+        for name, time_limit, memory_limit in task.tests:
+            if task.compile_error:
+                results[name] = {'satori': {'status': 'CME', 'compile_log': 'Simulated compilation error'}}
+                continue
+            real = self.random.lognormvariate(math.log(self.profile.time_fraction * time_limit),
+                                              self.profile.time_sigma)
+            if real > time_limit:
+                status, real = 'TLE', time_limit
+            elif self.random.random() < self.profile.wrong_answer_rate:
+                status = 'ANS'
+            else:
+                status = 'OK'
+            duration += real
+            results[name] = {'satori': {
+                'status': status,
+                'execute_time_real': f'{real:.3f}s',
+                'execute_time_cpu': f'{real * 0.95:.3f}s',
+                'execute_memory': f'{int(memory_limit * self.random.uniform(0.05, 0.5))}B',
+                'compile_log': '',
+                'checker_log': '',
+            }}
+        return results, duration
+
+    @staticmethod
+    def _write_results(result_dir: Path, results: dict):
+        (result_dir / 'results').mkdir(parents=True, exist_ok=True)
+        with open(result_dir / 'results' / 'results.yaml', 'w') as f:
+            yaml.safe_dump(results, f)
+
+    async def _callback(self, task: _SimulatedTask):
+        if self.random.random() < self.profile.lost_callback_rate:
+            self._lost.inc()
+            return
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url=task.callback_url, verify_ssl=False) as response:
+                    if response.status != 200:
+                        self.logger.warning("Simulated callback of '%s' rejected with status %s",
+                                            task.set_submit_id, response.status)
+        except aiohttp.ClientError as e:
+            self.logger.warning("Simulated callback of '%s' failed: %s", task.set_submit_id, str(e))
+
+    async def _worker(self):
+        while True:
+            task = await self._queue.get()
+            self._queued.set(self._queue.qsize())
+            self._queue_time.observe((time.monotonic() - task.put_time) / self.profile.time_scale)
+            self._running.inc()
+            try:
+                results, duration = self._execute(task)
+                await self._sleep(duration)
+                await self.executors.run_io(self._write_results, task.result_dir, results)
+                self._finished[task.set_submit_id] = task.result_dir
+                self._completed.inc()
+            except Exception as e:
+                self.logger.error("Simulation of '%s' failed: %s", task.set_submit_id, str(e), exc_info=True)
+                continue
+            finally:
+                self._running.dec()
+            await self._callback(task)
+
+    # results ===========================================================================
+
+    async def poll(self, set_submit: SetSubmitInterface) -> bool:
+        return set_submit.submit_id in self._finished
+
+    async def get_results(self, set_submit: SetSubmitInterface):
+        result_dir = self._finished.pop(set_submit.submit_id, None)
+        if result_dir is None:
+            raise self.KolejkaCommunicationError(f"Set submit '{set_submit.submit_id}' is not finished")
+        set_submit.set_result(await self.executors.run_cpu(parse_results, set_submit.set_name, result_dir))
+
+    async def close(self):
+        """Stops simulated workers (tasks that did not finish are lost)."""
+        for task in self._workers + list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._background, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+
+class SimulatorArtifactStore(ArtifactStore):
+    """Artifact store with placeholders of Kolejka tools, which are not run by KolejkaSimulator."""
+
+    async def _download(self, session: aiohttp.ClientSession, name: str) -> bytes:
+        return f'#!/usr/bin/env python3\n# {name} placeholder of KolejkaSimulator\n'.encode()
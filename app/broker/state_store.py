@@ -0,0 +1,108 @@
+"""Storage of broker state shared by many broker instances."""
+import fcntl
+import json
+import os
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+
+class StateStoreInterface(ABC):
+    """
+    Key-value store of JSON-serialisable records. All methods are blocking, they are
+    called from threads by the async code.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> dict | None:
+        """Returns record stored under key or None if there is none."""
+        pass
+
+    @abstractmethod
+    def put(self, key: str, record: dict):
+        """Stores record under key."""
+        pass
+
+    @abstractmethod
+    def update(self, key: str, func: Callable[[dict | None], dict | None]) -> dict | None:
+        """
+        Atomically replaces record under key with func(record). If func returns None, the
+        record is left unchanged. Returns the stored record.
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Deletes record stored under key (if there is one)."""
+        pass
+
+    @abstractmethod
+    def keys(self, prefix: str = '') -> list[str]:
+        """Keys of all records starting with prefix."""
+        pass
+
+
+class LocalStateStore(StateStoreInterface):
+    """
+    State store kept in a directory, one file per record. It can be shared by broker
+    instances running on one host (or on many hosts, if the directory is on a shared
+    file system with working flock). Updates are serialised with a lock file.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock_path = directory / '.lock'
+
+    def _path(self, key: str) -> Path:
+        if not key or '/' in key or key.startswith('.'):
+            raise ValueError(f"Invalid key '{key}'")
+        return self.directory / f'{key}.json'
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, key: str) -> dict | None:
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, record: dict):
+        path = self._path(key)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> dict | None:
+        return self._read(key)
+
+    def put(self, key: str, record: dict):
+        with self._locked():
+            self._write(key, record)
+
+    def update(self, key: str, func: Callable[[dict | None], dict | None]) -> dict | None:
+        with self._locked():
+            record = self._read(key)
+            new_record = func(record)
+            if new_record is None:
+                return record
+            self._write(key, new_record)
+            return new_record
+
+    def delete(self, key: str):
+        with self._locked():
+            self._path(key).unlink(missing_ok=True)
+
+    def keys(self, prefix: str = '') -> list[str]:
+        return sorted(p.stem for p in self.directory.glob(f'{prefix}*.json')
+                      if not p.name.startswith('.'))
@@ -0,0 +1,81 @@
+"""Delivery of results of finished sets to BaCa2 before the whole submit is checked."""
+import asyncio
+import logging
+from datetime import datetime
+
+from .datamaster import TaskSubmitInterface
+from .messenger import BacaMessengerInterface
+from .metrics import MetricsRegistry, registry
+
+
+class _Stream:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.sequence = 0
+        self.delivered: set[str] = set()
+        self.closed = False
+
+
+class ResultStreamer:
+    """
+    Sends results of package sets to BaCa2 as soon as all their set submits are done,
+    for packages with at least min_sets sets. Messages of a submit are sent one at a time
+    with consecutive sequence numbers, each with sets that were not delivered yet (sets
+    whose delivery failed are sent with the next message). The final message with all
+    results is sent by BrokerMaster after close, so it always comes last.
+    """
+
+    def __init__(self,
+                 baca_messenger: BacaMessengerInterface,
+                 min_sets: int,
+                 logger: logging.Logger,
+                 metrics: MetricsRegistry = registry):
+        self.baca_messenger = baca_messenger
+        self.min_sets = min_sets
+        self.logger = logger
+        # task submit id -> stream of its partial results
+        self._streams: dict[str, _Stream] = {}
+        # metrics
+        self._sent = metrics.counter('streaming.sent')
+        self._failed = metrics.counter('streaming.failed')
+        self._first_verdict = metrics.histogram('streaming.first_verdict_seconds')
+
+    def enabled_for(self, task_submit: TaskSubmitInterface) -> bool:
+        return len(task_submit.plan.set_names) >= self.min_sets
+
+    async def stream(self, task_submit: TaskSubmitInterface):
+        """Sends results of newly finished sets of task submit (never raises)."""
+        try:
+            if not self.enabled_for(task_submit):
+                return
+            stream = self._streams.setdefault(task_submit.submit_id, _Stream())
+            async with stream.lock:
+                # everything goes with the final message
+                if stream.closed or task_submit.state != task_submit.TaskState.AWAITING_SETS:
+                    return
+                if task_submit.all_checked():
+                    return
+                results = {name: result for name, result in task_submit.finished_results().items()
+                           if name not in stream.delivered}
+                if not results:
+                    return
+                await self.baca_messenger.send_partial(task_submit, results, stream.sequence + 1)
+                stream.sequence += 1
+                if not stream.delivered:
+                    self._first_verdict.observe((datetime.now() - task_submit.creation_date).total_seconds())
+                stream.delivered.update(results)
+                self._sent.inc()
+                self.logger.info("Partial results of task submit '%s' sent (%s): %s",
+                                 task_submit.submit_id, stream.sequence, sorted(results))
+        except Exception as e:
+            self._failed.inc()
+            self.logger.warning("Sending partial results of task submit '%s' failed: %s",
+                                task_submit.submit_id, str(e))
+
+    async def close(self, task_submit: TaskSubmitInterface):
+        """Ends streaming of task submit, waiting for a message that is being sent."""
+        stream = self._streams.pop(task_submit.submit_id, None)
+        if stream is None:
+            return
+        async with stream.lock:
+            stream.closed = True
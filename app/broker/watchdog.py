@@ -0,0 +1,121 @@
+"""Detection of code blocking the event loop."""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from .metrics import MetricsRegistry, registry
+
+
+class LoopBlockedError(AssertionError):
+    """Raised by LoopWatchdog.guard when the event loop was blocked."""
+    pass
+
+
+class LoopBlock:
+    """Event loop being blocked for at least duration seconds, with stack of the blocking code."""
+
+    def __init__(self, start: datetime, stack: str):
+        self.start = start
+        self.stack = stack
+        self.duration = 0.0
+
+    def __repr__(self):
+        return f'LoopBlock({self.start.isoformat()}, {self.duration:.3f}s)\n{self.stack}'
+
+
+class LoopWatchdog:
+    """
+    Measures lag of the event loop - how much later than planned a sleeping coroutine is
+    woken up. A separate thread watches heartbeats of that coroutine and, when there is
+    none for threshold seconds, takes a sample of the stack of the loop thread - the code
+    that blocks the loop. Recent blocks are kept for inspection.
+    """
+
+    def __init__(self,
+                 interval: timedelta,
+                 threshold: timedelta,
+                 logger: logging.Logger,
+                 max_blocks: int = 100,
+                 metrics: MetricsRegistry = registry):
+        if threshold <= interval:
+            raise ValueError("Threshold has to be greater than interval")
+        self.interval = interval.total_seconds()
+        self.threshold = threshold.total_seconds()
+        self.logger = logger
+        self.blocks: deque[LoopBlock] = deque(maxlen=max_blocks)
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: int | None = None
+        self._stopped = threading.Event()
+        # metrics
+        self._lag = metrics.histogram('loop.lag_seconds')
+        self._blocked = metrics.counter('loop.blocked')
+        self._blocked_time = metrics.histogram('loop.blocked_seconds')
+
+    def _sample_stack(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return ''
+        return ''.join(traceback.format_stack(frame))
+
+    def _watch(self):
+        """Body of the watching thread."""
+        block: LoopBlock | None = None
+        while not self._stopped.wait(self.threshold / 2):
+            silence = time.monotonic() - self._heartbeat
+            if silence >= self.threshold:
+                if block is None:
+                    block = LoopBlock(datetime.now(), self._sample_stack())
+                block.duration = silence
+            elif block is not None:
+                self._report(block)
+                block = None
+        if block is not None:
+            self._report(block)
+
+    def _report(self, block: LoopBlock):
+        self.blocks.append(block)
+        self._blocked.inc()
+        self._blocked_time.observe(block.duration)
+        self.logger.warning("Event loop blocked for at least %.3fs by:\n%s", block.duration, block.stack)
+
+    async def run(self):
+        """Launch this method as a separate task to start watching the event loop."""
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self._heartbeat = time.monotonic()
+                self._lag.observe(max(0.0, self._heartbeat - start - self.interval))
+        finally:
+            self._stopped.set()
+            await asyncio.to_thread(thread.join)
+
+    @asynccontextmanager
+    async def guard(self):
+        """
+        Watches the event loop while the block is executed and raises LoopBlockedError
+        if it was blocked. Meant for tests of code that must not block the loop.
+        """
+        blocks_before = len(self.blocks)
+        task = asyncio.create_task(self.run())
+        await asyncio.sleep(0)
+        try:
+            yield self
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        blocks = list(self.blocks)[blocks_before:]
+        if blocks:
+            raise LoopBlockedError(f"Event loop was blocked {len(blocks)} times:\n"
+                                   + '\n'.join(map(repr, blocks)))
@@ -0,0 +1,62 @@
+"""
+Picklable units of CPU-bound work. They are module level functions taking and returning
+picklable values, so they can be run in a process pool (see Executors.run_cpu).
+"""
+from pathlib import Path
+
+import yaml
+from baca2PackageManager import Package
+from baca2PackageManager.broker_communication import SetResult, TestResult
+
+from .builder import Builder
+from .planner import TaskPlan, TaskPlanner
+from .resources import ResourceEstimator
+from .yaml_tags import get_loader
+
+
+def load_package(package_path: Path, commit_id: str) -> Package:
+    """Parses package configuration."""
+    return Package(package_path, commit_id)
+
+
+def build_package(package: Package, planner: TaskPlanner | None = None, kolejka_src: Path | None = None,
+                  resources: ResourceEstimator | None = None, plan: TaskPlan | None = None):
+    """
+    Builds package for Kolejka (with Kolejka tasks of plan, or planned by planner if there
+    is no plan) linking to Kolejka tools in kolejka_src. Limits of tasks are estimated by
+    resources, if given. The plan is stored with the build.
+    """
+    if plan is None and planner is not None:
+        plan = planner.plan(package)
+    Builder(package, plan=plan, kolejka_src=kolejka_src, resources=resources).build()
+
+
+def parse_results(set_name: str, result_dir: Path) -> SetResult:
+    """Parses results.yaml of set downloaded from Kolejka."""
+    results_yaml = result_dir / 'results' / 'results.yaml'
+    with open(results_yaml) as f:
+        content: dict = yaml.load(f, Loader=get_loader())
+    tests = {}
+    for key, val in content.items():
+        satori = val['satori']
+
+        logs = {}
+        logs_names = ['compile_log', 'checker_log']
+        for log_name in logs_names:
+            logs[log_name] = satori.get(log_name, '')
+        # reported only by tests that compiled the solution
+        if satori.get('compile_time'):
+            logs['compile_time'] = str(satori['compile_time']).strip()
+
+        tmp = TestResult(
+            name=key,
+            status=satori.get('status'),
+            time_real=float(satori.get('execute_time_real', '-1.0 ')[:-1]),
+            time_cpu=float(satori.get('execute_time_cpu', '-1.0 ')[:-1]),
+            runtime_memory=int(satori.get('execute_memory', '-1 ')[:-1]),
+            answer=satori.get('answer', ''),
+            logs=logs,
+        )
+        tests[key] = tmp
+    return SetResult(name=set_name, tests=tests)
+
@@ -0,0 +1,202 @@
+"""
+Fork server (zygote) of a Python script - imports modules of the script once and forks
+a ready process for every run of it. Started by ForkServerRunner (see commands.py):
+
+    python3 zygote.py <socket path> <script> [<preloaded module prefix> ...]
+
+and prints 'ready' once it accepts runs. A run is requested by connecting to the socket
+and sending a JSON line {"args": [...]} together with file descriptors for stdout and
+stderr of the run. Exit code of the run is sent back as a line. Closing the connection
+before that kills the run.
+
+Only the standard library can be used here - the zygote runs with the interpreter of
+Kolejka tools, not with the one of the broker.
+"""
+import atexit
+import importlib
+import json
+import os
+import runpy
+import selectors
+import signal
+import socket
+import sys
+import traceback
+import zipfile
+
+
+def preload(script, prefixes):
+    """Imports modules of script (a zipapp or a plain file) with names starting with one of prefixes."""
+    def chosen(module):
+        return any(module == prefix or module.startswith(prefix + '.') for prefix in prefixes)
+
+    if zipfile.is_zipfile(script):
+        with zipfile.ZipFile(script) as archive:
+            names = archive.namelist()
+        modules = sorted({name[:-3].replace('/', '.').removesuffix('.__init__')
+                          for name in names if name.endswith('.py')})
+    else:
+        modules = list(prefixes)
+    for module in modules:
+        if module != '__main__' and chosen(module):
+            try:
+                importlib.import_module(module)
+            except BaseException:  # the run will import it on its own (or fail the same way)
+                pass
+
+
+class Zygote:
+
+    def __init__(self, socket_path, script):
+        self.script = script
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(socket_path)
+        self.listener.listen(64)
+        self.selector = selectors.DefaultSelector()
+        self.runs = {}  # pid -> connection
+        self.stopping = False
+        self.stop_requested = False
+
+    def serve(self):
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        self.wakeup = (wakeup_r, wakeup_w)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda *_: None)
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, 'stop_requested', True))
+        self.selector.register(self.listener, selectors.EVENT_READ, 'accept')
+        self.selector.register(wakeup_r, selectors.EVENT_READ, 'signal')
+        # end of stdin - the broker is gone
+        self.selector.register(sys.stdin, selectors.EVENT_READ, 'parent')
+
+        print('ready', flush=True)
+        while not (self.stopping and not self.runs):
+            for key, _ in self.selector.select():
+                if key.data == 'accept':
+                    self.accept()
+                elif key.data == 'signal':
+                    while True:
+                        try:
+                            if not os.read(wakeup_r, 512):
+                                break
+                        except BlockingIOError:
+                            break
+                    self.reap()
+                elif key.data == 'parent':
+                    if not sys.stdin.buffer.read1(512):
+                        self.selector.unregister(sys.stdin)
+                        self.stop_requested = True
+                elif key.data in self.runs:
+                    # the requester is gone - nobody waits for the run
+                    self.selector.unregister(key.fileobj)
+                    os.kill(key.data, signal.SIGKILL)
+            if self.stop_requested:
+                self.stop()
+
+    def stop(self):
+        """Stops taking new runs, runs already started are finished."""
+        if not self.stopping:
+            self.stopping = True
+            self.selector.unregister(self.listener)
+            self.listener.close()
+
+    def accept(self):
+        connection, _ = self.listener.accept()
+        connection.setblocking(True)
+        data, fds = b'', []
+        while not data.endswith(b'\n'):
+            chunk, new_fds, _, _ = socket.recv_fds(connection, 65536, 2)
+            fds += new_fds
+            if not chunk:
+                break
+            data += chunk
+        if len(fds) != 2 or not data.endswith(b'\n'):
+            for fd in fds:
+                os.close(fd)
+            connection.close()
+            return
+        args = json.loads(data)['args']
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.run(connection, args, *fds)
+        for fd in fds:
+            os.close(fd)
+        self.runs[pid] = connection
+        self.selector.register(connection, selectors.EVENT_READ, pid)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            connection = self.runs.pop(pid, None)
+            if connection is None:
+                continue
+            if connection.fileno() in self.selector.get_map():
+                self.selector.unregister(connection)
+            try:
+                connection.sendall(f'{os.waitstatus_to_exitcode(status)}\n'.encode())
+            except OSError:
+                pass
+            connection.close()
+
+    def run(self, connection, args, stdout_fd, stderr_fd):
+        """Body of a forked run, never returns."""
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGCHLD, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+            self.selector.close()
+            self.listener.close()
+            connection.close()
+            for other in self.runs.values():
+                other.close()
+            for fd in self.wakeup:
+                os.close(fd)
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(stdout_fd, 1)
+            os.dup2(stderr_fd, 2)
+            for fd in (devnull, stdout_fd, stderr_fd):
+                os.close(fd)
+
+            sys.argv = [self.script] + list(args)
+            runpy.run_path(self.script, run_name='__main__')
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code & 0xff)
+
+
+def main():
+    socket_path, script, *prefixes = sys.argv[1:]
+    # like for 'python3 script', not the directory of the zygote
+    if zipfile.is_zipfile(script):
+        sys.path[0] = script
+    else:
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+    sys.argv = [script]
+    preload(script, prefixes)
+    Zygote(socket_path, script).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,76 +1,301 @@
 """Background handlers for incoming messages from BaCa2 and Kolejka"""
 from abc import ABC, abstractmethod
 import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from pathlib import Path
 
+from baca2PackageManager import Package
 from baca2PackageManager.broker_communication import BacaToBroker
 
+from .broker.breaker import DispatchBuffer
+from .broker.datamaster import TaskSubmitInterface, SetSubmitInterface
 from .broker.messenger import KolejkaMessengerActiveWait
 from .broker.master import BrokerMaster
+from .broker.metrics import MetricsRegistry, registry
+from .broker.work_units import load_package
+from .jobs import JobQueue
+
+
+class CallbackWindow:
+    """
+    Remembers set submits whose Kolejka callbacks were already accepted, so duplicated
+    or retried callbacks can be dropped without touching the submit.
+    """
+
+    def __init__(self, ttl: timedelta = timedelta(minutes=30), max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._claimed: OrderedDict[str, datetime] = OrderedDict()
+
+    def _expire(self):
+        limit = datetime.now() - self.ttl
+        while self._claimed and (len(self._claimed) > self.max_size
+                                 or next(iter(self._claimed.values())) < limit):
+            self._claimed.popitem(last=False)
+
+    def claim(self, submit_id: str) -> bool:
+        """Marks callback of set submit as accepted. Returns False if it already was."""
+        self._expire()
+        if submit_id in self._claimed:
+            return False
+        self._claimed[submit_id] = datetime.now()
+        return True
+
+    def release(self, submit_id: str):
+        """Forgets callback of set submit, so it can be accepted again."""
+        self._claimed.pop(submit_id, None)
+
+    def __contains__(self, submit_id: str) -> bool:
+        self._expire()
+        return submit_id in self._claimed
 
 
 class Handler(ABC):
     """Abstract class for handling incoming messages from BaCa2 and Kolejka."""
 
+    master: BrokerMaster
+    logger: logging.Logger
+    buffer: DispatchBuffer | None = None
+    # submits of batches are processed as separate jobs of this queue
+    intake_queue: JobQueue | None = None
+
     @abstractmethod
     async def handle_baca(self, data: BacaToBroker):
         pass
 
+    @abstractmethod
+    async def _new_task_submit(self, data: BacaToBroker) -> TaskSubmitInterface | None:
+        """Creates task submit for incoming message. Returns None if it cannot be created."""
+        pass
+
+    @abstractmethod
+    async def _process_task_submit(self, task_submit: TaskSubmitInterface, package: Package | None = None,
+                                   attempts: int = 0):
+        """
+        Processes new task submit. If package is given, it has to be loaded and built already.
+        Attempts is how many times the submit was already held because of Kolejka outages.
+        """
+        pass
+
+    async def _hold(self, data: BacaToBroker) -> bool:
+        """Holds new submit in dispatch buffer if Kolejka is unavailable."""
+        return self.buffer is not None and await self.buffer.hold(DispatchBuffer.entry(data))
+
+    @staticmethod
+    def _dispatched(task_submit: TaskSubmitInterface) -> bool:
+        """Tells if any set of task submit has a task in Kolejka (which is going to call back)."""
+        if not task_submit.initialised:
+            return False
+        for set_submit in task_submit.set_submits:
+            try:
+                set_submit.get_status_code()
+            except ValueError:
+                continue
+            return True
+        return False
+
+    async def _fail(self, task_submit: TaskSubmitInterface, error: Exception, attempts: int = 0):
+        """
+        Trashes task submit, unless it is held to be tried again once Kolejka is available.
+        Submits with any set already sent to Kolejka are never held - callbacks of those
+        sets would come to set submits of the replayed submit.
+        """
+        if self.buffer is None or self._dispatched(task_submit):
+            await self.master.trash_task_submit(task_submit, error)
+            return
+        # trashed before it is held, so it can be created again when replayed
+        await self.master.trash_task_submit(task_submit, None)
+        if not await self.buffer.hold_failed(DispatchBuffer.entry(task_submit, attempts), error):
+            await self.master.baca_messenger.send_error(task_submit, error)
+
+    async def handle_buffered(self, entry: dict):
+        """Processes submit replayed from dispatch buffer."""
+        # password was checked when the submit was received
+        data = BacaToBroker.model_construct(pass_hash=None,
+                                            submit_id=entry['submit_id'],
+                                            package_path=entry['package_path'],
+                                            commit_id=entry['commit_id'],
+                                            submit_path=entry['submit_path'])
+        task_submit = await self._new_task_submit(data)
+        if task_submit is not None:
+            await self._process_task_submit(task_submit, attempts=entry['attempts'])
+
+    async def handle_baca_batch(self, data: list[BacaToBroker], priority: str | None = None, tenant: str = ''):
+        """
+        Handles many submits of the same package commit. Package is loaded and
+        checked (built if needed) only once for the whole batch. Submits are then
+        processed one by one as separate jobs of intake queue (with given priority class
+        and tenant), so a batch takes no more intake workers than single submits.
+        """
+        data = [d for d in data if not await self._hold(d)]
+        task_submits = [t for t in [await self._new_task_submit(d) for d in data] if t is not None]
+        if not task_submits:
+            return
+        package_path = task_submits[0].package_path
+        commit_id = task_submits[0].commit_id
+        if any(t.package_path != package_path or t.commit_id != commit_id for t in task_submits):
+            raise ValueError("All submits in batch have to use the same package commit")
+
+        try:
+            package = await self.data_master.executors.run_cpu(load_package, package_path, commit_id)
+            await self.master.process_package(package)
+        except Exception as e:
+            self.logger.error("Error while preparing package '%s' (commit %s) for batch of %s submits: %s",
+                              package_path, commit_id, len(task_submits), str(e), exc_info=True)
+            for task_submit in task_submits:
+                try:
+                    await self._fail(task_submit, e)
+                except Exception as fail_error:
+                    self.logger.error("Error while failing task submit '%s': %s",
+                                      task_submit.submit_id, str(fail_error), exc_info=True)
+            return
+
+        for task_submit in task_submits:
+            if self.intake_queue is None:
+                await self._process_task_submit(task_submit, package)
+                continue
+            try:
+                self.intake_queue.submit(self._process_task_submit, task_submit, package,
+                                         priority=priority, tenant=tenant)
+            except (JobQueue.QueueFullError, JobQueue.QueueClosedError) as e:
+                self.logger.warning("Task submit '%s' not queued (%s), processing inline",
+                                    task_submit.submit_id, str(e))
+                await self._process_task_submit(task_submit, package)
+
 
 class PassiveHandler(Handler):
     """Handler class for broker when ACTIVE_WAIT is disabled."""
 
-    def __init__(self, broker_master: BrokerMaster, log: logging.Logger):
+    # States in which set submit is not yet known to be sent to Kolejka
+    EARLY_STATES = (SetSubmitInterface.SetState.INITIAL, SetSubmitInterface.SetState.SENDING_TO_KOLEJKA)
+
+    def __init__(self, broker_master: BrokerMaster, log: logging.Logger,
+                 delivery_queue: JobQueue | None = None,
+                 callback_window: CallbackWindow | None = None,
+                 park_timeout: timedelta = timedelta(minutes=2),
+                 metrics: MetricsRegistry = registry,
+                 buffer: DispatchBuffer | None = None,
+                 intake_queue: JobQueue | None = None):
         self.master = broker_master
         self.data_master = self.master.data_master
         self.logger = log
+        self.buffer = buffer
+        self.intake_queue = intake_queue
+        self.delivery_queue = delivery_queue
+        self.callback_window = callback_window if callback_window is not None else CallbackWindow()
+        self.park_timeout = park_timeout
+        self._duplicates = metrics.counter('callbacks.duplicates')
+        self._parked = metrics.counter('callbacks.parked')
 
     async def handle_baca(self, data: BacaToBroker):
+        if await self._hold(data):
+            return
+        task_submit = await self._new_task_submit(data)
+        if task_submit is not None:
+            await self._process_task_submit(task_submit)
+
+    async def _new_task_submit(self, data: BacaToBroker) -> TaskSubmitInterface | None:
         try:
-            task_submit = self.data_master.new_task_submit(data.submit_id,
-                                                           Path(data.package_path),
-                                                           data.commit_id,
-                                                           Path(data.submit_path))
+            return await self.data_master.create_task_submit(data.submit_id,
+                                                                 Path(data.package_path),
+                                                                 data.commit_id,
+                                                                 Path(data.submit_path))
         except self.data_master.DataMasterError as e:
             self.logger.error("Task submit '%s' not created: (%s)", data.submit_id, str(e))
-            return
+            return None
 
+    async def _process_task_submit(self, task_submit: TaskSubmitInterface, package: Package | None = None,
+                                   attempts: int = 0):
         try:
-            await task_submit.initialise()
-            await self.master.process_package(task_submit.package)
+            await task_submit.initialise(package)
+            if package is None:
+                await self.master.process_package(task_submit.package, task_submit.plan)
             await self.master.process_new_task_submit(task_submit)
         except Exception as e:
-            self.logger.error("Error while processing task submit '%s': %s", data.submit_id, str(e), exc_info=True)
-            await self.master.trash_task_submit(task_submit, e)
+            self.logger.error("Error while processing task submit '%s': %s",
+                              task_submit.submit_id, str(e), exc_info=True)
+            await self._fail(task_submit, e, attempts)
             return
-        else:
-            self.logger.info("Task submit '%s' started successfully", data.submit_id)
+        self.logger.info("Task submit '%s' started successfully", task_submit.submit_id)
+        # all sets could have been taken from result cache
+        await self._deliver(task_submit)
 
     async def handle_kolejka(self, submit_id: str):
+        # claimed synchronously, so concurrent duplicates cannot both pass
+        if not self.callback_window.claim(submit_id):
+            self._duplicates.inc()
+            self.logger.info("Duplicated callback for set submit '%s' dropped", submit_id)
+            return
         try:
-            set_submit = self.data_master.get_set_submit(submit_id)
+            set_submit = await self.data_master.fetch_set_submit(submit_id,
+                                                                 timeout=self.park_timeout.total_seconds())
         except self.data_master.DataMasterError as e:
             self.logger.error("Set submit '%s' not found: %s", submit_id, str(e), exc_info=True)
+            # the callback may be retried once the set submit exists
+            self.callback_window.release(submit_id)
+            return
+
+        if set_submit.state in self.EARLY_STATES:
+            # callback came before sending was finished - park it until it is
+            self._parked.inc()
+            self.logger.info("Callback for set submit '%s' parked in state %s",
+                             submit_id, set_submit.state.name)
+            try:
+                await set_submit.wait_for_state(
+                    [s for s in set_submit.SetState if s not in self.EARLY_STATES],
+                    timeout=self.park_timeout.total_seconds())
+            except TimeoutError:
+                self.logger.error("Parked callback for set submit '%s' timed out in state %s",
+                                  submit_id, set_submit.state.name)
+                self.callback_window.release(submit_id)
+                return
+        if set_submit.state != set_submit.SetState.AWAITING_KOLEJKA:
+            self._duplicates.inc()
+            self.logger.info("Callback for set submit '%s' in state %s dropped",
+                             submit_id, set_submit.state.name)
             return
+
         try:
-            await self.master.process_finished_set_submit(set_submit)
+            processed = await self.master.process_finished_set_submit(set_submit)
         except Exception as e:
             self.logger.error("Error while processing set submit '%s': %s", submit_id, str(e), exc_info=True)
             await self.master.trash_task_submit(set_submit.task_submit, e)
             return
+        if processed:
+            await self._deliver(set_submit.task_submit)
+
+    async def _deliver(self, task_submit: TaskSubmitInterface):
+        """Runs delivery of task submit in delivery queue (or inline, if there is no queue)."""
+        if self.delivery_queue is None:
+            await self.handle_delivery(task_submit)
+            return
         try:
-            await self.master.if_all_checked_process_finished_task_submit(set_submit.task_submit)
+            self.delivery_queue.submit(self.handle_delivery, task_submit)
+        except (JobQueue.QueueFullError, JobQueue.QueueClosedError) as e:
+            self.logger.warning("Delivery of task submit '%s' not queued (%s), delivering inline",
+                                task_submit.submit_id, str(e))
+            await self.handle_delivery(task_submit)
+
+    async def handle_delivery(self, task_submit: TaskSubmitInterface):
+        try:
+            await self.master.if_all_checked_process_finished_task_submit(task_submit)
         except Exception as e:
-            self.logger.error("Error while finishing task submit '%s': %s", submit_id, str(e), exc_info=True)
-            await self.master.trash_task_submit(set_submit.task_submit, e)
+            self.logger.error("Error while finishing task submit '%s': %s",
+                              task_submit.submit_id, str(e), exc_info=True)
+            await self.master.trash_task_submit(task_submit, e)
             return
 
 
 class ActiveHandler(Handler):
     """Handler class for broker when ACTIVE_WAIT is enabled."""
 
-    def __init__(self, broker_master: BrokerMaster, kolejka_messenger: KolejkaMessengerActiveWait, log: logging.Logger):
+    def __init__(self, broker_master: BrokerMaster, kolejka_messenger: KolejkaMessengerActiveWait, log: logging.Logger,
+                 buffer: DispatchBuffer | None = None,
+                 intake_queue: JobQueue | None = None):
         self.master = broker_master
+        self.buffer = buffer
+        self.intake_queue = intake_queue
         self.kolejka_messenger = kolejka_messenger
         # assert isinstance(self.kolejka_messenger, KolejkaMessengerActiveWait)
         assert self.master.kolejka_messenger is self.kolejka_messenger
@@ -78,28 +303,40 @@ class ActiveHandler(Handler):
         self.logger = log
 
     async def handle_baca(self, data: BacaToBroker):
+        if await self._hold(data):
+            return
+        task_submit = await self._new_task_submit(data)
+        if task_submit is not None:
+            await self._process_task_submit(task_submit)
+
+    async def _new_task_submit(self, data: BacaToBroker) -> TaskSubmitInterface | None:
         try:
-            task_submit = self.data_master.new_task_submit(data.submit_id,
-                                                           Path(data.package_path).resolve(),
-                                                           data.commit_id,
-                                                           Path(data.submit_path).resolve())
+            return await self.data_master.create_task_submit(data.submit_id,
+                                                                 Path(data.package_path).resolve(),
+                                                                 data.commit_id,
+                                                                 Path(data.submit_path).resolve())
         except self.data_master.DataMasterError as e:
             self.logger.error("Task submit '%s' not created: (%s)", data.submit_id, str(e))
-            return
+            return None
 
+    async def _process_task_submit(self, task_submit: TaskSubmitInterface, package: Package | None = None,
+                                   attempts: int = 0):
         try:
-            await task_submit.initialise()
-            await self.master.process_package(task_submit.package)
+            await task_submit.initialise(package)
+            if package is None:
+                await self.master.process_package(task_submit.package, task_submit.plan)
             await self.master.process_new_task_submit(task_submit)
             for s in task_submit.set_submits:
+                if s.state == s.SetState.DONE:  # result taken from cache
+                    continue
                 await self.master.process_finished_set_submit(s)
             self.logger.info("All sets checked for task submit '%s', now sending to BaCa2",
-                             data.submit_id)
+                             task_submit.submit_id)
             await self.master.process_finished_task_submit(task_submit)
         except Exception as e:
             self.logger.error("Error while processing task submit '%s': %s",
-                              data.submit_id, str(e), exc_info=True)
-            await self.master.trash_task_submit(task_submit, e)
+                              task_submit.submit_id, str(e), exc_info=True)
+            await self._fail(task_submit, e, attempts)
             return
         else:
-            self.logger.info("Task submit '%s' processed successfully", data.submit_id)
+            self.logger.info("Task submit '%s' processed successfully", task_submit.submit_id)
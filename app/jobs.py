@@ -0,0 +1,245 @@
+"""Background job queues for work accepted by the HTTP views."""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from .broker.master import DispatchLimit
+from .broker.metrics import MetricsRegistry, registry
+
+
+class FairQueue(asyncio.Queue):
+    """
+    Queue of jobs of several priority classes. Classes are served in strict priority
+    order, within a class jobs of different tenants are served by weighted fair queueing,
+    so one tenant submitting a lot of jobs does not delay jobs of the others.
+    Items are (priority class, tenant, cost, job) tuples, get returns (priority class, job).
+    """
+
+    def __init__(self, priorities: list[str], tenant_weights: dict[str, float] | None = None,
+                 maxsize: int = 0):
+        self.priorities = priorities
+        self.tenant_weights = tenant_weights or {}
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue: list[tuple[int, float, int, str, Any]] = []
+        self._counter = itertools.count()
+        # virtual time of every class - finish tag of the job served most recently
+        self._virtual_time = {priority: 0.0 for priority in self.priorities}
+        # finish tag of the last queued job of every (class, tenant)
+        self._finish_tags: dict[tuple[str, str], float] = {}
+        self._class_sizes = {priority: 0 for priority in self.priorities}
+
+    def _qsize(self):
+        return len(self._queue)
+
+    def _put(self, item):
+        priority, tenant, cost, job = item
+        start = max(self._virtual_time[priority], self._finish_tags.get((priority, tenant), 0.0))
+        tag = start + cost / self.tenant_weights.get(tenant, 1.0)
+        self._finish_tags[(priority, tenant)] = tag
+        rank = self.priorities.index(priority)
+        heapq.heappush(self._queue, (rank, tag, next(self._counter), priority, job))
+        self._class_sizes[priority] += 1
+
+    def _get(self):
+        _, tag, _, priority, job = heapq.heappop(self._queue)
+        self._virtual_time[priority] = tag
+        self._class_sizes[priority] -= 1
+        if self._class_sizes[priority] == 0:
+            # class is idle, tenants start over (keeps finish tags from growing forever)
+            self._finish_tags = {k: v for k, v in self._finish_tags.items() if k[0] != priority}
+            self._virtual_time[priority] = 0.0
+        return priority, job
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs processed by a fixed number of worker coroutines. If priority
+    classes are given, jobs are taken from the queue in fair order (see FairQueue).
+    With dispatch limit, a job is taken only when there is room for one more submit.
+    """
+
+    class QueueFullError(Exception):
+        """Raised when a job is submitted to a full queue."""
+        pass
+
+    class QueueClosedError(Exception):
+        """Raised when a job is submitted to a queue that is shutting down."""
+        pass
+
+    def __init__(self,
+                 name: str,
+                 workers: int,
+                 max_size: int,
+                 logger: logging.Logger,
+                 metrics: MetricsRegistry = registry,
+                 priorities: list[str] | None = None,
+                 tenant_weights: dict[str, float] | None = None,
+                 dispatch_limit: DispatchLimit | None = None):
+        if workers < 1:
+            raise ValueError("Job queue needs at least one worker")
+        self.name = name
+        self.workers = workers
+        self.max_size = max_size
+        self.logger = logger
+        self.priorities = priorities
+        if priorities:
+            self._queue: asyncio.Queue = FairQueue(priorities, tenant_weights, maxsize=max_size)
+        else:
+            self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self.dispatch_limit = dispatch_limit
+        # one worker at a time holds a reservation while waiting for a job
+        self._get_lock = asyncio.Lock()
+        self._worker_tasks: set[asyncio.Task] = set()
+        self._closed = False
+        # metrics
+        self._length = metrics.gauge(f'jobs.{name}.queue_length')
+        self._in_flight = metrics.gauge(f'jobs.{name}.in_flight')
+        self._wait_time = metrics.histogram(f'jobs.{name}.wait_seconds')
+        self._run_time = metrics.histogram(f'jobs.{name}.run_seconds')
+        self._processed = metrics.counter(f'jobs.{name}.processed')
+        self._failed = metrics.counter(f'jobs.{name}.failed')
+        self._rejected = metrics.counter(f'jobs.{name}.rejected')
+        self._class_wait_time = {p: metrics.histogram(f'jobs.{name}.{p}.wait_seconds')
+                                 for p in priorities or []}
+
+    @property
+    def size(self) -> int:
+        """Number of jobs waiting for a worker."""
+        return self._queue.qsize()
+
+    @property
+    def free_slots(self) -> int | None:
+        """Number of jobs that can be submitted before the queue is full (None if unbounded)."""
+        if self.max_size <= 0:
+            return None
+        return self.max_size - self._queue.qsize()
+
+    @property
+    def running(self) -> bool:
+        return bool(self._worker_tasks)
+
+    def start(self):
+        """Starts worker coroutines. Has to be called from within a running event loop."""
+        if self.running:
+            raise RuntimeError(f"Job queue '{self.name}' already started")
+        self._closed = False
+        for _ in range(self.workers):
+            self._worker_tasks.add(asyncio.create_task(self._worker()))
+
+    def submit(self,
+               func: Callable[..., Awaitable[Any]],
+               *args,
+               priority: str | None = None,
+               tenant: str = '',
+               cost: float = 1.0):
+        """
+        Puts a job to the queue. Raises QueueFullError if the queue is full. Priority class,
+        tenant and cost of the job are used only by queues with priority classes.
+        """
+        if self._closed:
+            raise self.QueueClosedError(f"Job queue '{self.name}' is closed")
+        job = (time.monotonic(), func, args)
+        if self.priorities:
+            if priority is None:
+                priority = self.priorities[-1]
+            if priority not in self.priorities:
+                raise ValueError(f"Unknown priority class '{priority}'")
+            job = (priority, tenant, cost, job)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._rejected.inc()
+            raise self.QueueFullError(f"Job queue '{self.name}' is full ({self.max_size} jobs)")
+        self._length.set(self._queue.qsize())
+
+    async def _get(self):
+        if self.dispatch_limit is None:
+            return await self._queue.get()
+        async with self._get_lock:
+            await self.dispatch_limit.reserve()
+            try:
+                return await self._queue.get()
+            except BaseException:
+                self.dispatch_limit.release()
+                raise
+
+    async def _worker(self):
+        while True:
+            job = await self._get()
+            priority = None
+            if self.priorities:
+                priority, job = job
+            enqueued, func, args = job
+            self._length.set(self._queue.qsize())
+            started = time.monotonic()
+            self._wait_time.observe(started - enqueued)
+            if priority is not None:
+                self._class_wait_time[priority].observe(started - enqueued)
+            self._in_flight.inc()
+            try:
+                await func(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._failed.inc()
+                self.logger.error("Job in queue '%s' failed: %s", self.name, str(e), exc_info=True)
+            finally:
+                self._in_flight.dec()
+                self._run_time.observe(time.monotonic() - started)
+                self._processed.inc()
+                self._queue.task_done()
+                if self.dispatch_limit is not None:
+                    self.dispatch_limit.release()
+
+    async def stop(self, timeout: float | None = None):
+        """
+        Stops accepting new jobs, waits until queued and in-flight jobs are finished
+        (at most timeout seconds) and stops the workers.
+        """
+        self._closed = True
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning("Job queue '%s' not drained in %ss, %s jobs dropped",
+                                self.name, timeout, self._queue.qsize())
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks.clear()
+
+
+class JobQueues:
+    """Job queues of the broker, one per job kind."""
+
+    KINDS = ('intake', 'callback', 'delivery')
+
+    def __init__(self,
+                 workers: dict[str, int],
+                 max_sizes: dict[str, int],
+                 logger: logging.Logger,
+                 metrics: MetricsRegistry = registry,
+                 priorities: list[str] | None = None,
+                 tenant_weights: dict[str, float] | None = None,
+                 dispatch_limit: DispatchLimit | None = None):
+        self.queues = {kind: JobQueue(kind, workers[kind], max_sizes[kind], logger, metrics)
+                       for kind in self.KINDS if kind != 'intake'}
+        # submits are dispatched to Kolejka by intake jobs, so only intake is prioritised
+        self.queues['intake'] = JobQueue('intake', workers['intake'], max_sizes['intake'], logger,
+                                         metrics, priorities, tenant_weights, dispatch_limit)
+
+    def __getitem__(self, kind: str) -> JobQueue:
+        return self.queues[kind]
+
+    def start(self):
+        for queue in self.queues.values():
+            queue.start()
+
+    async def stop(self, timeout: float | None = None):
+        """Drains queues in pipeline order, so jobs created while draining are not lost."""
+        for kind in self.KINDS:
+            await self.queues[kind].stop(timeout)
@@ -1,16 +1,37 @@
 import asyncio
+import json
 from contextlib import asynccontextmanager
+from pathlib import Path
 
 import pydantic
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from baca2PackageManager.broker_communication import BacaToBroker, make_hash
 import settings
 
-from .broker.master import BrokerMaster
-from .broker.datamaster import DataMaster, SetSubmit, TaskSubmit
+from .broker.artifacts import ArtifactStore
+from .broker.breaker import BreakingKolejkaMessenger, CircuitBreaker, DispatchBuffer
+from .broker.cache import ResultCache
+from .broker.commands import ForkServerRunner, SubprocessRunner
+from .broker.master import BrokerMaster, DispatchLimit
+from .broker.planner import TaskPlanner
+from .broker.resources import ResourceEstimator
+from .broker.prewarm import PackagePrewarmer
+from .broker.retry import Retrier, RetryPolicy, RetryBudget
+from .broker.simulator import KolejkaSimulator, SimulationProfile, SimulatorArtifactStore
+from .broker.state_store import LocalStateStore
+from .broker.streaming import ResultStreamer
+from .broker.events import EventBus
+from .broker.executors import Executors
+from .broker.durable_queue import DurableQueue
+from .broker.datamaster import DataMaster, SharedDataMaster, SetSubmit, TaskSubmit
+from .broker.outbox import ResultOutbox
 from .broker.messenger import KolejkaMessenger, BacaMessenger, PackageManager, \
     KolejkaMessengerActiveWait
-from .handlers import PassiveHandler, ActiveHandler
+from .broker.metrics import registry
+from .broker.watchdog import LoopWatchdog
+from .handlers import PassiveHandler, ActiveHandler, CallbackWindow
+from .jobs import JobQueue, JobQueues
 from .logger import LoggerManager
 
 # APP ===================================================================================
@@ -21,68 +42,298 @@ logger_manager.set_formatter(settings.LOGGER_PROMPT)
 logger_manager.start()
 logger = logger_manager.logger
 
-data_master = DataMaster(
-    task_submit_t=TaskSubmit,
-    set_submit_t=SetSubmit,
-    logger=logger
-)
+if settings.TASK_PLANNING_ENABLED:
+    planner = TaskPlanner(
+        shard_cost=settings.TASK_PLANNING_SHARD_COST,
+        bundle_cost=settings.TASK_PLANNING_BUNDLE_COST,
+        max_shards=settings.TASK_PLANNING_MAX_SHARDS,
+        test_overhead=settings.TASK_PLANNING_TEST_OVERHEAD,
+        cost_per_mb=settings.TASK_PLANNING_COST_PER_MB,
+    )
+else:
+    planner = None
 
-if settings.ACTIVE_WAIT:
-    tmp_t = KolejkaMessengerActiveWait
+if settings.KOLEJKA_RESOURCE_PROFILES_ENABLED:
+    resources = ResourceEstimator(**settings.KOLEJKA_RESOURCE_PROFILE)
 else:
-    tmp_t = KolejkaMessenger
+    resources = None
 
-kolejka_messanger = tmp_t(
-    submits_dir=settings.SUBMITS_DIR,
-    build_namespace=settings.BUILD_NAMESPACE,
-    kolejka_conf=settings.KOLEJKA_CONF,
-    kolejka_callback_url_prefix=settings.KOLEJKA_CALLBACK_URL_PREFIX,
-    logger=logger
+executors = Executors(
+    io_workers=settings.EXECUTOR_IO_WORKERS,
+    cpu_workers=settings.EXECUTOR_CPU_WORKERS
+)
+
+events = EventBus(
+    buffer_size=settings.EVENTS_BUFFER_SIZE,
+    max_subscribers=settings.EVENTS_MAX_SUBSCRIBERS
 )
 
+if settings.SHARED_STATE_DIR is not None:
+    data_master = SharedDataMaster(
+        task_submit_t=TaskSubmit,
+        set_submit_t=SetSubmit,
+        logger=logger,
+        store=LocalStateStore(settings.SHARED_STATE_DIR),
+        instance_id=settings.INSTANCE_ID,
+        planner=planner,
+        executors=executors,
+        events=events,
+        build_namespace=settings.BUILD_NAMESPACE
+    )
+else:
+    data_master = DataMaster(
+        task_submit_t=TaskSubmit,
+        set_submit_t=SetSubmit,
+        logger=logger,
+        planner=planner,
+        executors=executors,
+        events=events,
+        build_namespace=settings.BUILD_NAMESPACE
+    )
+
+kolejka_retrier = Retrier(
+    policies={stage: RetryPolicy(attempts=attempts,
+                                 base_delay=settings.KOLEJKA_RETRY_BASE_DELAY,
+                                 max_delay=settings.KOLEJKA_RETRY_MAX_DELAY)
+              for stage, attempts in settings.KOLEJKA_RETRY_ATTEMPTS.items()},
+    budget=RetryBudget(capacity=settings.KOLEJKA_RETRY_BUDGET,
+                       refill_rate=settings.KOLEJKA_RETRY_BUDGET_REFILL),
+    logger=logger,
+    timeouts=settings.KOLEJKA_STAGE_TIMEOUTS,
+    no_retry_after_deadline=settings.KOLEJKA_NO_RETRY_AFTER_DEADLINE
+)
+
+if settings.FORKSERVER_ENABLED:
+    command_runner = ForkServerRunner(
+        logger=logger,
+        preload=settings.FORKSERVER_PRELOAD,
+        max_servers=settings.FORKSERVER_MAX_SERVERS
+    )
+else:
+    command_runner = SubprocessRunner()
+
+if settings.KOLEJKA_SIMULATOR:
+    if settings.ACTIVE_WAIT:
+        raise ValueError("Kolejka simulator requires ACTIVE_WAIT to be disabled")
+    kolejka_messanger = KolejkaSimulator(
+        submits_dir=settings.SUBMITS_DIR,
+        kolejka_callback_url_prefix=settings.KOLEJKA_SIMULATOR_CALLBACK_URL_PREFIX,
+        profile=SimulationProfile(**settings.KOLEJKA_SIMULATOR_PROFILE),
+        logger=logger,
+        retrier=kolejka_retrier,
+        executors=executors
+    )
+else:
+    if settings.ACTIVE_WAIT:
+        tmp_t = KolejkaMessengerActiveWait
+    else:
+        tmp_t = KolejkaMessenger
+
+    kolejka_messanger = tmp_t(
+        submits_dir=settings.SUBMITS_DIR,
+        build_namespace=settings.BUILD_NAMESPACE,
+        kolejka_conf=settings.KOLEJKA_CONF,
+        kolejka_callback_url_prefix=settings.KOLEJKA_CALLBACK_URL_PREFIX,
+        logger=logger,
+        retrier=kolejka_retrier,
+        executors=executors,
+        runner=command_runner
+    )
+
+if settings.KOLEJKA_BREAKER_ENABLED:
+    kolejka_breaker = CircuitBreaker(
+        name='kolejka',
+        failure_threshold=settings.KOLEJKA_BREAKER_FAILURE_THRESHOLD,
+        recovery_timeout=settings.KOLEJKA_BREAKER_RECOVERY_TIMEOUT.total_seconds(),
+        max_recovery_timeout=settings.KOLEJKA_BREAKER_MAX_RECOVERY_TIMEOUT.total_seconds(),
+        logger=logger
+    )
+    dispatch_buffer = DispatchBuffer(
+        breaker=kolejka_breaker,
+        queue=DurableQueue(settings.DISPATCH_BUFFER_DIR,
+                           max_items=settings.DISPATCH_BUFFER_MAX_SIZE,
+                           name='dispatch_buffer',
+                           rescan_interval=settings.DURABLE_QUEUE_RESCAN_INTERVAL,
+                           executors=executors),
+        replay_rate=settings.DISPATCH_BUFFER_REPLAY_RATE,
+        logger=logger,
+        max_attempts=settings.DISPATCH_BUFFER_MAX_ATTEMPTS
+    )
+else:
+    kolejka_breaker = None
+    dispatch_buffer = None
+
 baca_messanger = BacaMessenger(
     baca_success_url=settings.BACA_RESULTS_URL,
     baca_failure_url=settings.BACA_ERROR_URL,
     password=settings.BACA_PASSWORD,
-    logger=logger
+    logger=logger,
+    executors=executors,
+    baca_partial_url=settings.BACA_PARTIAL_RESULTS_URL if settings.STREAM_PARTIAL_RESULTS else None,
+    offload_tests=settings.BACA_OFFLOAD_TESTS,
+    timeouts=settings.BACA_TIMEOUTS
+)
+
+artifacts = (SimulatorArtifactStore if settings.KOLEJKA_SIMULATOR else ArtifactStore)(
+    root_dir=settings.KOLEJKA_SRC_DIR,
+    sources=settings.KOLEJKA_ARTIFACTS,
+    logger=logger,
+    checksums=settings.KOLEJKA_ARTIFACT_CHECKSUMS,
+    gc_min_age=settings.KOLEJKA_ARTIFACTS_GC_MIN_AGE.total_seconds(),
+    executors=executors
 )
 
 package_manager = PackageManager(
-    kolejka_src_dir=settings.KOLEJKA_SRC_DIR,
+    artifacts=artifacts,
     build_namespace=settings.BUILD_NAMESPACE,
     force_rebuild=settings.FORCE_REBUILD_PACKAGE,
+    planner=planner,
+    resources=resources,
+    executors=executors
 )
 
+if settings.RESULT_CACHE_ENABLED:
+    result_cache = ResultCache(
+        cache_dir=settings.RESULT_CACHE_DIR,
+        max_size=settings.RESULT_CACHE_MAX_SIZE,
+        build_namespace=settings.BUILD_NAMESPACE,
+        logger=logger,
+        executors=executors
+    )
+else:
+    result_cache = None
+
+if settings.STREAM_PARTIAL_RESULTS:
+    streamer = ResultStreamer(
+        baca_messenger=baca_messanger,
+        min_sets=settings.STREAM_PARTIAL_MIN_SETS,
+        logger=logger
+    )
+else:
+    streamer = None
+
+if settings.OUTBOX_ENABLED:
+    outbox = ResultOutbox(
+        baca_messenger=baca_messanger,
+        queue=DurableQueue(settings.OUTBOX_DIR / 'pending',
+                           max_items=settings.OUTBOX_MAX_SIZE,
+                           max_bytes=settings.OUTBOX_MAX_BYTES,
+                           name='outbox',
+                           rescan_interval=settings.DURABLE_QUEUE_RESCAN_INTERVAL,
+                           executors=executors),
+        logger=logger,
+        workers=settings.OUTBOX_WORKERS,
+        initial_concurrency=settings.OUTBOX_INITIAL_CONCURRENCY,
+        backoff=RetryPolicy(0, settings.OUTBOX_RETRY_BASE_DELAY, settings.OUTBOX_RETRY_MAX_DELAY),
+        rejected_dir=settings.OUTBOX_DIR / 'rejected',
+        executors=executors
+    )
+else:
+    outbox = None
+
+if settings.INTAKE_MAX_OUTSTANDING is not None:
+    dispatch_limit = DispatchLimit(settings.INTAKE_MAX_OUTSTANDING)
+else:
+    dispatch_limit = None
+
 master = BrokerMaster(
     data_master=data_master,
-    kolejka_messenger=kolejka_messanger,
+    kolejka_messenger=(kolejka_messanger if kolejka_breaker is None
+                       else BreakingKolejkaMessenger(kolejka_messanger, kolejka_breaker)),
     baca_messenger=baca_messanger,
     package_manager=package_manager,
-    logger=logger
+    logger=logger,
+    result_cache=result_cache,
+    streamer=streamer,
+    outbox=outbox,
+    dispatch_limit=dispatch_limit
+)
+
+if settings.PREWARM_ENABLED and not settings.FORCE_REBUILD_PACKAGE:
+    prewarmer = PackagePrewarmer(
+        master=master,
+        packages_dir=settings.PACKAGES_DIR,
+        concurrency=settings.PREWARM_CONCURRENCY,
+        logger=logger,
+        executors=executors
+    )
+else:
+    prewarmer = None
+
+job_queues = JobQueues(
+    workers=settings.JOB_QUEUE_WORKERS,
+    max_sizes=settings.JOB_QUEUE_DEPTH,
+    logger=logger,
+    priorities=settings.PRIORITY_CLASSES,
+    tenant_weights=settings.TENANT_WEIGHTS,
+    dispatch_limit=dispatch_limit
 )
 
 if settings.ACTIVE_WAIT:
-    handlers = ActiveHandler(master, master.kolejka_messenger, logger)
+    handlers = ActiveHandler(master, master.kolejka_messenger, logger, buffer=dispatch_buffer,
+                             intake_queue=job_queues['intake'])
+else:
+    handlers = PassiveHandler(master, logger,
+                              delivery_queue=job_queues['delivery'],
+                              callback_window=CallbackWindow(ttl=settings.CALLBACK_DEDUP_WINDOW,
+                                                             max_size=settings.CALLBACK_DEDUP_MAX_SIZE),
+                              park_timeout=settings.CALLBACK_PARK_TIMEOUT,
+                              buffer=dispatch_buffer,
+                              intake_queue=job_queues['intake'])
+
+if settings.LOOP_WATCHDOG_ENABLED:
+    watchdog = LoopWatchdog(
+        interval=settings.LOOP_WATCHDOG_INTERVAL,
+        threshold=settings.LOOP_WATCHDOG_THRESHOLD,
+        logger=logger
+    )
 else:
-    handlers = PassiveHandler(master, logger)
+    watchdog = None
 
 daemons = set()
 
 
 @asynccontextmanager
 async def lifespan(app_: FastAPI):
+    # start job queues
+    job_queues.start()
+
     # start daemons
     task = asyncio.create_task(
         master.start_daemons(task_submit_timeout=settings.TASK_SUBMIT_TIMEOUT,
-                             interval=settings.DELETION_DAEMON_INTERVAL))
+                             interval=settings.DELETION_DAEMON_INTERVAL,
+                             polling_interval=None if settings.ACTIVE_WAIT else settings.POLLING_INTERVAL,
+                             polling_min_age=settings.POLLING_MIN_AGE,
+                             polling_batch_size=settings.POLLING_BATCH_SIZE,
+                             polling_max_backoff=settings.POLLING_MAX_BACKOFF))
     daemons.add(task)
+    if watchdog is not None:
+        daemons.add(asyncio.create_task(watchdog.run()))
+    daemons.add(asyncio.create_task(artifacts.daemon(settings.KOLEJKA_ARTIFACTS_REFRESH_INTERVAL)))
+    if prewarmer is not None:
+        daemons.add(asyncio.create_task(prewarmer.run(settings.PREWARM_INTERVAL)))
+    if dispatch_buffer is not None:
+        daemons.add(asyncio.create_task(dispatch_buffer.run(handlers.handle_buffered)))
+    if outbox is not None:
+        daemons.add(asyncio.create_task(outbox.run()))
 
     yield
 
+    # drain job queues
+    await job_queues.stop(settings.JOB_QUEUE_DRAIN_TIMEOUT)
+
     # stop daemons
     for task in daemons:
         task.cancel()
     await asyncio.gather(*daemons, return_exceptions=True)
+    # write remaining changes of shared state
+    await data_master.flush()
+    if settings.KOLEJKA_SIMULATOR:
+        await kolejka_messanger.close()
+    await command_runner.close()
+
+    # stop executors
+    executors.shutdown()
 
     # stop logger
     logger_manager.stop()
@@ -98,16 +349,91 @@ async def root():
     return {"message": "Broker is running"}
 
 
+@app.get("/metrics")
+async def metrics():
+    return registry.snapshot()
+
+
+@app.get("/packages/prewarm")
+async def prewarm_status():
+    """Status of the package build queue of prewarming."""
+    if prewarmer is None:
+        raise HTTPException(status_code=404, detail="Package prewarming is disabled")
+    return prewarmer.status()
+
+
+def events_authorised(submit_ids: list[str] | None, pass_hashes: list[str] | None) -> bool:
+    """
+    Checks password of /events - either one hash of 'events' (access to all submits),
+    or a hash of every submit id, in the same order.
+    """
+    if not pass_hashes:
+        return False
+    if pass_hashes == [make_hash(settings.BROKER_PASSWORD, 'events')]:
+        return True
+    if not submit_ids or len(submit_ids) != len(pass_hashes):
+        return False
+    return all(make_hash(settings.BROKER_PASSWORD, s) == h for s, h in zip(submit_ids, pass_hashes))
+
+
+@app.get("/events")
+async def events_stream(submit_id: list[str] | None = Query(None),
+                        pass_hash: list[str] | None = Query(None)):
+    """
+    Server-sent events stream of state changes of given task submits (of all submits if
+    none is given). Too slow consumers are disconnected with a 'dropped' event.
+    Requires pass_hash (see events_authorised).
+    """
+    if not events_authorised(submit_id, pass_hash):
+        raise HTTPException(status_code=401, detail="Wrong Password")
+    try:
+        subscription = events.subscribe(set(submit_id) if submit_id else None)
+    except EventBus.TooManySubscribers as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    event = await subscription.get(settings.EVENTS_KEEPALIVE.total_seconds())
+                except TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                if event is None:
+                    yield 'event: dropped\ndata: {}\n\n'
+                    return
+                yield f'id: {event["id"]}\nevent: state\ndata: {json.dumps(event)}\n\n'
+        finally:
+            events.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'cache-control': 'no-cache'})
+
+
 class Content(pydantic.BaseModel):
     pass_hash: str
     submit_id: str
     package_path: str
     commit_id: str
     submit_path: str
+    priority: str | None = None
+
+
+def check_priority(priority: str | None, default: str) -> str:
+    if priority is None:
+        return default
+    if priority not in settings.PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority class '{priority}'")
+    return priority
+
+
+def tenant_of(package_path: str) -> str:
+    """Tenant of a submit - jobs of one package are scheduled together."""
+    return Path(package_path).name
 
 
 @app.post("/baca")
-async def baca_post(content: Content, background_tasks: BackgroundTasks):
+async def baca_post(content: Content):
     """Handle submit request from baCa2"""
     btb = BacaToBroker(pass_hash=content.pass_hash,
                        submit_id=content.submit_id,
@@ -117,14 +443,68 @@ async def baca_post(content: Content, background_tasks: BackgroundTasks):
 
     if make_hash(settings.BROKER_PASSWORD, btb.submit_id) != btb.pass_hash:
         raise HTTPException(status_code=401, detail="Wrong Password")
+    priority = check_priority(content.priority, settings.DEFAULT_PRIORITY)
 
-    background_tasks.add_task(handlers.handle_baca, btb)
+    try:
+        job_queues['intake'].submit(handlers.handle_baca, btb,
+                                    priority=priority, tenant=tenant_of(btb.package_path))
+    except (JobQueue.QueueFullError, JobQueue.QueueClosedError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
     return {"message": "Success", "status_code": 200}
 
 
+@app.post("/baca/batch")
+async def baca_batch_post(contents: list[Content]):
+    """
+    Handle many submit requests from BaCa2 at once (e.g. rejudges). Submits are
+    deduplicated by submit_id and grouped by package commit, so every package
+    is loaded and checked only once per batch.
+    """
+    unique: dict[str, BacaToBroker] = {}
+    priorities: dict[str, str] = {}
+    wrong_password = []
+    for content in contents:
+        if make_hash(settings.BROKER_PASSWORD, content.submit_id) != content.pass_hash:
+            wrong_password.append(content.submit_id)
+            continue
+        if content.submit_id not in unique:
+            priorities[content.submit_id] = check_priority(content.priority, settings.BATCH_PRIORITY)
+            unique[content.submit_id] = BacaToBroker(pass_hash=content.pass_hash,
+                                                     submit_id=content.submit_id,
+                                                     package_path=content.package_path,
+                                                     commit_id=content.commit_id,
+                                                     submit_path=content.submit_path)
+    if wrong_password:
+        raise HTTPException(status_code=401,
+                            detail=f"Wrong Password for {len(wrong_password)} submits")
+
+    groups: dict[tuple[str, str, str], list[BacaToBroker]] = {}
+    for btb in unique.values():
+        key = (btb.package_path, btb.commit_id, priorities[btb.submit_id])
+        groups.setdefault(key, []).append(btb)
+
+    intake = job_queues['intake']
+    free_slots = intake.free_slots
+    if free_slots is not None and free_slots < len(groups):
+        raise HTTPException(status_code=503, detail=f"Job queue '{intake.name}' is full")
+    try:
+        for (package_path, _, priority), group in groups.items():
+            # submits of the group are queued as separate jobs once the package is ready
+            intake.submit(handlers.handle_baca_batch, group, priority, tenant_of(package_path),
+                          priority=priority, tenant=tenant_of(package_path))
+    except (JobQueue.QueueFullError, JobQueue.QueueClosedError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return {"message": "Success",
+            "status_code": 200,
+            "accepted": len(unique),
+            "duplicates": len(contents) - len(unique),
+            "groups": len(groups)}
+
+
 @app.post("/kolejka/{submit_id}")
-async def kolejka_post(submit_id: str, background_tasks: BackgroundTasks):
+async def kolejka_post(submit_id: str):
     """Handle notifications from kolejka"""
     if settings.ACTIVE_WAIT:
         raise HTTPException(status_code=404, detail="Not Active - broker in 'active wait' mode")
@@ -134,6 +514,9 @@ async def kolejka_post(submit_id: str, background_tasks: BackgroundTasks):
     if not submit_normalized.isalnum():
         raise HTTPException(status_code=400)
 
-    background_tasks.add_task(handlers.handle_kolejka, submit_id)
+    try:
+        job_queues['callback'].submit(handlers.handle_kolejka, submit_id)
+    except (JobQueue.QueueFullError, JobQueue.QueueClosedError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
     return {"message": "Success", "status_code": 200}
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# vim:ts=4:sts=4:sw=4:expandtab
+import os, sys
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kolejka-judge'))
+    from kolejka.judge import main
+    main(__file__)
+import hashlib
+import shutil
+from pathlib import Path
+from kolejka.judge.commands import *
+from kolejka.judge.parse import *
+from kolejka.judge.tasks import *
+
+# Judge that compiles the solution only once per Kolejka task. The first test builds the
+# solution as judge_main does and stores the build directory in BUILD_CACHE_DIR, next tests
+# of the task restore it instead of compiling the same source again.
+
+BUILD_DIRECTORY = 'solution/build'
+BUILD_CACHE_DIR = Path('/tmp/baca2-build-cache')
+
+
+class StoreBuildTask(TaskBase):
+    """Stores solution build directory for next tests of the task. Runs only if the build and its rules passed."""
+    DEFAULT_RESULT_ON_ERROR = 'INT'
+
+    def __init__(self, cache_path, source=BUILD_DIRECTORY, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_path = Path(cache_path)
+        self.source = source
+
+    def execute(self):
+        source = Path(self.resolve_path(self.source))
+        if source.is_dir() and not self.cache_path.exists():
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            partial = self.cache_path.with_name(self.cache_path.name + '.{}'.format(os.getpid()))
+            shutil.copytree(source, partial, symlinks=True)
+            os.rename(partial, self.cache_path)
+        return None, None
+
+
+class RestoreBuildTask(TaskBase):
+    """Restores solution build directory stored by the first test of the task."""
+    DEFAULT_RESULT_ON_ERROR = 'INT'
+
+    def __init__(self, cache_path, target=BUILD_DIRECTORY, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_path = Path(cache_path)
+        self.target = target
+
+    def execute(self):
+        target = Path(self.resolve_path(self.target))
+        if target.exists():
+            shutil.rmtree(target)
+        shutil.copytree(self.cache_path, target, symlinks=True)
+        return None, None
+
+
+def build_key(args, build_options):
+    hash_obj = hashlib.sha256()
+    with open(args.solution, 'rb') as solution:
+        hash_obj.update(solution.read())
+    hash_obj.update(repr(build_options).encode('utf-8'))
+    return hash_obj.hexdigest()
+
+
+def judge(args):
+    tool_time = parse_time('60s')
+    prepare_time = parse_time('5s')
+    source_size_limit = parse_memory(args.test.get('source_size', '100K'))
+    binary_size_limit = parse_memory(args.test.get('binary_size', '10M'))
+    compile_time = parse_time(args.test.get('compile_time', '10s'))
+    compile_memory = parse_memory(args.test.get('compile_memory', '1G'))
+    c_standard = args.test.get('c_standard', 'c11')
+    cpp_standard = args.test.get('cpp_standard', 'c++17')
+    gcc_arguments = [ arg.strip() for arg in args.test.get('gcc_arguments', '').split() if arg.strip() ]
+    gcc_arguments.append('-Wall')
+    time_limit = parse_time(args.test.get('time', '10s'))
+    memory_limit = parse_memory(args.test.get('memory', '1G'))
+    output_size_limit = parse_memory(args.test.get('output_size', '64M'))
+    error_size_limit  = parse_memory(args.test.get('error_size', '1M'))
+    basename = args.test.get('basename', None)
+    regex_count = args.test.get('regex_count', None)
+    environment = args.test.get('environment', None)
+    # everything the build and its rules depend on - a cached build passed the same rules
+    build_options = (basename, environment, c_standard, cpp_standard, gcc_arguments, regex_count,
+                     source_size_limit, binary_size_limit, compile_time, compile_memory)
+    cache_path = BUILD_CACHE_DIR / build_key(args, build_options)
+    cached = cache_path.is_dir()
+    if cached:
+        args.add_steps(
+            system=SystemPrepareTask(default_logs=False),
+            source=SolutionPrepareTask(source=args.solution, basename=basename, allow_extract=True, override=environment, limit_real_time=prepare_time),
+            restore=RestoreBuildTask(cache_path),
+        )
+    else:
+        args.add_steps(
+            system=SystemPrepareTask(default_logs=False),
+            source=SolutionPrepareTask(source=args.solution, basename=basename, allow_extract=True, override=environment, limit_real_time=prepare_time),
+            source_rules=SolutionSourceRulesTask(max_size=source_size_limit, regex_count=regex_count),
+            builder=SolutionBuildAutoTask([
+                [SolutionBuildCMakeTask, [], {}],
+                [SolutionBuildMakeTask, [], {}],
+                [SolutionBuildGXXTask, [], {'standard': cpp_standard, 'build_arguments': gcc_arguments}],
+                [SolutionBuildGCCTask, [], {'standard': c_standard, 'build_arguments': gcc_arguments, 'libraries': ['m']}],
+                [SolutionBuildPython3ScriptTask, [], {}],
+            ], limit_real_time=compile_time, limit_memory=compile_memory),
+            build_rules=SolutionBuildRulesTask(max_size=binary_size_limit),
+            # steps stop at the first failure, so only builds that passed the rules are stored
+            store=StoreBuildTask(cache_path),
+        )
+    args.add_steps(io=SingleIOTask(
+        input_path=args.test.get('input', None),
+        tool_override=args.test.get('tools', None),
+        tool_time=tool_time,
+        tool_c_standard=c_standard,
+        tool_cpp_standard=cpp_standard,
+        tool_gcc_arguments=gcc_arguments,
+        generator_source=args.test.get('generator', None),
+        verifier_source=args.test.get('verifier', None),
+        hint_path=args.test.get('hint', None),
+        hinter_source=args.test.get('hinter', None),
+        checker_source=args.test.get('checker', None),
+        limit_cores=1,
+        limit_time=time_limit,
+        limit_memory=memory_limit,
+        limit_output_size=output_size_limit,
+        limit_error_size=error_size_limit,
+        )
+    )
+    if parse_bool(args.test.get('debug', 'no')):
+        args.add_steps(debug=CollectDebugTask())
+    args.add_steps(logs=CollectLogsTask())
+    result = args.run()
+    print('Result {} on test {}.'.format(result.status, args.id))
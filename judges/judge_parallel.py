@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# vim:ts=4:sts=4:sw=4:expandtab
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+# Judge that runs tests of a Kolejka task in parallel. 'execute' of the task is split into
+# workers, one per core allotted to the task (one logical core per physical core, so tests
+# do not share SMT siblings), each pinned to its core. Workers go through all tests in the
+# same order and claim them atomically, a test is judged (as judge_main does) only by the
+# worker that claimed it. Results of workers are merged into one results.yaml with the
+# usual satori layout. Sets (or their single tests) may limit the number of workers with
+# 'parallel' key, and there are never more workers than tests or than test memory limits
+# fit in the task.
+
+WORKER_ENV = 'BACA2_PARALLEL_WORKER'
+CLAIMS_ENV = 'BACA2_PARALLEL_CLAIMS'
+RESERVED_MEMORY = 512 * 1024 ** 2  # for the judge itself and tools (checker, hinter)
+RESULTS_YAML = 'results.yaml'
+INCLUDE_KEY = '!include'
+
+
+def read_first(*paths):
+    for path in paths:
+        try:
+            return Path(path).read_text().strip()
+        except OSError:
+            pass
+    return None
+
+
+def allotted_cores():
+    """Cores the task may use, without SMT siblings, limited by CPU quota of the task."""
+    cores = {}
+    for cpu in sorted(os.sched_getaffinity(0)):
+        siblings = read_first(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list') or str(cpu)
+        cores.setdefault(siblings, cpu)
+    cores = sorted(cores.values())
+    quota = read_first('/sys/fs/cgroup/cpu.max')
+    if quota and not quota.startswith('max'):
+        limit, period = quota.split()
+        cores = cores[:max(1, -(-int(limit) // int(period)))]
+    return cores
+
+
+def memory_limit():
+    limit = read_first('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    return int(limit) if limit and limit.isdigit() else None
+
+
+def load_yaml(path):
+    import yaml
+    class Loader(yaml.SafeLoader):
+        pass
+    Loader.add_constructor('!include', lambda loader, node: INCLUDE_KEY)
+    Loader.add_multi_constructor('!', lambda loader, suffix, node: None)
+    with open(path) as yaml_file:
+        return yaml.load(yaml_file, Loader=Loader)
+
+
+def resolve_includes(entry, base):
+    """Settings of entry over settings of the file it includes (test.yaml of its set)."""
+    if not isinstance(entry, dict) or INCLUDE_KEY not in entry:
+        return entry
+    include_path = base / entry[INCLUDE_KEY]
+    included = resolve_includes(load_yaml(include_path), include_path.parent)
+    own = {k: v for k, v in entry.items() if k != INCLUDE_KEY}
+    return {**included, **own} if isinstance(included, dict) else own
+
+
+def load_tests(tests_path):
+    tests_path = Path(tests_path)
+    tests = load_yaml(tests_path)
+    tests = {str(k): resolve_includes(v, tests_path.parent) for k, v in (tests or {}).items()}
+    return {k: v if isinstance(v, dict) else {} for k, v in tests.items()}
+
+
+def worker_count(tests, cores):
+    from kolejka.judge.parse import parse_memory
+    workers = min(len(cores), len(tests))
+    for test in tests.values():
+        if test.get('parallel') is not None:
+            workers = min(workers, int(test['parallel']))
+    limit = memory_limit()
+    if limit is not None:
+        test_memory = max(parse_memory(str(t.get('memory', '1G'))) for t in tests.values())
+        workers = min(workers, max(1, (limit - RESERVED_MEMORY) // test_memory))
+    return workers
+
+
+def claim(test_id):
+    """Claims test for this worker. Returns False if another worker claimed it."""
+    claims = os.environ.get(CLAIMS_ENV)
+    if claims is None:
+        return True
+    try:
+        fd = os.open(os.path.join(claims, quote(str(test_id), safe='')), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(fd, os.environ[WORKER_ENV].encode())
+    os.close(fd)
+    return True
+
+
+def rewrite_paths(value, old, new):
+    if isinstance(value, str):
+        return value.replace(old, new)
+    if isinstance(value, dict):
+        return {k: rewrite_paths(v, old, new) for k, v in value.items()}
+    if isinstance(value, list):
+        return [rewrite_paths(v, old, new) for v in value]
+    return value
+
+
+def merge_zip(source, target):
+    with zipfile.ZipFile(target, 'a') as target_zip, zipfile.ZipFile(source) as source_zip:
+        present = set(target_zip.namelist())
+        for info in source_zip.infolist():
+            if info.filename not in present:
+                target_zip.writestr(info, source_zip.read(info))
+
+
+def merge(test_ids, workers, output, cwd, owners):
+    """
+    Merges outputs of workers into output and files workers created in their directories
+    into cwd. Tests without result of the worker that claimed them fail with INT.
+    """
+    import yaml
+    output.mkdir(parents=True, exist_ok=True)
+    results = []
+    for worker_cwd, worker_output in workers:
+        try:
+            with open(worker_output / RESULTS_YAML) as results_file:
+                results.append(yaml.safe_load(results_file) or {})
+        except OSError:
+            results.append({})
+    merged = {}
+    for test_id in test_ids:
+        owner = owners.get(test_id)
+        owner_results = {str(k): v for k, v in results[owner].items()} if owner is not None else {}
+        if test_id in owner_results:
+            merged[test_id] = rewrite_paths(owner_results[test_id], str(workers[owner][1]), str(output))
+        else:
+            merged[test_id] = {'satori': {'status': 'INT'}}
+    with open(output / RESULTS_YAML, 'w') as results_file:
+        yaml.safe_dump(merged, results_file, sort_keys=False)
+
+    for index, (worker_cwd, worker_output) in enumerate(workers):
+        if worker_output.is_dir():
+            for entry in worker_output.iterdir():
+                target = output / entry.name
+                owner = owners.get(unquote(entry.name))
+                if entry.name == RESULTS_YAML or not (owner == index or (owner is None and not target.exists())):
+                    continue
+                if target.is_dir():
+                    shutil.rmtree(target)
+                elif target.exists():
+                    target.unlink()
+                shutil.move(str(entry), str(target))
+        for entry in worker_cwd.iterdir():
+            target = cwd / entry.name
+            if entry.is_symlink() or entry == worker_output:
+                continue
+            if entry.suffix == '.zip' and target.exists():
+                merge_zip(entry, target)
+            elif not target.exists():
+                shutil.move(str(entry), str(target))
+
+
+def run_parallel(judge_path, argv):
+    """
+    Runs 'execute' of the task in parallel workers. Returns exit code, or None if tests
+    should be run one after another (other command, a single worker or unknown arguments).
+    """
+    if 'execute' not in argv or len(argv) < 4 or argv[-1].startswith('-'):
+        return None
+    tests_path, output = Path(argv[-3]), Path(argv[-1])
+    try:
+        tests = load_tests(tests_path)
+        cores = allotted_cores()
+        count = worker_count(tests, cores) if tests else 0
+    except Exception as e:
+        print('Parallel execution not possible ({}), running tests one after another.'.format(e))
+        return None
+    if count <= 1:
+        return None
+    cwd = Path.cwd()
+    output = output if output.is_absolute() else cwd / output
+    shared = Path(tempfile.mkdtemp(prefix='baca2-parallel-'))
+    claims = shared / 'claims'
+    claims.mkdir()
+    workers, processes = [], []
+    for index, core in enumerate(cores[:count]):
+        worker_cwd = shared / 'worker{}'.format(index)
+        worker_cwd.mkdir()
+        # inputs of the task are shared, outputs of workers are kept apart
+        for entry in cwd.iterdir():
+            if entry != output and entry.resolve() != output.resolve():
+                os.symlink(entry, worker_cwd / entry.name)
+        worker_output = worker_cwd / output.name
+        workers.append((worker_cwd, worker_output))
+        env = dict(os.environ, **{WORKER_ENV: str(index), CLAIMS_ENV: str(claims)})
+        processes.append(subprocess.Popen(
+            [sys.executable, judge_path, *argv[:-1], str(worker_output)],
+            cwd=worker_cwd, env=env, preexec_fn=lambda core=core: os.sched_setaffinity(0, {core}),
+        ))
+    codes = [process.wait() for process in processes]
+    owners = {unquote(path.name): int(path.read_text() or 0) for path in claims.iterdir()}
+    merge(list(tests), workers, output, cwd, owners)
+    shutil.rmtree(shared, ignore_errors=True)
+    print('Tests run by {} workers on cores {}.'.format(count, cores[:count]))
+    return max(codes)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kolejka-judge'))
+    if WORKER_ENV not in os.environ:
+        exit_code = run_parallel(os.path.abspath(__file__), sys.argv[1:])
+        if exit_code is not None:
+            sys.exit(exit_code)
+    from kolejka.judge import main
+    main(__file__)
+from kolejka.judge.commands import *
+from kolejka.judge.parse import *
+from kolejka.judge.tasks import *
+
+
+def judge(args):
+    if not claim(args.id):
+        # judged by another worker, this result is replaced by the one of that worker
+        args.run()
+        print('Test {} left to another worker.'.format(args.id))
+        return
+    tool_time = parse_time('60s')
+    prepare_time = parse_time('5s')
+    source_size_limit = parse_memory(args.test.get('source_size', '100K'))
+    binary_size_limit = parse_memory(args.test.get('binary_size', '10M'))
+    compile_time = parse_time(args.test.get('compile_time', '10s'))
+    compile_memory = parse_memory(args.test.get('compile_memory', '1G'))
+    c_standard = args.test.get('c_standard', 'c11')
+    cpp_standard = args.test.get('cpp_standard', 'c++17')
+    gcc_arguments = [ arg.strip() for arg in args.test.get('gcc_arguments', '').split() if arg.strip() ]
+    gcc_arguments.append('-Wall')
+    time_limit = parse_time(args.test.get('time', '10s'))
+    memory_limit = parse_memory(args.test.get('memory', '1G'))
+    output_size_limit = parse_memory(args.test.get('output_size', '64M'))
+    error_size_limit  = parse_memory(args.test.get('error_size', '1M'))
+    basename = args.test.get('basename', None)
+    regex_count = args.test.get('regex_count', None)
+    args.add_steps(
+        system=SystemPrepareTask(default_logs=False),
+        source=SolutionPrepareTask(source=args.solution, basename=basename, allow_extract=True, override=args.test.get('environment', None), limit_real_time=prepare_time),
+        source_rules=SolutionSourceRulesTask(max_size=source_size_limit, regex_count=regex_count),
+        builder=SolutionBuildAutoTask([
+            [SolutionBuildCMakeTask, [], {}],
+            [SolutionBuildMakeTask, [], {}],
+            [SolutionBuildGXXTask, [], {'standard': cpp_standard, 'build_arguments': gcc_arguments}],
+            [SolutionBuildGCCTask, [], {'standard': c_standard, 'build_arguments': gcc_arguments, 'libraries': ['m']}],
+            [SolutionBuildPython3ScriptTask, [], {}],
+        ], limit_real_time=compile_time, limit_memory=compile_memory),
+        build_rules=SolutionBuildRulesTask(max_size=binary_size_limit),
+    )
+    args.add_steps(io=SingleIOTask(
+        input_path=args.test.get('input', None),
+        tool_override=args.test.get('tools', None),
+        tool_time=tool_time,
+        tool_c_standard=c_standard,
+        tool_cpp_standard=cpp_standard,
+        tool_gcc_arguments=gcc_arguments,
+        generator_source=args.test.get('generator', None),
+        verifier_source=args.test.get('verifier', None),
+        hint_path=args.test.get('hint', None),
+        hinter_source=args.test.get('hinter', None),
+        checker_source=args.test.get('checker', None),
+        limit_cores=1,
+        limit_time=time_limit,
+        limit_memory=memory_limit,
+        limit_output_size=output_size_limit,
+        limit_error_size=error_size_limit,
+        )
+    )
+    if parse_bool(args.test.get('debug', 'no')):
+        args.add_steps(debug=CollectDebugTask())
+    args.add_steps(logs=CollectLogsTask())
+    result = args.run()
+    print('Result {} on test {}.'.format(result.status, args.id))
@@ -1,5 +1,6 @@
 """Settings for broker"""
 import os
+import socket
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
@@ -14,6 +15,8 @@ SERVER_PORT: int = int(os.getenv('SERVER_PORT'))
 SERVER_URL: str = os.getenv('SERVER_URL')
 
 ACTIVE_WAIT: bool = os.getenv('ACTIVE_WAIT') == 'true'
+# Simulated Kolejka instead of the real one, for experiments (requires ACTIVE_WAIT disabled)
+KOLEJKA_SIMULATOR: bool = os.getenv('KOLEJKA_SIMULATOR') == 'true'
 
 # Path settings
 BASE_DIR = Path(__file__).resolve().parent
@@ -35,7 +38,8 @@ if _submits_dir_in is not None:
 else:
     SUBMITS_DIR = BASE_DIR / 'submits'
 
-KOLEJKA_SRC_DIR = BASE_DIR / 'kolejka_src'
+# builds of simulator runs are kept apart, they link to placeholders of Kolejka tools
+KOLEJKA_SRC_DIR = BASE_DIR / ('kolejka_src_simulator' if KOLEJKA_SIMULATOR else 'kolejka_src')
 JUDGES_SRC_DIR = BASE_DIR / 'judges'
 KOLEJKA_CONF = BASE_DIR / 'kolejka.conf'
 
@@ -44,26 +48,246 @@ add_supported_extensions('cpp')
 
 # Judge settings
 JUDGES = {
-    'main': JUDGES_SRC_DIR / 'judge_main.py'
+    'main': JUDGES_SRC_DIR / 'judge_main.py',
+    # compiles the solution once per Kolejka task instead of once per test
+    'build_once': JUDGES_SRC_DIR / 'judge_build_once.py',
+    # runs tests of a Kolejka task in parallel, one per core allotted to the task ('cpus')
+    'parallel': JUDGES_SRC_DIR / 'judge_parallel.py',
 }
+# Judge used for packages that do not choose one with 'judge' key in their config
+DEFAULT_JUDGE = 'main'
 
 # Kolejka settings
 KOLEJKA_CALLBACK_URL_PREFIX = f'https://{SERVER_URL}/kolejka'
-BUILD_NAMESPACE = 'kolejka'
+BUILD_NAMESPACE = 'kolejka_simulator' if KOLEJKA_SIMULATOR else 'kolejka'
+
+# Executor settings
+# Threads for blocking I/O (None - default of ThreadPoolExecutor)
+EXECUTOR_IO_WORKERS: int | None = None
+# Processes for CPU-bound work (package parsing and building, parsing of results);
+# with 0 such work runs in the I/O threads
+EXECUTOR_CPU_WORKERS: int = max(1, (os.cpu_count() or 2) // 2)
+
+# Shared state settings
+# Directory with state shared by broker instances (e.g. many uvicorn workers behind one
+# load balancer). Any instance can then take Kolejka callbacks. If not set, state is kept
+# only in the memory of a single instance.
+SHARED_STATE_DIR: Path | None = Path(os.getenv('SHARED_STATE_DIR')) if os.getenv('SHARED_STATE_DIR') else None
+INSTANCE_ID: str = os.getenv('BROKER_INSTANCE_ID') or f'{socket.gethostname()}-{os.getpid()}'
 
 # Timeout settings
 TASK_SUBMIT_TIMEOUT: timedelta = timedelta(minutes=10)
 DELETION_DAEMON_INTERVAL: timedelta = timedelta(minutes=5)
 
+# Job queue settings
+# Number of worker coroutines per job kind
+JOB_QUEUE_WORKERS: dict[str, int] = {
+    'intake': 16,
+    'callback': 16,
+    'delivery': 8,
+}
+# Maximum number of waiting jobs per job kind
+JOB_QUEUE_DEPTH: dict[str, int] = {
+    'intake': 10000,
+    'callback': 10000,
+    'delivery': 10000,
+}
+# How long (in seconds) each job queue may take to drain on shutdown
+JOB_QUEUE_DRAIN_TIMEOUT: float = 60.0
+# Priority classes of submits, highest first. Within a class submits of different
+# tenants (packages) are dispatched by weighted fair queueing.
+PRIORITY_CLASSES: list[str] = ['exam', 'interactive', 'rejudge']
+DEFAULT_PRIORITY = 'interactive'
+BATCH_PRIORITY = 'rejudge'  # default for submits sent to /baca/batch
+TENANT_WEIGHTS: dict[str, float] = {}  # tenants not listed have weight 1
+# Maximum number of submits dispatched to Kolejka and not finished yet (None - no limit).
+# Further submits wait in the intake queue, where priority classes and fair share apply.
+INTAKE_MAX_OUTSTANDING: int | None = 500
+
+# Kolejka callback settings
+# How long accepted callbacks are remembered, so their duplicates can be dropped
+CALLBACK_DEDUP_WINDOW: timedelta = timedelta(minutes=30)
+CALLBACK_DEDUP_MAX_SIZE = 100000
+# How long a callback that came before its set submit was sent waits for it
+CALLBACK_PARK_TIMEOUT: timedelta = timedelta(minutes=2)
+
+# Polling for set submits whose callbacks were lost (used only when ACTIVE_WAIT is disabled)
+POLLING_INTERVAL: timedelta = timedelta(seconds=15)
+POLLING_MIN_AGE: timedelta = timedelta(minutes=1)  # first poll after waiting that long
+POLLING_BATCH_SIZE = 50
+POLLING_MAX_BACKOFF: timedelta = timedelta(minutes=4)
+
+# Kolejka simulator settings (see SimulationProfile for meaning of profile keys)
+KOLEJKA_SIMULATOR_PROFILE: dict = {
+    'workers': 4,
+    'queue_delay': 2.0,
+    'task_overhead': 1.0,
+    'time_fraction': 0.2,
+    'time_sigma': 0.5,
+    'failure_rate': 0.01,
+    'lost_callback_rate': 0.01,
+    'compile_error_rate': 0.05,
+    'wrong_answer_rate': 0.05,
+    'time_scale': 1.0,
+    'seed': None,
+}
+KOLEJKA_SIMULATOR_CALLBACK_URL_PREFIX = f'http://{SERVER_HOST}:{SERVER_PORT}/kolejka'
+
+# Retrying of transient Kolejka failures, per stage: task creation, task put, result get
+# and (with ACTIVE_WAIT) execution of the whole task
+# (attempts including the first one, base and max delay of the jittered backoff in seconds).
+# Polling has no policy - it is repeated by the polling daemon anyway.
+KOLEJKA_RETRY_ATTEMPTS: dict[str, int] = {
+    'create': 1,
+    'put': 4,
+    'get': 4,
+    'execute': 4,
+}
+KOLEJKA_RETRY_BASE_DELAY: float = 1.0
+KOLEJKA_RETRY_MAX_DELAY: float = 30.0
+# Retries shared by all set submits: at most RETRY_BUDGET at once, refilled at RETRY_BUDGET_REFILL per second
+KOLEJKA_RETRY_BUDGET: float = 100.0
+KOLEJKA_RETRY_BUDGET_REFILL: float = 1.0
+# Deadlines of single attempts of stages (in seconds, stages not listed have none). Kolejka
+# tools still running at the deadline are killed and the attempt fails like any other
+# transient failure. 'poll' is checking for results of set submits with lost callbacks.
+# 'execute' covers waiting in Kolejka queue and running of the task, so it has to be well
+# above the longest task (max_time of KOLEJKA_RESOURCE_PROFILE).
+KOLEJKA_STAGE_TIMEOUTS: dict[str, float] = {
+    'create': 120.0,
+    'put': 120.0,
+    'get': 300.0,
+    'poll': 60.0,
+    'execute': 3 * 3600.0,
+}
+# Stages not retried after their deadline - the task may still be queued or running in
+# Kolejka, so running it again would only add load
+KOLEJKA_NO_RETRY_AFTER_DEADLINE: set[str] = {'execute'}
+
+# Circuit breaker around Kolejka - opens after that many consecutive set submits failed to
+# be sent because of transient failures. While it is not closed, new submits are held in
+# a buffer on disk and replayed once Kolejka recovers, instead of failing.
+KOLEJKA_BREAKER_ENABLED = True
+KOLEJKA_BREAKER_FAILURE_THRESHOLD = 5
+# how long the breaker stays open before letting a probe through (doubled after failed probes)
+KOLEJKA_BREAKER_RECOVERY_TIMEOUT: timedelta = timedelta(seconds=10)
+KOLEJKA_BREAKER_MAX_RECOVERY_TIMEOUT: timedelta = timedelta(minutes=5)
+DISPATCH_BUFFER_DIR = BASE_DIR / 'dispatch_buffer'
+DISPATCH_BUFFER_MAX_SIZE = 10000  # submits
+DISPATCH_BUFFER_REPLAY_RATE: float = 5.0  # submits per second, once the breaker is closed
+DISPATCH_BUFFER_MAX_ATTEMPTS = 3  # times a submit failing because of outages is held
+# dispatch buffer and outbox directories may be shared by broker processes - messages
+# put by other processes are found by rescanning the directory every this many seconds
+DURABLE_QUEUE_RESCAN_INTERVAL: float = 5.0
+
+# Kolejka tools (kolejka-client, kolejka-judge) are forked from fork servers that have
+# their modules already imported, instead of starting a new interpreter for every call
+FORKSERVER_ENABLED: bool = hasattr(os, 'fork')
+FORKSERVER_PRELOAD: list[str] = ['kolejka']  # prefixes of modules imported by fork servers
+FORKSERVER_MAX_SERVERS = 4  # one per tool and version of Kolejka tools
+
+# Result cache settings
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_DIR = BASE_DIR / 'result_cache'
+RESULT_CACHE_MAX_SIZE = 1024 ** 3  # bytes
+
+# Kolejka task planning settings
+# Sets are split into shards or bundled together based on their estimated cost (in seconds)
+TASK_PLANNING_ENABLED = True
+TASK_PLANNING_SHARD_COST: float = 300.0  # sets more expensive than this are split
+TASK_PLANNING_BUNDLE_COST: float = 30.0  # sets cheaper than this are bundled
+TASK_PLANNING_MAX_SHARDS = 8
+TASK_PLANNING_TEST_OVERHEAD: float = 1.0  # cost of a single test on top of its time limit
+TASK_PLANNING_COST_PER_MB: float = 0.5  # cost of each MB of test input
+
+# Kolejka task resources
+# Worker requirements of tasks (packages may set their own with 'kolejka_requires' key)
+KOLEJKA_REQUIRES: list[str] = ['cpu:xeon e3-1270 v5']
+# Limits of every task when resource profiles are disabled
+KOLEJKA_DEFAULT_LIMITS: dict[str, str] = {'time': '600s', 'memory': '10G', 'storage': '5G', 'workspace': '5G'}
+# Limits of tasks derived from time and memory limits, number and file sizes of their tests
+# (see ResourceEstimator for meaning of profile keys). Packages and sets may override
+# single limits with 'kolejka_limits' key.
+KOLEJKA_RESOURCE_PROFILES_ENABLED = True
+KOLEJKA_RESOURCE_PROFILE: dict = {
+    'time_factor': 2.0,
+    'test_overhead': 15.0,
+    'base_time': 60.0,
+    'memory_factor': 1.5,
+    'compile_memory': '1G',
+    'base_memory': '512M',
+    'storage_factor': 2.0,
+    'base_storage': '1G',
+    'min_time': 60.0,
+    'max_time': 3600.0,
+    'max_memory': '16G',
+    'max_storage': '20G',
+}
+
+# Watching of the event loop - lag is measured every INTERVAL, stack of code blocking
+# the loop for longer than THRESHOLD is logged
+LOOP_WATCHDOG_ENABLED = True
+LOOP_WATCHDOG_INTERVAL: timedelta = timedelta(milliseconds=100)
+LOOP_WATCHDOG_THRESHOLD: timedelta = timedelta(milliseconds=250)
+
+# Stream of submit state changes under /events
+EVENTS_BUFFER_SIZE = 256  # events buffered per subscriber, subscribers falling further behind are dropped
+EVENTS_MAX_SUBSCRIBERS = 100
+EVENTS_KEEPALIVE: timedelta = timedelta(seconds=15)
+
+# Package prewarming - building new package commits before their first submits
+PREWARM_ENABLED = True  # not used with FORCE_REBUILD_PACKAGE
+PREWARM_INTERVAL: timedelta = timedelta(seconds=30)
+PREWARM_CONCURRENCY = 2
+
 # Package settings
 FORCE_REBUILD_PACKAGE = False
 
+# Kolejka tools linked into package builds, kept in versions under KOLEJKA_SRC_DIR
+KOLEJKA_ARTIFACTS: dict[str, str] = {
+    'kolejka-judge': 'https://kolejka.matinf.uj.edu.pl/kolejka-judge',
+    'kolejka-client': 'https://kolejka.matinf.uj.edu.pl/kolejka-client',
+}
+# Expected sha256 of artifacts pinned to a version (artifacts not listed here are not checked)
+KOLEJKA_ARTIFACT_CHECKSUMS: dict[str, str] = {}
+# How often artifacts are fetched again (new version is published only if they changed)
+KOLEJKA_ARTIFACTS_REFRESH_INTERVAL: timedelta = timedelta(hours=6)
+# Versions not used by any build are removed, but not before they are that old
+KOLEJKA_ARTIFACTS_GC_MIN_AGE: timedelta = timedelta(hours=1)
+
 # BaCa2 URL settings
 BACA_URL = os.getenv('BACA_URL')
 # Where results should be sent back to BaCa2
 BACA_RESULTS_URL = f'{BACA_URL}/result'
 # Where error notifications should be sent to BaCa2
 BACA_ERROR_URL = f'{BACA_URL}/error'
+# Results with more tests than that are serialised outside of the event loop
+BACA_OFFLOAD_TESTS = 1000
+# Where results of single sets are sent to BaCa2 (with STREAM_PARTIAL_RESULTS)
+BACA_PARTIAL_RESULTS_URL = f'{BACA_URL}/partial_result'
+# Deadlines of requests to BaCa2 (in seconds) - of results, partial results and errors.
+# Requests are aborted at the deadline and fail like any other connection error.
+BACA_TIMEOUTS: dict[str, float] = {
+    'send': 60.0,
+    'partial': 30.0,
+    'error': 30.0,
+}
+# Outbox of results - results of finished submits are stored on disk and delivered to
+# BaCa2 by OUTBOX_WORKERS workers, retrying until BaCa2 accepts them. Number of concurrent
+# deliveries starts at OUTBOX_INITIAL_CONCURRENCY and adapts to BaCa2 (up to OUTBOX_WORKERS).
+OUTBOX_ENABLED = True
+OUTBOX_DIR = BASE_DIR / 'outbox'
+OUTBOX_MAX_SIZE = 10000  # results, submits finished when the outbox is full are sent directly
+OUTBOX_MAX_BYTES = 1024 ** 3  # bytes of results waiting for delivery
+OUTBOX_WORKERS = 16
+OUTBOX_INITIAL_CONCURRENCY = 4
+OUTBOX_RETRY_BASE_DELAY: float = 1.0  # seconds, of the jittered backoff
+OUTBOX_RETRY_MAX_DELAY: float = 300.0
+
+# Streaming of results - results of every finished set are sent to BaCa2 right away,
+# all results are still sent once the whole submit is checked
+STREAM_PARTIAL_RESULTS = False
+STREAM_PARTIAL_MIN_SETS = 4  # only packages with at least that many sets
 
 # Password settings
 # PASSWORDS HAVE TO DIFFERENT IN ORDER TO BE EFFECTIVE
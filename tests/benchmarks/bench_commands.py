@@ -0,0 +1,75 @@
+"""
+Benchmark of running Kolejka tools: a new interpreter per run (SubprocessRunner) against
+forking from a fork server (ForkServerRunner). Reports wall time of a run and CPU time of
+the broker and of the processes it started (fork servers included) per run.
+
+    python -m tests.benchmarks.bench_commands --script kolejka_src/current/kolejka-client --runs 20
+
+Without --script a zipapp importing a few heavy standard library modules is used.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import tempfile
+import time
+import zipapp
+from pathlib import Path
+
+from app.broker.commands import CommandRunner, ForkServerRunner, SubprocessRunner
+
+SYNTHETIC_TOOL = """
+import argparse, asyncio, email.mime.multipart, http.client, json, logging.handlers, urllib.request, \
+    xml.etree.ElementTree
+"""
+
+
+def synthetic_tool(directory: Path) -> Path:
+    source = directory / 'tool'
+    (source / 'kolejka').mkdir(parents=True)
+    (source / 'kolejka' / '__init__.py').write_text(SYNTHETIC_TOOL)
+    (source / '__main__.py').write_text('import kolejka, argparse\nargparse.ArgumentParser().parse_args()\n')
+    zipapp.create_archive(source, directory / 'tool.pyz')
+    return directory / 'tool.pyz'
+
+
+def cpu_time() -> float:
+    """CPU time of this process and its finished children (fork servers are waited for on close)."""
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+async def measure(runner: CommandRunner, script: Path, args: list[str], runs: int) -> tuple[float, float]:
+    """Returns mean wall time and mean CPU time of a run."""
+    wall, cpu = time.perf_counter(), cpu_time()
+    for _ in range(runs):
+        result = await runner.run(script, *args)
+        if result.returncode != 0:
+            raise RuntimeError(f'{script} failed:\n{result.stderr.decode()}')
+    await runner.close()
+    return (time.perf_counter() - wall) / runs, (cpu_time() - cpu) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--script', type=Path, help='script to run, e.g. kolejka-client')
+    parser.add_argument('--args', nargs='*', default=['--help'], help='arguments of every run')
+    parser.add_argument('--preload', nargs='*', default=['kolejka'], help='module prefixes preloaded by fork server')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = args.script or synthetic_tool(Path(tmp))
+        run_args = args.args if args.script else []
+        logger = logging.getLogger('benchmark')
+        print(f'{args.runs} runs of {os.path.basename(script)}')
+        print(f'{"":12} {"wall [ms]":>10} {"cpu [ms]":>10}')
+        for name, runner in (('subprocess', SubprocessRunner()),
+                             ('forkserver', ForkServerRunner(logger, preload=args.preload))):
+            wall, cpu = asyncio.run(measure(runner, script, run_args, args.runs))
+            print(f'{name:12} {wall * 1000:10.1f} {cpu * 1000:10.1f}')
+
+
+if __name__ == '__main__':
+    main()
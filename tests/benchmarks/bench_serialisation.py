@@ -0,0 +1,78 @@
+"""
+Benchmark of serialisation of results sent to BaCa2: the previous path (deepcopy, model
+validation, model_dump_json and logging of the whole payload) against encode_message.
+Reports wall time, CPU time and peak memory allocated per delivery.
+
+    python -m tests.benchmarks.bench_serialisation --sets 10 --tests 1000
+"""
+import argparse
+import logging
+import time
+import tracemalloc
+from copy import deepcopy
+
+from baca2PackageManager.broker_communication import BrokerToBaca, SetResult, TestResult
+
+from app.broker.messenger import encode_message
+
+logger = logging.getLogger('benchmark')
+logger.addHandler(logging.NullHandler())
+
+
+def make_results(sets: int, tests: int, log_size: int) -> dict[str, SetResult]:
+    return {
+        f'set{s}': SetResult(name=f'set{s}', tests={
+            str(t): TestResult(name=str(t), status='OK', time_real=0.5, time_cpu=0.4,
+                               runtime_memory=1024, answer='',
+                               logs={'compile_log': 'x' * log_size, 'checker_log': 'y' * log_size})
+            for t in range(tests)
+        })
+        for s in range(sets)
+    }
+
+
+def previous(results: dict[str, SetResult]) -> bytes:
+    message = BrokerToBaca(pass_hash='hash', submit_id='submit', results=deepcopy(results))
+    data = message.model_dump_json()
+    logger.warning(f'Sending results to baCa2: {data}')
+    return data.encode()
+
+
+def current(results: dict[str, SetResult]) -> bytes:
+    data, digest = encode_message(BrokerToBaca.model_construct(pass_hash='hash', submit_id='submit',
+                                                               results=results))
+    logger.info("Sending results to baCa2: %s bytes, sha256 %s", len(data), digest[:16])
+    return data
+
+
+def measure(func, results: dict[str, SetResult], repeat: int) -> tuple[float, float, int, int]:
+    """Returns mean wall time, mean CPU time, peak allocated memory and size of output."""
+    size = len(func(results))  # warm up
+    tracemalloc.start()
+    func(results)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(repeat):
+        func(results)
+    return (time.perf_counter() - wall) / repeat, (time.process_time() - cpu) / repeat, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sets', type=int, default=10)
+    parser.add_argument('--tests', type=int, default=1000, help='tests per set')
+    parser.add_argument('--log-size', type=int, default=100, help='length of every test log')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = make_results(args.sets, args.tests, args.log_size)
+    print(f'{args.sets} sets x {args.tests} tests')
+    print(f'{"":10} {"wall [ms]":>10} {"cpu [ms]":>10} {"peak [MB]":>10} {"size [MB]":>10}')
+    for name, func in (('previous', previous), ('current', current)):
+        wall, cpu, peak, size = measure(func, results, args.repeat)
+        print(f'{name:10} {wall * 1000:10.1f} {cpu * 1000:10.1f} {peak / 1024 ** 2:10.1f} {size / 1024 ** 2:10.1f}')
+
+
+if __name__ == '__main__':
+    main()
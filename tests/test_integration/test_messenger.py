@@ -6,8 +6,9 @@ import unittest
 from pathlib import Path
 from time import sleep
 
-from settings import SUBMITS_DIR, BUILD_NAMESPACE, KOLEJKA_CONF, KOLEJKA_SRC_DIR
+from settings import SUBMITS_DIR, BUILD_NAMESPACE, KOLEJKA_CONF, KOLEJKA_SRC_DIR, KOLEJKA_ARTIFACTS
 
+from app.broker.artifacts import ArtifactStore
 from app.broker.messenger import KolejkaMessenger, PackageManager, KolejkaMessengerActiveWait
 from app.broker.datamaster import TaskSubmit, DataMaster, SetSubmit
 
@@ -28,12 +29,13 @@ class KolejkaMessengerTest(unittest.TestCase):
             kolejka_callback_url_prefix='http://127.0.0.1/',
             logger=self.logger
         )
+        self.artifacts = ArtifactStore(KOLEJKA_SRC_DIR, KOLEJKA_ARTIFACTS, self.logger)
         self.package_manager = PackageManager(
-            kolejka_src_dir=KOLEJKA_SRC_DIR,
+            artifacts=self.artifacts,
             build_namespace=BUILD_NAMESPACE,
             force_rebuild=False,
         )
-        self.package_manager.refresh_kolejka_src()
+        asyncio.run(self.artifacts.refresh())
 
         shutil.rmtree(SUBMITS_DIR / 'submit_id', ignore_errors=True)
         shutil.rmtree(SUBMITS_DIR / '1', ignore_errors=True)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from app.broker.artifacts import ArtifactStore
+from app.broker.metrics import MetricsRegistry
+
+
+class ArtifactStoreMock(ArtifactStore):
+    """Artifact store serving artifacts from memory instead of the network."""
+
+    contents: dict[str, bytes] = {}
+
+    async def _download(self, session, name: str) -> bytes:
+        return self.contents[name]
+
+
+class ArtifactStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.metrics = MetricsRegistry()
+        self.store = ArtifactStoreMock(self.root / 'kolejka_src',
+                                       {'kolejka-judge': 'judge-url', 'kolejka-client': 'client-url'},
+                                       logging.Logger('test'),
+                                       gc_min_age=0,
+                                       metrics=self.metrics)
+        self.store.contents = {'kolejka-judge': b'judge v1', 'kolejka-client': b'client v1'}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_build(self, name: str, version: str) -> Path:
+        build_path = self.root / name
+        (build_path / 'common').mkdir(parents=True)
+        os.symlink(self.store.version_path(version) / 'kolejka-judge',
+                   build_path / 'common' / 'kolejka-judge')
+        return build_path
+
+    def test_refresh(self):
+        version = asyncio.run(self.store.refresh())
+        self.assertEqual(self.store.current_version(), version)
+        current = self.store.root_dir / 'current'
+        self.assertEqual((current / 'kolejka-judge').read_bytes(), b'judge v1')
+        self.assertTrue(os.access(current / 'kolejka-client', os.X_OK))
+        self.assertTrue(self.store.verify(version))
+
+        # unchanged artifacts - nothing new is published
+        self.assertEqual(asyncio.run(self.store.refresh()), version)
+        self.assertEqual(self.metrics.counter('artifacts.published').value, 1)
+        self.assertEqual(asyncio.run(self.store.ensure()), version)
+        self.assertEqual(self.metrics.counter('artifacts.fetches').value, 2)
+
+        self.store.contents['kolejka-judge'] = b'judge v2'
+        new_version = asyncio.run(self.store.refresh())
+        self.assertNotEqual(new_version, version)
+        self.assertEqual((current / 'kolejka-judge').read_bytes(), b'judge v2')
+
+    def test_checksums(self):
+        self.store.checksums = {'kolejka-judge': '0' * 64}
+        with self.assertRaises(ArtifactStore.ArtifactError):
+            asyncio.run(self.store.refresh())
+        self.assertIsNone(self.store.current_version())
+        self.assertEqual(self.metrics.counter('artifacts.fetch_failed').value, 1)
+
+    def test_collect_garbage(self):
+        old_version = asyncio.run(self.store.acquire())
+        self.store.release(old_version, self.make_build('build1', old_version))
+        in_progress = asyncio.run(self.store.acquire())  # a build that did not finish yet
+
+        self.store.contents['kolejka-judge'] = b'judge v2'
+        new_version = asyncio.run(self.store.refresh())
+        self.assertEqual(asyncio.run(self.store.collect_garbage()), [])
+
+        # build1 was rebuilt, old version is used only by the build in progress
+        (self.root / 'build1' / 'common' / 'kolejka-judge').unlink()
+        self.assertEqual(asyncio.run(self.store.collect_garbage()), [])
+
+        self.store.release(in_progress)
+        self.assertEqual(asyncio.run(self.store.collect_garbage()), [old_version])
+        self.assertFalse(self.store.version_path(old_version).exists())
+
+        # current version is never collected
+        self.assertEqual(asyncio.run(self.store.collect_garbage()), [])
+        self.assertTrue(self.store.verify(new_version))
+
+    def test_shared_store(self):
+        # other broker process using the same directory
+        other = ArtifactStoreMock(self.store.root_dir, self.store.sources, logging.Logger('test'),
+                                  gc_min_age=0, metrics=MetricsRegistry())
+        old_version = asyncio.run(self.store.acquire())
+        # ref of a build of a process that died
+        (self.store.version_path(old_version) / 'refs' / f'0-dead{ArtifactStore.BUILDING}').touch()
+
+        self.store.contents['kolejka-judge'] = b'judge v2'
+        asyncio.run(self.store.refresh())
+        self.assertEqual(asyncio.run(other.collect_garbage()), [])
+
+        self.store.release(old_version)
+        self.assertEqual(asyncio.run(other.collect_garbage()), [old_version])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from app.broker.breaker import BreakingKolejkaMessenger, CircuitBreaker, DispatchBuffer
+from app.broker.durable_queue import DurableQueue
+from app.broker.messenger import KolejkaMessengerInterface
+from app.broker.metrics import MetricsRegistry
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.breaker = CircuitBreaker('test', failure_threshold=2, recovery_timeout=0.05,
+                                      max_recovery_timeout=0.15, logger=logging.Logger('test'),
+                                      metrics=self.metrics)
+
+    def test_transitions(self):
+        State = CircuitBreaker.State
+        self.breaker.record_failure()
+        self.breaker.record_success()  # failures must be consecutive
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, State.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, State.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.metrics.counter('breaker.test.rejected').value, 1)
+
+        time.sleep(0.06)
+        self.assertEqual(self.breaker.state, State.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()  # failed probe
+        self.assertEqual(self.breaker.state, State.OPEN)
+        self.assertEqual(self.breaker.recovery_timeout, 0.1)
+
+        time.sleep(0.11)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, State.CLOSED)
+        self.assertEqual(self.breaker.recovery_timeout, 0.05)
+        self.assertEqual(self.metrics.counter('breaker.test.opened').value, 2)
+        self.assertEqual(self.metrics.gauge('breaker.test.state').value, State.CLOSED.value)
+
+    def test_max_recovery_timeout(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        for _ in range(3):
+            self.breaker._opened_at -= self.breaker.recovery_timeout  # recovery timeout passed
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.recovery_timeout, 0.15)
+
+
+class BreakingKolejkaMessengerTest(unittest.TestCase):
+
+    class KolejkaMessengerMock(KolejkaMessengerInterface):
+
+        def __init__(self):
+            self.error = None
+            self.sent = 0
+
+        async def send(self, set_submit):
+            self.sent += 1
+            if self.error is not None:
+                raise self.error
+
+        async def get_results(self, set_submit):
+            pass
+
+    def setUp(self):
+        self.messenger = self.KolejkaMessengerMock()
+        self.breaker = CircuitBreaker('kolejka', failure_threshold=2, recovery_timeout=60,
+                                      max_recovery_timeout=60, logger=logging.Logger('test'),
+                                      metrics=MetricsRegistry())
+        self.breaking = BreakingKolejkaMessenger(self.messenger, self.breaker)
+
+    def send(self):
+        asyncio.run(self.breaking.send(None))
+
+    def test_outage(self):
+        self.messenger.error = ConnectionError()
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.send()
+        with self.assertRaises(BreakingKolejkaMessenger.KolejkaUnavailable):
+            self.send()
+        self.assertEqual(self.messenger.sent, 2)  # not sent while open
+
+    def test_permanent_errors(self):
+        self.messenger.error = ValueError()
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                self.send()
+        self.assertEqual(self.breaker.state, CircuitBreaker.State.CLOSED)
+
+        # transient error wrapped by the messenger counts as an outage
+        error = KolejkaMessengerInterface.KolejkaCommunicationError()
+        error.__cause__ = TimeoutError()
+        self.messenger.error = error
+        for _ in range(2):
+            with self.assertRaises(KolejkaMessengerInterface.KolejkaCommunicationError):
+                self.send()
+        self.assertEqual(self.breaker.state, CircuitBreaker.State.OPEN)
+
+
+class DispatchBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.metrics = MetricsRegistry()
+        self.logger = logging.Logger('test')
+        self.breaker = CircuitBreaker('kolejka', failure_threshold=1, recovery_timeout=0.05,
+                                      max_recovery_timeout=0.05, logger=self.logger, metrics=self.metrics)
+        self.queue = DurableQueue(self.tmp / 'buffer', max_items=3, fsync=False, metrics=self.metrics)
+        self.buffer = DispatchBuffer(self.breaker, self.queue, replay_rate=100, logger=self.logger,
+                                     max_attempts=2, metrics=self.metrics)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @staticmethod
+    def entry(submit_id: str, attempts: int = 0) -> dict:
+        return {'submit_id': submit_id, 'package_path': '1', 'commit_id': '1', 'submit_path': 's',
+                'attempts': attempts}
+
+    def test_hold(self):
+        async def inner():
+            self.assertFalse(await self.buffer.hold(self.entry('a')))  # Kolejka available
+            self.breaker.record_failure()
+            self.assertTrue(await self.buffer.hold(self.entry('a')))
+            self.breaker.record_success()
+            self.assertTrue(await self.buffer.hold(self.entry('b')))  # queued behind 'a'
+            self.assertFalse(await self.buffer.hold_failed(self.entry('c'), ValueError()))
+            self.assertTrue(await self.buffer.hold_failed(self.entry('c'), ConnectionError()))
+            self.assertFalse(await self.buffer.hold_failed(self.entry('d', attempts=1), ConnectionError()))
+            self.assertFalse(await self.buffer.hold(self.entry('e')))  # full
+            return [json.loads((await self.queue.get())[1]) for _ in range(self.queue.pending)]
+
+        held = asyncio.run(inner())
+        self.assertEqual([e['submit_id'] for e in held], ['a', 'b', 'c'])
+        self.assertEqual(held[2]['attempts'], 1)
+        self.assertEqual(self.metrics.counter('dispatch_buffer.overflow').value, 1)
+
+    def test_replay(self):
+        dispatched = []
+
+        async def dispatch(entry):
+            # the first replay is a probe that fails
+            if not dispatched:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            dispatched.append(entry['submit_id'])
+
+        async def inner():
+            self.breaker.record_failure()
+            for submit_id in 'abc':
+                await self.buffer.hold(self.entry(submit_id))
+            runner = asyncio.create_task(self.buffer.run(dispatch))
+            for _ in range(100):
+                if len(self.queue) == 0:
+                    break
+                await asyncio.sleep(0.02)
+            runner.cancel()
+
+        start = time.monotonic()
+        asyncio.run(inner())
+        self.assertEqual(dispatched, ['a', 'b', 'c'])
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)  # waited for recovery twice
+        self.assertEqual(self.breaker.state, CircuitBreaker.State.CLOSED)
+        self.assertEqual(self.metrics.counter('dispatch_buffer.replayed').value, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ from unittest import TestCase
 
 from baca2PackageManager import *
 
+import settings
 from app.broker.builder import Builder
 
 set_base_dir(Path(__file__).parent.parent / 'resources')
@@ -18,3 +19,20 @@ class TestBuilder(TestCase):
         builder = Builder(pkg)
         builder.build()
         self.assertTrue(builder.is_built)
+
+    def test_build_judge_type(self):
+        pkg = Package(self.path / '1', '1')
+        for judge_type in ('build_once', 'parallel'):
+            with self.subTest(judge_type=judge_type):
+                builder = Builder(pkg)
+                builder.build_path = pkg.prepare_build(builder.build_namespace)
+                builder._create_common({}, judge_type)
+                self.assertEqual((builder.common_path / 'judge.py').resolve(),
+                                 settings.JUDGES[judge_type].resolve())
+
+    def test_build_unknown_judge(self):
+        pkg = Package(self.path / '1', '1')
+        builder = Builder(pkg)
+        builder.build_path = pkg.prepare_build(builder.build_namespace)
+        with self.assertRaises(ValueError):
+            builder._create_common({}, 'nonexistent')
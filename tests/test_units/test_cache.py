@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import shutil
+import unittest
+from pathlib import Path
+
+from baca2PackageManager import set_base_dir, add_supported_extensions
+from baca2PackageManager.broker_communication import SetResult, TestResult
+
+from settings import BUILD_NAMESPACE
+from app.broker.builder import Builder
+from app.broker.cache import ResultCache
+from app.broker.datamaster import DataMaster, TaskSubmit, SetSubmit
+from app.broker.metrics import MetricsRegistry
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class ResultCacheTest(unittest.TestCase):
+    test_dir = Path(__file__).absolute().parent.parent
+    resource_dir = test_dir / 'resources'
+    cache_dir = test_dir / 'result_cache'
+
+    def setUp(self):
+        self.logger = logging.Logger('test')
+        self.metrics = MetricsRegistry()
+        self.data_master = DataMaster(TaskSubmit, SetSubmit, self.logger)
+        self.package_path = self.resource_dir / '1'
+        self.submit_path = self.resource_dir / '1' / '1' / 'prog' / 'solution.cpp'
+        self.other_submit_path = self.test_dir / 'other_solution.cpp'
+        self.other_submit_path.write_text('int main() { return 1; }\n')
+        self.cache = ResultCache(self.cache_dir, 1024 ** 2, BUILD_NAMESPACE, self.logger, self.metrics)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.other_submit_path.unlink(missing_ok=True)
+
+    def new_task_submit(self, submit_id: str, submit_path: Path) -> TaskSubmit:
+        task_submit = self.data_master.new_task_submit(submit_id, self.package_path, '1', submit_path)
+        asyncio.run(task_submit.initialise())
+        if not task_submit.package.check_build(BUILD_NAMESPACE):
+            Builder(task_submit.package).build()
+        return task_submit
+
+    @staticmethod
+    def make_result(status: str = 'OK') -> SetResult:
+        return SetResult(name='x', tests={'1': TestResult(name='1', status=status)})
+
+    def test_put_get(self):
+        set_submit = self.new_task_submit('submit1', self.submit_path).set_submits[0]
+        self.assertIsNone(asyncio.run(self.cache.get(set_submit)))
+        asyncio.run(self.cache.put(set_submit, self.make_result()))
+
+        same_set_submit = self.new_task_submit('submit2', self.submit_path).set_submits[0]
+        result = asyncio.run(self.cache.get(same_set_submit))
+        self.assertIsNotNone(result)
+        self.assertEqual(result.name, same_set_submit.set_name)
+        self.assertEqual(result.tests['1'].status, 'OK')
+        self.assertEqual(self.metrics.counter('result_cache.hits').value, 1)
+        self.assertEqual(self.metrics.counter('result_cache.misses').value, 1)
+        self.assertEqual(self.metrics.gauge('result_cache.hit_rate').value, 0.5)
+
+    def test_different_solution_or_set(self):
+        task_submit = self.new_task_submit('submit1', self.submit_path)
+        asyncio.run(self.cache.put(task_submit.set_submits[0], self.make_result()))
+        self.assertIsNone(asyncio.run(self.cache.get(task_submit.set_submits[1])))
+
+        other_set_submit = self.new_task_submit('submit2', self.other_submit_path).set_submits[0]
+        self.assertIsNone(asyncio.run(self.cache.get(other_set_submit)))
+
+    def test_uncacheable_result(self):
+        set_submit = self.new_task_submit('submit1', self.submit_path).set_submits[0]
+        asyncio.run(self.cache.put(set_submit, self.make_result('INT')))
+        self.assertIsNone(asyncio.run(self.cache.get(set_submit)))
+
+    def test_eviction(self):
+        task_submit = self.new_task_submit('submit1', self.submit_path)
+        entry_size = len(self.make_result().model_dump_json())
+        self.cache.max_size = entry_size * 2
+        for set_submit in task_submit.set_submits:
+            asyncio.run(self.cache.put(set_submit, self.make_result()))
+        self.assertLessEqual(self.metrics.gauge('result_cache.bytes').value, self.cache.max_size)
+        self.assertGreater(self.metrics.counter('result_cache.evicted').value, 0)
+
+    def test_dir_hash_memo(self):
+        directory = self.cache_dir / 'set0'
+        directory.mkdir(parents=True)
+        (directory / 'tests.yaml').write_text('time: 1s\n')
+        first = self.cache._dir_hash(directory)
+        self.assertEqual(self.cache._dir_hash(directory), first)
+
+        # edited in place - mtime of the directory itself does not change
+        dir_mtime = directory.stat().st_mtime_ns
+        (directory / 'tests.yaml').write_text('time: 2s\n')
+        mtime = (directory / 'tests.yaml').stat().st_mtime_ns
+        os.utime(directory / 'tests.yaml', ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+        self.assertEqual(directory.stat().st_mtime_ns, dir_mtime)
+        self.assertNotEqual(self.cache._dir_hash(directory), first)
+
+        self.cache.MAX_DIR_HASHES = 1
+        self.cache._dir_hash(self.cache_dir)
+        self.assertEqual(len(self.cache._dir_hashes), 1)
+
+    def test_opt_out(self):
+        class PackageStub:
+            def __init__(self, config: dict):
+                self.config = config
+
+            def get(self, key, default=None):
+                return self.config.get(key, default)
+
+        self.assertTrue(ResultCache.enabled_for(PackageStub({})))
+        self.assertFalse(ResultCache.enabled_for(PackageStub({'result_cache': False})))
+
+
+if __name__ == '__main__':
+    unittest.main()
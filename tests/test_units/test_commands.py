@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipapp
+from pathlib import Path
+
+from app.broker.commands import ForkServerRunner, SubprocessRunner
+from app.broker.metrics import MetricsRegistry
+
+TOOL_MODULE = """
+import os
+# every import of the module is counted in imports.log next to the archive
+with open(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'imports.log'), 'a') as f:
+    f.write(f'{os.getpid()}\\n')
+"""
+
+TOOL_MAIN = """
+import os, sys, time
+import kolejka_tool
+print('out', *sys.argv[1:])
+print('err', file=sys.stderr)
+if sys.argv[1] == 'raise':
+    raise ValueError('failure')
+if sys.argv[1] == 'sleep':
+    with open(os.path.join(os.path.dirname(sys.argv[0]), 'sleeping'), 'w') as f:
+        f.write(str(os.getpid()))
+    time.sleep(10)
+sys.exit(int(sys.argv[2]))
+"""
+
+
+def make_tool(directory: Path, name: str) -> Path:
+    """Zipapp with a package, like kolejka-client."""
+    source = directory / f'{name}_src'
+    (source / 'kolejka_tool').mkdir(parents=True)
+    (source / 'kolejka_tool' / '__init__.py').write_text(TOOL_MODULE)
+    (source / '__main__.py').write_text(TOOL_MAIN)
+    zipapp.create_archive(source, directory / name)
+    return directory / name
+
+
+class CommandRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.tool = make_tool(self.tmp, 'tool.pyz')
+        self.metrics = MetricsRegistry()
+        self.logger = logging.Logger('test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_fork_server_runner(self, **kwargs) -> ForkServerRunner:
+        return ForkServerRunner(self.logger, preload=['kolejka_tool'], metrics=self.metrics, **kwargs)
+
+    def imports(self) -> int:
+        return len((self.tmp / 'imports.log').read_text().splitlines())
+
+    def run_all(self, runner, *runs):
+        async def inner():
+            try:
+                return [await runner.run(self.tool, *args, **kwargs) for args, kwargs in runs]
+            finally:
+                await runner.close()
+
+        return asyncio.run(inner())
+
+    def test_output(self):
+        for runner in (SubprocessRunner(metrics=self.metrics), self.make_fork_server_runner()):
+            with self.subTest(runner=type(runner).__name__):
+                ok, failed, silent = self.run_all(runner,
+                                                  (('exit', 0), {}),
+                                                  (('exit', 3), {}),
+                                                  (('exit', 0), {'stdout': False, 'stderr': False}))
+                self.assertEqual(ok, (0, b'out exit 0\n', b'err\n'))
+                self.assertEqual(failed, (3, b'out exit 3\n', b'err\n'))
+                self.assertEqual(silent, (0, b'', b''))
+
+    def test_exception(self):
+        for runner in (SubprocessRunner(metrics=self.metrics), self.make_fork_server_runner()):
+            with self.subTest(runner=type(runner).__name__):
+                result, = self.run_all(runner, (('raise',), {}))
+                self.assertEqual(result.returncode, 1)
+                self.assertIn(b'ValueError: failure', result.stderr)
+
+    def test_preload(self):
+        self.run_all(self.make_fork_server_runner(), *[(('exit', 0), {})] * 5)
+        self.assertEqual(self.imports(), 1)  # imported only by the fork server
+        self.run_all(SubprocessRunner(metrics=self.metrics), *[(('exit', 0), {})] * 2)
+        self.assertEqual(self.imports(), 3)
+
+    def test_cancel(self):
+        for runner in (SubprocessRunner(metrics=self.metrics), self.make_fork_server_runner()):
+            with self.subTest(runner=type(runner).__name__):
+                async def inner():
+                    try:
+                        with self.assertRaises(TimeoutError):
+                            await asyncio.wait_for(runner.run(self.tool, 'sleep'), 1.0)
+                    finally:
+                        await runner.close()
+
+                start = time.monotonic()
+                asyncio.run(inner())
+                self.assertLess(time.monotonic() - start, 5)  # the run was killed, not waited for
+                with self.assertRaises(ProcessLookupError):
+                    os.kill(int((self.tmp / 'sleeping').read_text()), 0)
+
+    def test_fallback(self):
+        runner = self.make_fork_server_runner()
+        runner.ZYGOTE = self.tmp / 'missing.py'
+        result, = self.run_all(runner, (('exit', 2), {}))
+        self.assertEqual(result, (2, b'out exit 2\n', b'err\n'))
+        self.assertEqual(self.metrics.counter('commands.forkserver_failures').value, 1)
+
+    def test_max_servers(self):
+        other = make_tool(self.tmp, 'other.pyz')
+        runner = self.make_fork_server_runner(max_servers=1)
+
+        async def inner():
+            try:
+                for tool in (self.tool, other, self.tool):
+                    self.assertEqual((await runner.run(tool, 'exit', 0)).returncode, 0)
+                self.assertEqual(self.metrics.gauge('commands.forkservers').value, 1)
+            finally:
+                await runner.close()
+
+        asyncio.run(inner())
+        self.assertEqual(self.imports(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,16 @@
 import asyncio
 import os
+import shutil
 import unittest
 from pathlib import Path
 
 from baca2PackageManager import Package
-from baca2PackageManager.broker_communication import BrokerToBaca
+from baca2PackageManager.broker_communication import BrokerToBaca, SetResult, TestResult
 
 from app.broker.datamaster import (DataMasterInterface, TaskSubmitInterface, SetSubmitInterface,
-                                   DataMaster, TaskSubmit, SetSubmit, StateError)
+                                   DataMaster, SharedDataMaster, TaskSubmit, SetSubmit, StateError)
+from app.broker.planner import TaskPlan
+from app.broker.state_store import LocalStateStore
 from app.logger import LoggerManager
 
 
@@ -52,12 +55,20 @@ class DatamasterTest(unittest.TestCase):
                 raise ValueError("Sets not filled")
             return self._sets.copy()
 
+        @property
+        def plan(self) -> TaskPlan:
+            return TaskPlan.identity([s.set_name for s in self.set_submits])
+
         @property
         def results(self) -> list[BrokerToBaca]:
             if not self.all_checked():
                 raise ValueError("Sets not filled")
             return [s.get_result() for s in self.set_submits]
 
+        def finished_results(self) -> dict[str, SetResult]:
+            return {s.set_name: s.get_result() for s in self.set_submits
+                    if s.state == SetSubmit.SetState.DONE}
+
     def setUp(self):
         self.logger_manager = LoggerManager('test', self.test_dir / 'test.log', 0)
         self.logger_manager.set_formatter('%(filename)s:%(lineno)d: %(message)s')
@@ -188,5 +199,143 @@ class SubmitsTest(unittest.TestCase):
                          {set_submit.set_name: result for set_submit in self.task_submit.set_submits})
 
 
+class SharedDataMasterTest(unittest.TestCase):
+
+    test_dir = Path(__file__).absolute().parent.parent
+    resource_dir = test_dir / 'resources'
+    state_dir = test_dir / 'shared_state'
+
+    def setUp(self):
+        self.logger_manager = LoggerManager('test', self.test_dir / 'test.log', 0)
+        self.logger_manager.set_formatter('%(filename)s:%(lineno)d: %(message)s')
+        self.logger_manager.start()
+        self.logger = self.logger_manager.logger
+        self.store = LocalStateStore(self.state_dir)
+        # two broker instances sharing one store
+        self.master_a = SharedDataMaster(TaskSubmit, SetSubmit, self.logger, self.store, 'a',
+                                         store_poll_interval=0.01)
+        self.master_b = SharedDataMaster(TaskSubmit, SetSubmit, self.logger, self.store, 'b',
+                                         store_poll_interval=0.01)
+        self.package_path = self.resource_dir / '1'
+        self.submit_path = self.resource_dir / '1' / '1' / 'prog' / 'solution.cpp'
+
+    def tearDown(self):
+        self.logger_manager.stop()
+        with open(self.test_dir / 'test.log') as f:
+            print(f.read())
+        os.remove(self.test_dir / 'test.log')
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    async def new_sent_task_submit(self) -> TaskSubmitInterface:
+        task_submit = await self.master_a.create_task_submit("submit", self.package_path, "1", self.submit_path)
+        await task_submit.initialise()
+        task_submit.change_state(TaskSubmit.TaskState.AWAITING_SETS, requires=TaskSubmit.TaskState.INITIAL)
+        for set_submit in task_submit.set_submits:
+            set_submit.set_status_code(f'code_{set_submit.set_name}')
+            set_submit.change_state(SetSubmit.SetState.AWAITING_KOLEJKA, requires=None)
+        await self.master_a.flush()
+        return task_submit
+
+    def test_take_over(self):
+        async def inner():
+            task_submit = await self.new_sent_task_submit()
+            set_submit = task_submit.set_submits[0]
+            result = SetResult(name=set_submit.set_name, tests={'1': TestResult(name='1', status='OK')})
+            set_submit.set_result(result)
+            set_submit.change_state(SetSubmit.SetState.DONE, requires=None)
+            await self.master_a.flush()
+            with self.assertRaises(self.master_b.DataMasterError):
+                await self.master_b.create_task_submit("submit", self.package_path, "1", self.submit_path)
+            self.assertEqual(len(self.master_b.task_submits), 0)
+
+            other = task_submit.set_submits[1]
+            adopted = await self.master_b.fetch_set_submit(other.submit_id)
+            self.assertIsNot(adopted, other)
+            self.assertEqual(adopted.state, SetSubmit.SetState.AWAITING_KOLEJKA)
+            self.assertEqual(adopted.get_status_code(), other.get_status_code())
+            adopted_task = adopted.task_submit
+            self.assertEqual(adopted_task.state, TaskSubmit.TaskState.AWAITING_SETS)
+            self.assertEqual(adopted_task.set_submits[0].get_result(), result)
+            self.assertEqual(self.store.get(f'task.{task_submit.submit_id}')['owner'], 'b')
+
+            # the old owner drops its copy and cannot overwrite state anymore
+            task_submit.change_state(TaskSubmit.TaskState.ERROR, requires=None)
+            await self.master_a.flush()
+            self.assertEqual(self.store.get(f'task.{task_submit.submit_id}')['state'], 'AWAITING_SETS')
+            await self.master_a.refresh()
+            self.assertEqual(len(self.master_a.task_submits), 0)
+
+            self.master_b.delete_task_submit(adopted_task)
+            await self.master_b.flush()
+            self.assertEqual(self.store.keys(), [])
+
+        asyncio.run(inner())
+
+    def test_coalesced_writes(self):
+        async def inner():
+            task_submit = await self.new_sent_task_submit()
+            writes = []
+            update = self.store.update
+
+            def counted_update(key, fn):
+                writes.append(key)
+                return update(key, fn)
+
+            self.store.update = counted_update
+            for set_submit in task_submit.set_submits:
+                set_submit.change_state(SetSubmit.SetState.DONE, requires=None)
+            # nothing was written on the event loop
+            self.assertEqual(writes, [])
+            await self.master_a.flush()
+            # changes made before the writer ran are written together
+            self.assertEqual(len(writes), 1)
+            record = self.store.get(f'task.{task_submit.submit_id}')
+            self.assertTrue(all(s['state'] == 'DONE' for s in record['sets'].values()))
+
+        asyncio.run(inner())
+
+    def test_wait_until_sent(self):
+        async def inner():
+            task_submit = await self.master_a.create_task_submit("submit", self.package_path, "1",
+                                                                 self.submit_path)
+            await task_submit.initialise()
+            set_submit = task_submit.set_submits[0]
+            set_submit.change_state(SetSubmit.SetState.SENDING_TO_KOLEJKA, requires=None)
+            await self.master_a.flush()
+
+            with self.assertRaises(self.master_b.DataMasterError):
+                await self.master_b.fetch_set_submit(set_submit.submit_id, timeout=0.05)
+            self.assertEqual(len(self.master_b.task_submits), 0)
+
+            fetch = asyncio.create_task(self.master_b.fetch_set_submit(set_submit.submit_id, timeout=1))
+            await asyncio.sleep(0.05)
+            set_submit.set_status_code('code')
+            set_submit.change_state(SetSubmit.SetState.AWAITING_KOLEJKA, requires=None)
+            # the owner is still sending other sets
+            await asyncio.sleep(0.05)
+            self.assertFalse(fetch.done())
+            for other in task_submit.set_submits[1:]:
+                other.change_state(SetSubmit.SetState.AWAITING_KOLEJKA, requires=None)
+            adopted = await fetch
+            self.assertEqual(adopted.get_status_code(), 'code')
+
+        asyncio.run(inner())
+
+    def test_stale_local_copy(self):
+        async def inner():
+            task_submit = await self.new_sent_task_submit()
+            set_submit = task_submit.set_submits[0]
+            await self.master_b.fetch_set_submit(set_submit.submit_id)
+            self.assertEqual(self.store.get(f'task.{task_submit.submit_id}')['owner'], 'b')
+
+            # callback comes back to the old owner - its local copy is not used
+            fetched = await self.master_a.fetch_set_submit(set_submit.submit_id)
+            self.assertIsNot(fetched, set_submit)
+            self.assertEqual(fetched.get_status_code(), set_submit.get_status_code())
+            self.assertEqual(self.store.get(f'task.{task_submit.submit_id}')['owner'], 'a')
+
+        asyncio.run(inner())
+
+
 if __name__ == '__main__':
     unittest.main()
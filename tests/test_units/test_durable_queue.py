@@ -0,0 +1,117 @@
+import asyncio
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from app.broker.durable_queue import DurableQueue
+from app.broker.metrics import MetricsRegistry
+
+
+class DurableQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.metrics = MetricsRegistry()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_queue(self, **kwargs) -> DurableQueue:
+        return DurableQueue(self.tmp / 'queue', **{'max_items': 10, 'name': 'test', 'metrics': self.metrics,
+                                                   **kwargs})
+
+    def test_fifo(self):
+        queue = self.make_queue()
+
+        async def inner():
+            for i in range(3):
+                await queue.put(str(i).encode())
+            first = await queue.get()
+            second = await queue.get()
+            queue.nack(first[0])  # returned to its place
+            self.assertEqual((await queue.get())[1], b'0')
+            await queue.ack(second[0])
+            self.assertEqual((await queue.get())[1], b'2')
+            self.assertIsNone(await queue.get())
+            self.assertEqual(len(queue), 2)  # taken, not acked
+
+        asyncio.run(inner())
+        self.assertEqual(self.metrics.gauge('test.items').value, 2)
+
+    def test_persistence(self):
+        async def fill():
+            queue = self.make_queue()
+            for i in range(3):
+                await queue.put(str(i).encode())
+            key, _ = await queue.get()
+            await queue.ack(key)
+            await queue.get()  # taken, but never acked
+            queue.close()  # as if the process ended
+
+        async def read():
+            queue = self.make_queue()
+            await queue.load()
+            return [(await queue.get())[1] for _ in range(queue.pending)]
+
+        asyncio.run(fill())
+        self.assertEqual(asyncio.run(read()), [b'1', b'2'])
+
+    def test_limits(self):
+        async def inner():
+            queue = self.make_queue(max_items=2, max_bytes=10)
+            await queue.put(b'12345')
+            with self.assertRaises(DurableQueue.QueueFull):
+                await queue.put(b'123456')
+            await queue.put(b'12345')
+            with self.assertRaises(DurableQueue.QueueFull):
+                await queue.put(b'')
+            self.assertEqual(queue.bytes, 10)
+
+        asyncio.run(inner())
+
+    def test_wait(self):
+        async def inner():
+            queue = self.make_queue()
+            waiter = asyncio.create_task(queue.wait())
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+            await queue.put(b'x')
+            await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(inner())
+
+    def test_shared_directory(self):
+        async def inner():
+            # two processes using the same directory
+            first = self.make_queue(rescan_interval=0.01)
+            second = self.make_queue(rescan_interval=0.01)
+            await first.put(b'a')
+            await second.put(b'b')
+            await second.wait()
+            self.assertEqual(second.pending, 2)
+            await first.rescan()
+
+            key, data = await first.get()
+            self.assertEqual(data, b'a')
+            # claimed by the first one, the second one skips it
+            b_key, data = await second.get()
+            self.assertEqual(data, b'b')
+            self.assertIsNone(await second.get())
+
+            first.nack(key)
+            await second.rescan()
+            other_key, data = await second.get()
+            self.assertEqual(data, b'a')
+            await second.ack(other_key)
+            await second.ack(b_key)
+            self.assertIsNone(await first.get())
+            await first.rescan()
+            self.assertEqual(first.pending, 0)
+            self.assertEqual(len(first), 0)
+
+        asyncio.run(inner())
+
+
+if __name__ == '__main__':
+    unittest.main()
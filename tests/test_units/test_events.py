@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import unittest
+from pathlib import Path
+
+from baca2PackageManager import set_base_dir, add_supported_extensions
+
+from app.broker.datamaster import DataMaster, SetSubmit, TaskSubmit
+from app.broker.events import EventBus
+from app.broker.metrics import MetricsRegistry
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class EventBusTest(unittest.TestCase):
+    resource_dir = Path(__file__).absolute().parent.parent / 'resources'
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.events = EventBus(buffer_size=4, max_subscribers=2, metrics=self.metrics)
+
+    def test_filtering(self):
+        async def inner():
+            everything = self.events.subscribe()
+            chosen = self.events.subscribe({'b'})
+            for submit_id in ('a', 'b', 'a'):
+                self.events.publish({'submit_id': submit_id})
+            received = [(await everything.get(0.1))['submit_id'] for _ in range(3)]
+            self.assertEqual(received, ['a', 'b', 'a'])
+            event = await chosen.get(0.1)
+            self.assertEqual((event['id'], event['submit_id']), (2, 'b'))
+            with self.assertRaises(TimeoutError):
+                await chosen.get(0.01)
+
+        asyncio.run(inner())
+
+    def test_slow_subscriber_dropped(self):
+        async def inner():
+            slow = self.events.subscribe()
+            fast = self.events.subscribe()
+            for i in range(6):
+                self.events.publish({'submit_id': str(i)})
+                await fast.get(0.1)
+            self.assertTrue(slow.dropped)
+            self.assertIsNone(await slow.get(0.1))
+            self.assertFalse(fast.dropped)
+            self.assertEqual(self.metrics.counter('events.dropped_subscribers').value, 1)
+            self.assertEqual(self.metrics.gauge('events.subscribers').value, 1)
+
+        asyncio.run(inner())
+
+    def test_max_subscribers(self):
+        subscription = self.events.subscribe()
+        self.events.subscribe()
+        with self.assertRaises(EventBus.TooManySubscribers):
+            self.events.subscribe()
+        self.events.unsubscribe(subscription)
+        self.events.subscribe()
+
+    def test_state_changes(self):
+        events = EventBus(buffer_size=100, max_subscribers=1, metrics=self.metrics)
+        data_master = DataMaster(TaskSubmit, SetSubmit, logging.Logger('test'), events=events)
+
+        async def inner():
+            subscription = events.subscribe({'submit1'})
+            task_submit = data_master.new_task_submit('submit1', self.resource_dir / '1', '1',
+                                                      self.resource_dir / '1' / '1' / 'prog' / 'solution.cpp')
+            await task_submit.initialise()
+            task_submit.change_state(TaskSubmit.TaskState.AWAITING_SETS, requires=TaskSubmit.TaskState.INITIAL)
+            set_submit = task_submit.set_submits[0]
+            set_submit.change_state(SetSubmit.SetState.SENDING_TO_KOLEJKA, requires=SetSubmit.SetState.INITIAL)
+            return [await subscription.get(0.1) for _ in range(2)], set_submit.set_name
+
+        (task_event, set_event), set_name = asyncio.run(inner())
+        self.assertEqual((task_event['set'], task_event['from'], task_event['to']),
+                         (None, 'INITIAL', 'AWAITING_SETS'))
+        self.assertEqual((set_event['set'], set_event['from'], set_event['to']),
+                         (set_name, 'INITIAL', 'SENDING_TO_KOLEJKA'))
+
+
+if __name__ == '__main__':
+    unittest.main()
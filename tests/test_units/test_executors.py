@@ -0,0 +1,69 @@
+import asyncio
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from baca2PackageManager import set_base_dir, add_supported_extensions
+
+from settings import BUILD_NAMESPACE
+from app.broker.executors import Executors
+from app.broker.metrics import MetricsRegistry
+from app.broker.work_units import build_package, load_package, parse_results
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class ExecutorsTest(unittest.TestCase):
+    resource_dir = Path(__file__).absolute().parent.parent / 'resources'
+
+    RESULTS_YAML = """
+'1':
+  satori:
+    status: OK
+    execute_time_real: 0.5s
+    execute_time_cpu: 0.4s
+    execute_memory: 1024B
+"""
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.executors = Executors(io_workers=2, cpu_workers=1, metrics=self.metrics)
+
+    def tearDown(self):
+        self.executors.shutdown()
+
+    def test_io(self):
+        thread_name = asyncio.run(self.executors.run_io(lambda: threading.current_thread().name))
+        self.assertTrue(thread_name.startswith('broker-io'))
+        self.assertEqual(self.metrics.histogram('executors.io.run_seconds').count, 1)
+
+    def test_work_units_in_process(self):
+        async def inner():
+            package = await self.executors.run_cpu(load_package, self.resource_dir / '1', '1')
+            await self.executors.run_cpu(build_package, package, None)
+            return package
+
+        package = asyncio.run(inner())
+        self.assertEqual(sorted(s['name'] for s in package.sets()), ['set0', 'set1', 'set2'])
+        self.assertTrue(package.check_build(BUILD_NAMESPACE))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            result_dir = Path(tmp)
+            (result_dir / 'results').mkdir()
+            (result_dir / 'results' / 'results.yaml').write_text(self.RESULTS_YAML)
+            result = asyncio.run(self.executors.run_cpu(parse_results, 'set0', result_dir))
+        self.assertEqual(result.name, 'set0')
+        self.assertEqual(result.tests['1'].time_real, 0.5)
+        self.assertEqual(self.metrics.histogram('executors.cpu.run_seconds').count, 3)
+
+    def test_no_cpu_workers(self):
+        executors = Executors(io_workers=1, cpu_workers=0, metrics=self.metrics)
+        thread_name = asyncio.run(executors.run_cpu(lambda: threading.current_thread().name))
+        self.assertTrue(thread_name.startswith('broker-io'))
+        executors.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
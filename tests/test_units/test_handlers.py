@@ -1,17 +1,26 @@
 import asyncio
 import os
+import shutil
+import tempfile
 import unittest
-from datetime import timedelta
+from datetime import datetime, timedelta
 from pathlib import Path
 
 from baca2PackageManager import Package
-from baca2PackageManager.broker_communication import SetResult, BacaToBroker
+from baca2PackageManager.broker_communication import SetResult, TestResult, BacaToBroker
 
 import settings
 from app.broker import BrokerMaster
+from app.broker.breaker import CircuitBreaker, DispatchBuffer
+from app.broker.cache import ResultCacheInterface
 from app.broker.datamaster import DataMaster, SetSubmit, TaskSubmit, SetSubmitInterface, TaskSubmitInterface
 from app.broker.messenger import KolejkaMessengerInterface, BacaMessengerInterface, PackageManagerInterface
+from app.broker.durable_queue import DurableQueue
+from app.broker.master import DispatchLimit
+from app.broker.metrics import MetricsRegistry
+from app.broker.planner import TaskPlan
 from app.handlers import PassiveHandler, ActiveHandler
+from app.jobs import JobQueue
 from app.logger import LoggerManager
 
 
@@ -42,22 +51,35 @@ class MasterTest(unittest.TestCase):
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
             self.raise_exception = False
+            self.errors = []
 
         async def send_error(self, task_submit: TaskSubmitInterface, error: Exception) -> bool:
             await asyncio.sleep(0.01)
+            self.errors.append(task_submit.submit_id)
 
         async def send(self, task_submit: TaskSubmitInterface):
             await asyncio.sleep(0.01)
             if self.raise_exception:
                 raise Exception
 
+        async def encode(self, task_submit: TaskSubmitInterface) -> bytes:
+            return task_submit.submit_id.encode()
+
+        async def send_encoded(self, submit_id: str, data: bytes) -> int:
+            return 200
+
     class PackageManagerMock(PackageManagerInterface):
 
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.checked = 0
+
         async def check_build(self, package: Package) -> bool:
             await asyncio.sleep(0.01)
+            self.checked += 1
             return False
 
-        async def build_package(self, package: TaskSubmitInterface):
+        async def build_package(self, package: Package, plan: TaskPlan | None = None):
             await asyncio.sleep(0.01)
 
     def setUp(self):
@@ -120,6 +142,320 @@ class MasterTest(unittest.TestCase):
         set_submit = task_submit.set_submits[0]
         set_id = task_submit.make_set_submit_id(task_submit.submit_id, set_submit.set_name)
 
+    def test_duplicated_callbacks(self):
+        btb = BacaToBroker(pass_hash='x',
+                           submit_id='submit1',
+                           package_path=str(self.package_path),
+                           commit_id='1',
+                           submit_path=str(self.submit_path))
+        asyncio.run(self.handlers.handle_baca(btb))
+        task_submit = self.data_master.task_submits['submit1']
+
+        async def callbacks():
+            for set_submit in task_submit.set_submits:
+                await asyncio.gather(*[self.handlers.handle_kolejka(set_submit.submit_id) for _ in range(3)])
+            # retried callback after the submit is finished
+            await self.handlers.handle_kolejka(task_submit.set_submits[0].submit_id)
+
+        asyncio.run(callbacks())
+        self.assertEqual(task_submit.state, TaskSubmit.TaskState.DONE)
+        for set_submit in task_submit.set_submits:
+            self.assertEqual(set_submit.state, SetSubmit.SetState.DONE)
+
+    def test_parked_callback(self):
+        async def inner():
+            task_submit = self.data_master.new_task_submit('submit1', self.package_path, '1', self.submit_path)
+            await task_submit.initialise()
+            set_submit = task_submit.set_submits[0]
+            callback = asyncio.create_task(self.handlers.handle_kolejka(set_submit.submit_id))
+            await asyncio.sleep(0.01)
+            self.assertEqual(set_submit.state, SetSubmit.SetState.INITIAL)
+            await self.master.process_new_task_submit(task_submit)
+            await callback
+            self.assertEqual(set_submit.state, SetSubmit.SetState.DONE)
+
+        asyncio.run(inner())
+
+    def test_parked_callback_timeout(self):
+        handlers = PassiveHandler(self.master, self.logger, park_timeout=timedelta(seconds=0.05))
+
+        async def inner():
+            task_submit = self.data_master.new_task_submit('submit1', self.package_path, '1', self.submit_path)
+            await task_submit.initialise()
+            set_submit = task_submit.set_submits[0]
+            await handlers.handle_kolejka(set_submit.submit_id)
+            self.assertEqual(set_submit.state, SetSubmit.SetState.INITIAL)
+            self.assertTrue(set_submit.submit_id not in handlers.callback_window)
+
+        asyncio.run(inner())
+
+    def test_baca_batch(self):
+        btb_list = [BacaToBroker(pass_hash='x',
+                                 submit_id=f'submit{i}',
+                                 package_path=str(self.package_path),
+                                 commit_id='1',
+                                 submit_path=str(self.submit_path)) for i in range(10)]
+        asyncio.run(self.handlers.handle_baca_batch(btb_list))
+        self.assertEqual(self.package_manager.checked, 1)
+        self.assertEqual(len(self.data_master.task_submits), 10)
+        self.assertEqual(len(self.data_master.set_submits), 30)
+        for task_submit in self.data_master.task_submits.values():
+            self.assertEqual(task_submit.state, TaskSubmit.TaskState.AWAITING_SETS)
+        self.assertIs(self.data_master.task_submits['submit0'].package,
+                      self.data_master.task_submits['submit9'].package)
+
+    def test_baca_batch_queued(self):
+        btb_list = [BacaToBroker(pass_hash='x',
+                                 submit_id=f'submit{i}',
+                                 package_path=str(self.package_path),
+                                 commit_id='1',
+                                 submit_path=str(self.submit_path)) for i in range(10)]
+
+        async def inner():
+            intake = JobQueue('intake', 2, 100, self.logger, MetricsRegistry())
+            handlers = PassiveHandler(self.master, self.logger, intake_queue=intake)
+            intake.start()
+            intake.submit(handlers.handle_baca_batch, btb_list)
+            await intake.stop(5)
+
+        asyncio.run(inner())
+        self.assertEqual(self.package_manager.checked, 1)
+        for task_submit in self.data_master.task_submits.values():
+            self.assertEqual(task_submit.state, TaskSubmit.TaskState.AWAITING_SETS)
+        self.assertEqual(len(self.data_master.task_submits), 10)
+
+    def test_baca_batch_package_error(self):
+        btb_list = [BacaToBroker(pass_hash='x',
+                                 submit_id=f'submit{i}',
+                                 package_path=str(self.resource_dir / 'nonexistent'),
+                                 commit_id='1',
+                                 submit_path=str(self.submit_path)) for i in range(3)]
+        asyncio.run(self.handlers.handle_baca_batch(btb_list))
+        self.assertEqual(len(self.data_master.task_submits), 0)
+        self.assertEqual(sorted(self.baca_messenger.errors), ['submit0', 'submit1', 'submit2'])
+
+    def test_trash_uninitialised(self):
+        task_submit = self.data_master.new_task_submit('submit1', self.package_path, '1', self.submit_path)
+        asyncio.run(self.master.trash_task_submit(task_submit, Exception('error')))
+        self.assertEqual(task_submit.state, TaskSubmit.TaskState.ERROR)
+        self.assertTrue('submit1' not in self.data_master.task_submits)
+        self.assertEqual(self.baca_messenger.errors, ['submit1'])
+
+    def test_dispatch_limit(self):
+        limit = DispatchLimit(10, metrics=MetricsRegistry())
+        self.master.dispatch_limit = limit
+        btb = BacaToBroker(pass_hash='x',
+                           submit_id='submit1',
+                           package_path=str(self.package_path),
+                           commit_id='1',
+                           submit_path=str(self.submit_path))
+        asyncio.run(self.handlers.handle_baca(btb))
+        self.assertEqual(limit.outstanding, 1)
+        task_submit = self.data_master.task_submits['submit1']
+        asyncio.run(self.master.trash_task_submit(task_submit, None))
+        self.assertEqual(limit.outstanding, 0)
+
+    def test_result_cache(self):
+        class ResultCacheMock(ResultCacheInterface):
+            def __init__(self):
+                self.results = {}
+
+            async def get(self, set_submit: SetSubmitInterface) -> SetResult | None:
+                return self.results.get(set_submit.set_name)
+
+            async def put(self, set_submit: SetSubmitInterface, result: SetResult):
+                self.results[set_submit.set_name] = result
+
+        class KolejkaMessengerMockInner(MasterTest.KolejkaMessengerMock):
+            def __init__(self):
+                super().__init__()
+                self.sent = 0
+
+            async def send(self, set_submit: SetSubmitInterface):
+                self.sent += 1
+                await super().send(set_submit)
+
+            async def get_results(self, set_submit: SetSubmitInterface):
+                set_submit.set_result(await super().get_results(set_submit))
+
+        kolejka_messenger = KolejkaMessengerMockInner()
+        master = BrokerMaster(self.data_master,
+                              kolejka_messenger,
+                              self.baca_messenger,
+                              self.package_manager,
+                              self.logger,
+                              result_cache=ResultCacheMock())
+        handlers = PassiveHandler(master, self.logger)
+        btb = BacaToBroker(pass_hash='x',
+                           submit_id='submit1',
+                           package_path=str(self.package_path),
+                           commit_id='1',
+                           submit_path=str(self.submit_path))
+        asyncio.run(handlers.handle_baca(btb))
+        task_submit = self.data_master.task_submits['submit1']
+        for set_submit in task_submit.set_submits:
+            asyncio.run(handlers.handle_kolejka(set_submit.submit_id))
+        self.assertEqual(task_submit.state, TaskSubmit.TaskState.DONE)
+        self.assertEqual(kolejka_messenger.sent, 3)
+
+        btb.submit_id = 'submit2'
+        asyncio.run(handlers.handle_baca(btb))
+        self.assertEqual(kolejka_messenger.sent, 3)
+        self.assertTrue('submit2' not in self.data_master.task_submits)
+
+    def test_unknown_callback_released(self):
+        asyncio.run(self.handlers.handle_kolejka('unknown_set'))
+        self.assertTrue('unknown_set' not in self.handlers.callback_window)
+
+    def test_fail_held_only_if_not_dispatched(self):
+        class KolejkaMessengerMockInner(MasterTest.KolejkaMessengerMock):
+            def __init__(self, failing: set[str], error: type[Exception]):
+                super().__init__()
+                self.failing = failing
+                self.error = error
+
+            async def send(self, set_submit: SetSubmitInterface):
+                await asyncio.sleep(0.01)
+                if set_submit.set_name in self.failing:
+                    raise self.error('Kolejka unavailable')
+                set_submit.set_status_code('200')
+
+        def run(submit_id: str, failing: set[str], error: type[Exception] = ConnectionError) -> int:
+            tmp = Path(tempfile.mkdtemp())
+            breaker = CircuitBreaker('test', failure_threshold=100, recovery_timeout=1.0,
+                                     max_recovery_timeout=1.0, logger=self.logger, metrics=MetricsRegistry())
+            queue = DurableQueue(tmp, max_items=10, fsync=False, metrics=MetricsRegistry())
+            buffer = DispatchBuffer(breaker, queue, replay_rate=1.0, logger=self.logger, metrics=MetricsRegistry())
+            master = BrokerMaster(self.data_master, KolejkaMessengerMockInner(failing, error), self.baca_messenger,
+                                  self.package_manager, self.logger)
+            handlers = PassiveHandler(master, self.logger, buffer=buffer)
+            btb = BacaToBroker(pass_hash='x',
+                               submit_id=submit_id,
+                               package_path=str(self.package_path),
+                               commit_id='1',
+                               submit_path=str(self.submit_path))
+            asyncio.run(handlers.handle_baca(btb))
+            shutil.rmtree(tmp)
+            return len(queue)
+
+        # no set got to Kolejka - held and replayed later
+        self.assertEqual(run('submit1', {'set0', 'set1', 'set2'}), 1)
+        self.assertEqual(self.baca_messenger.errors, [])
+        # some sets are already in Kolejka - failed, as their callbacks would go to the replayed submit
+        self.assertEqual(run('submit2', {'set1'}, ValueError), 0)
+        self.assertEqual(self.baca_messenger.errors, ['submit2'])
+        self.assertEqual(len(self.data_master.task_submits), 0)
+        # retries of a single set ran out - only that set fails
+        self.assertEqual(run('submit3', {'set1'}), 0)
+        self.assertEqual(self.baca_messenger.errors, ['submit2'])
+        task_submit = self.data_master.task_submits['submit3']
+        self.assertEqual(task_submit.state, TaskSubmit.TaskState.AWAITING_SETS)
+        states = {s.set_name: s.state for s in task_submit.set_submits}
+        self.assertEqual(states, {'set0': SetSubmit.SetState.AWAITING_KOLEJKA, 'set1': SetSubmit.SetState.DONE,
+                                  'set2': SetSubmit.SetState.AWAITING_KOLEJKA})
+        set1 = next(s for s in task_submit.set_submits if s.set_name == 'set1')
+        statuses = {t.status for t in set1.get_result().tests.values()}
+        self.assertEqual(statuses, {BrokerMaster.INTERNAL_ERROR_STATUS})
+
+    def test_get_results_retries_exhausted(self):
+        class KolejkaMessengerMockInner(MasterTest.KolejkaMessengerMock):
+            async def get_results(self, set_submit: SetSubmitInterface):
+                if set_submit.set_name == 'set0':
+                    raise KolejkaMessengerInterface.KolejkaCommunicationError('Cannot communicate with KOLEJKA.') \
+                        from ConnectionError('Kolejka unavailable')
+                set_submit.set_result(SetResult(name=set_submit.set_name, tests={}))
+
+        self.master.kolejka_messenger = KolejkaMessengerMockInner()
+        btb = BacaToBroker(pass_hash='x',
+                           submit_id='submit1',
+                           package_path=str(self.package_path),
+                           commit_id='1',
+                           submit_path=str(self.submit_path))
+        asyncio.run(self.handlers.handle_baca(btb))
+        task_submit = self.data_master.task_submits['submit1']
+        for set_submit in task_submit.set_submits:
+            asyncio.run(self.handlers.handle_kolejka(set_submit.submit_id))
+        # results of the other sets are sent, the submit is not trashed
+        self.assertEqual(self.baca_messenger.errors, [])
+        self.assertNotIn('submit1', self.data_master.task_submits)
+
+    def test_compile_error(self):
+        class KolejkaMessengerMockInner(MasterTest.KolejkaMessengerMock):
+            async def get_results(self, set_submit: SetSubmitInterface):
+                tests = {'1': TestResult(name='1', status='CME', logs={'compile_log': 'error'})}
+                set_submit.set_result(SetResult(name=set_submit.set_name, tests=tests))
+
+        self.master.kolejka_messenger = KolejkaMessengerMockInner()
+        btb = BacaToBroker(pass_hash='x',
+                           submit_id='submit1',
+                           package_path=str(self.package_path),
+                           commit_id='1',
+                           submit_path=str(self.submit_path))
+        asyncio.run(self.handlers.handle_baca(btb))
+        task_submit = self.data_master.task_submits['submit1']
+        first, *others = task_submit.set_submits
+        asyncio.run(self.handlers.handle_kolejka(first.submit_id))
+        self.assertEqual(task_submit.state, TaskSubmit.TaskState.DONE)
+        self.assertTrue('submit1' not in self.data_master.task_submits)
+        for set_submit in others:
+            result = set_submit.get_result()
+            self.assertGreater(len(result.tests), 0)
+            self.assertTrue(all(t.status == 'CME' for t in result.tests.values()))
+            self.assertEqual(list(result.tests.values())[0].logs['compile_log'], 'error')
+
+        # late callbacks of skipped sets are dropped
+        asyncio.run(self.handlers.handle_kolejka(others[0].submit_id))
+
+    def compile_error_submit(self, logs: dict) -> TaskSubmitInterface:
+        class KolejkaMessengerMockInner(MasterTest.KolejkaMessengerMock):
+            async def get_results(self, set_submit: SetSubmitInterface):
+                tests = {'1': TestResult(name='1', status='CME', logs=logs)}
+                set_submit.set_result(SetResult(name=set_submit.set_name, tests=tests))
+
+        self.master.kolejka_messenger = KolejkaMessengerMockInner()
+        btb = BacaToBroker(pass_hash='x',
+                           submit_id='submit1',
+                           package_path=str(self.package_path),
+                           commit_id='1',
+                           submit_path=str(self.submit_path))
+        asyncio.run(self.handlers.handle_baca(btb))
+        return self.data_master.task_submits['submit1']
+
+    def test_compile_error_other_set_settings(self):
+        task_submit = self.compile_error_submit({'compile_log': 'error'})
+        task_submit.package.sets('set2')._settings['basename'] = 'other.cpp'
+        first, *others = task_submit.set_submits
+        asyncio.run(self.handlers.handle_kolejka(first.submit_id))
+        # set compiled with other settings is still run
+        states = {s.set_name: s.state for s in others}
+        self.assertEqual(states, {'set1': SetSubmit.SetState.DONE, 'set2': SetSubmit.SetState.AWAITING_KOLEJKA})
+
+    def test_compile_error_other_settings(self):
+        task_submit = self.compile_error_submit({'compile_log': 'error'})
+        for test in task_submit.package.sets('set2').tests():
+            test._settings['cpp_standard'] = 'c++20'
+        first, *others = task_submit.set_submits
+        asyncio.run(self.handlers.handle_kolejka(first.submit_id))
+        # set compiled with other settings is still run
+        states = {s.set_name: s.state for s in others}
+        self.assertEqual(states, {'set1': SetSubmit.SetState.DONE, 'set2': SetSubmit.SetState.AWAITING_KOLEJKA})
+
+    def test_compile_timeout(self):
+        task_submit = self.compile_error_submit({'compile_log': 'killed', 'compile_time': '9.95s'})
+        first, *others = task_submit.set_submits
+        asyncio.run(self.handlers.handle_kolejka(first.submit_id))
+        # compilation may pass in other sets
+        self.assertTrue(all(s.state == SetSubmit.SetState.AWAITING_KOLEJKA for s in others))
+
+    def test_compile_time_of_set(self):
+        task_submit = self.compile_error_submit({'compile_log': 'error', 'compile_time': '9.95s'})
+        first, *others = task_submit.set_submits
+        for t_set in task_submit.package.sets():
+            t_set._settings['compile_time'] = '30s'
+        asyncio.run(self.handlers.handle_kolejka(first.submit_id))
+        # far below the time limit of the set
+        self.assertTrue(all(s.state == SetSubmit.SetState.DONE for s in others))
+
     def test_trash_submit(self):
         btb = BacaToBroker(pass_hash='x',
                            submit_id='submit1',
@@ -160,6 +496,12 @@ class MasterTest(unittest.TestCase):
                 self.processed.append(task_submit.submit_id)
                 await asyncio.sleep(0.01)
 
+            async def encode(self, task_submit: TaskSubmitInterface) -> bytes:
+                return task_submit.submit_id.encode()
+
+            async def send_encoded(self, submit_id: str, data: bytes) -> int:
+                return 200
+
         class KolejkaMessengerMockInner(KolejkaMessengerInterface):
 
             def __init__(self, *args, **kwargs):
@@ -208,6 +550,49 @@ class MasterTest(unittest.TestCase):
         self.assertTrue(len(self.data_master.task_submits) == 0)
         self.assertEqual(100, len(baca_messenger.processed))
 
+    def test_polling_daemon(self):
+        class KolejkaMessengerMockInner(MasterTest.KolejkaMessengerMock):
+            def __init__(self):
+                super().__init__()
+                self.polls = 0
+                self.finished = False
+
+            async def poll(self, set_submit: SetSubmitInterface) -> bool:
+                self.polls += 1
+                return self.finished
+
+        self.master.kolejka_messenger = KolejkaMessengerMockInner()
+        btb = BacaToBroker(pass_hash='x',
+                           submit_id='submit1',
+                           package_path=str(self.package_path),
+                           commit_id='1',
+                           submit_path=str(self.submit_path))
+        asyncio.run(self.handlers.handle_baca(btb))
+        task_submit = self.data_master.task_submits['submit1']
+        for set_submit in task_submit.set_submits:
+            self.assertEqual(set_submit.state, SetSubmit.SetState.AWAITING_KOLEJKA)
+            set_submit.mod_date -= timedelta(minutes=2)
+
+        polling_args = (timedelta(minutes=1), 2, timedelta(minutes=4))
+        asyncio.run(self.master._polling_daemon_body(*polling_args))
+        self.assertEqual(self.master.kolejka_messenger.polls, 2)
+        asyncio.run(self.master._polling_daemon_body(*polling_args))
+        self.assertEqual(self.master.kolejka_messenger.polls, 3)
+        # polled set submits back off
+        asyncio.run(self.master._polling_daemon_body(*polling_args))
+        self.assertEqual(self.master.kolejka_messenger.polls, 3)
+        self.assertTrue(all(backoff == timedelta(minutes=2)
+                            for _, backoff in self.master._poll_schedule.values()))
+
+        self.master.kolejka_messenger.finished = True
+        for submit_id, (_, backoff) in self.master._poll_schedule.items():
+            self.master._poll_schedule[submit_id] = (datetime.now(), backoff)
+        asyncio.run(self.master._polling_daemon_body(*polling_args))
+        asyncio.run(self.master._polling_daemon_body(*polling_args))
+        self.assertEqual(task_submit.state, TaskSubmit.TaskState.DONE)
+        self.assertTrue('submit1' not in self.data_master.task_submits)
+        self.assertEqual(self.master._poll_schedule, {})
+
     def test_start_daemons(self):
         async def inner():
             task_submit_new = self.data_master.new_task_submit("submit_id_new",
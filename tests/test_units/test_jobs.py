@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import unittest
+
+from app.broker.master import DispatchLimit
+from app.broker.metrics import MetricsRegistry
+from app.jobs import JobQueue, JobQueues
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.Logger('test')
+        self.metrics = MetricsRegistry()
+
+    def test_concurrency_limit(self):
+        running = 0
+        max_running = 0
+
+        async def job():
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        async def inner():
+            queue = JobQueue('test', workers=3, max_size=100, logger=self.logger, metrics=self.metrics)
+            queue.start()
+            for _ in range(20):
+                queue.submit(job)
+            await queue.stop()
+
+        asyncio.run(inner())
+        self.assertEqual(max_running, 3)
+        self.assertEqual(self.metrics.counter('jobs.test.processed').value, 20)
+        self.assertEqual(self.metrics.histogram('jobs.test.wait_seconds').count, 20)
+
+    def test_queue_full(self):
+        async def job():
+            await asyncio.sleep(0.01)
+
+        async def inner():
+            queue = JobQueue('test', workers=1, max_size=2, logger=self.logger, metrics=self.metrics)
+            queue.submit(job)
+            queue.submit(job)
+            with self.assertRaises(JobQueue.QueueFullError):
+                queue.submit(job)
+            self.assertEqual(self.metrics.gauge('jobs.test.queue_length').value, 2)
+            self.assertEqual(self.metrics.counter('jobs.test.rejected').value, 1)
+
+        asyncio.run(inner())
+
+    def test_stop_drains(self):
+        done = []
+
+        async def job(i):
+            await asyncio.sleep(0.01)
+            done.append(i)
+
+        async def inner():
+            queue = JobQueue('test', workers=2, max_size=100, logger=self.logger, metrics=self.metrics)
+            queue.start()
+            for i in range(10):
+                queue.submit(job, i)
+            await queue.stop()
+            self.assertFalse(queue.running)
+            with self.assertRaises(JobQueue.QueueClosedError):
+                queue.submit(job, 10)
+
+        asyncio.run(inner())
+        self.assertEqual(sorted(done), list(range(10)))
+
+    def test_failing_job(self):
+        async def job():
+            raise ValueError('test')
+
+        async def inner():
+            queue = JobQueue('test', workers=1, max_size=10, logger=self.logger, metrics=self.metrics)
+            queue.start()
+            queue.submit(job)
+            queue.submit(job)
+            await queue.stop()
+
+        asyncio.run(inner())
+        self.assertEqual(self.metrics.counter('jobs.test.failed').value, 2)
+
+    def test_job_queues(self):
+        async def inner():
+            queues = JobQueues(workers={kind: 1 for kind in JobQueues.KINDS},
+                               max_sizes={kind: 1 for kind in JobQueues.KINDS},
+                               logger=self.logger,
+                               metrics=self.metrics)
+            queues.start()
+            for kind in JobQueues.KINDS:
+                self.assertTrue(queues[kind].running)
+            await queues.stop()
+            for kind in JobQueues.KINDS:
+                self.assertFalse(queues[kind].running)
+
+        asyncio.run(inner())
+
+
+class FairQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.Logger('test')
+        self.metrics = MetricsRegistry()
+
+    def run_jobs(self, jobs: list[tuple[str, str, float]],
+                 tenant_weights: dict[str, float] | None = None) -> list[tuple[str, str]]:
+        order = []
+
+        async def job(priority, tenant):
+            order.append((priority, tenant))
+
+        async def inner():
+            queue = JobQueue('test', workers=1, max_size=100, logger=self.logger, metrics=self.metrics,
+                             priorities=['exam', 'interactive', 'rejudge'],
+                             tenant_weights=tenant_weights)
+            for priority, tenant, cost in jobs:
+                queue.submit(job, priority, tenant, priority=priority, tenant=tenant, cost=cost)
+            queue.start()
+            await queue.stop()
+
+        asyncio.run(inner())
+        return order
+
+    def test_priority_classes(self):
+        order = self.run_jobs([('rejudge', 'a', 1), ('interactive', 'a', 1), ('exam', 'b', 1)])
+        self.assertEqual([p for p, _ in order], ['exam', 'interactive', 'rejudge'])
+        self.assertEqual(self.metrics.histogram('jobs.test.exam.wait_seconds').count, 1)
+
+    def test_fair_share(self):
+        jobs = [('rejudge', 'a', 1)] * 6 + [('rejudge', 'b', 1)] * 2
+        order = self.run_jobs(jobs)
+        # b is not starved by the earlier jobs of a
+        self.assertEqual([t for _, t in order[:4]], ['a', 'b', 'a', 'b'])
+
+    def test_weights_and_cost(self):
+        jobs = [('rejudge', 'a', 1)] * 4 + [('rejudge', 'b', 1)] * 4
+        order = self.run_jobs(jobs, tenant_weights={'a': 3.0})
+        self.assertEqual([t for _, t in order[:4]], ['a', 'a', 'a', 'b'])
+
+        order = self.run_jobs([('rejudge', 'a', 3), ('rejudge', 'b', 1), ('rejudge', 'b', 1)])
+        self.assertEqual([t for _, t in order], ['b', 'b', 'a'])
+
+    def test_default_and_unknown_priority(self):
+        async def job():
+            pass
+
+        async def inner():
+            queue = JobQueue('test', workers=1, max_size=10, logger=self.logger, metrics=self.metrics,
+                             priorities=['exam', 'rejudge'])
+            with self.assertRaises(ValueError):
+                queue.submit(job, priority='other')
+            queue.submit(job)
+            queue.start()
+            await queue.stop()
+
+        asyncio.run(inner())
+        self.assertEqual(self.metrics.histogram('jobs.test.rejudge.wait_seconds').count, 1)
+
+    def test_dispatch_limit(self):
+        limit = DispatchLimit(2, metrics=self.metrics)
+        dispatched = []
+
+        async def job(submit_id):
+            # submit stays outstanding after the job, until it is finished
+            limit.add(submit_id)
+            dispatched.append(submit_id)
+
+        async def inner():
+            queue = JobQueue('test', workers=4, max_size=10, logger=self.logger, metrics=self.metrics,
+                             priorities=['exam', 'rejudge'], dispatch_limit=limit)
+            queue.start()
+            for i in range(4):
+                queue.submit(job, f'rejudge{i}', priority='rejudge')
+            await asyncio.sleep(0.01)
+            self.assertEqual(dispatched, ['rejudge0', 'rejudge1'])
+            self.assertEqual(self.metrics.gauge('dispatch.outstanding').value, 2)
+            # submit of a higher class goes first once there is room
+            queue.submit(job, 'exam0', priority='exam')
+            limit.discard('rejudge0')
+            await asyncio.sleep(0.01)
+            self.assertEqual(dispatched[2:], ['exam0'])
+            limit.retain([])
+            await queue.stop(1)
+
+        asyncio.run(inner())
+        self.assertEqual(dispatched[3:], ['rejudge2', 'rejudge3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import importlib.util
+import sys
+import tempfile
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+JUDGE_PATH = Path(__file__).absolute().parent.parent.parent / 'judges' / 'judge_build_once.py'
+
+
+class TaskStub:
+    """Step of kolejka-judge, resolves paths against the working directory of the test."""
+    cwd = Path('.')
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+    def resolve_path(self, path) -> Path:
+        return self.cwd / path
+
+    def execute(self):
+        return None, None
+
+
+def kolejka_stubs() -> dict[str, types.ModuleType]:
+    """Modules of kolejka-judge used by the judge (it is available only on Kolejka)."""
+    modules = {name: types.ModuleType(name) for name in ('kolejka', 'kolejka.judge', 'kolejka.judge.commands',
+                                                          'kolejka.judge.parse', 'kolejka.judge.tasks')}
+    parse = modules['kolejka.judge.parse']
+    parse.parse_time = parse.parse_memory = parse.parse_bool = lambda value: value
+    tasks = modules['kolejka.judge.tasks']
+    tasks.TaskBase = TaskStub
+    for name in ('SystemPrepareTask', 'SolutionPrepareTask', 'SolutionSourceRulesTask', 'SolutionBuildAutoTask',
+                 'SolutionBuildCMakeTask', 'SolutionBuildMakeTask', 'SolutionBuildGXXTask', 'SolutionBuildGCCTask',
+                 'SolutionBuildPython3ScriptTask', 'SolutionBuildRulesTask', 'SingleIOTask', 'CollectDebugTask',
+                 'CollectLogsTask'):
+        setattr(tasks, name, type(name, (TaskStub,), {}))
+    return modules
+
+
+def load_judge() -> types.ModuleType:
+    spec = importlib.util.spec_from_file_location('judge_build_once', JUDGE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.dict(sys.modules, kolejka_stubs()):
+        spec.loader.exec_module(module)
+    return module
+
+
+judge = load_judge()
+
+
+class ArgsStub:
+    """Runs steps in order until the first one that fails, as kolejka-judge does."""
+
+    def __init__(self, solution: Path, test: dict, failing: str | None = None, build: bool = True):
+        self.id = '1'
+        self.solution = solution
+        self.test = test
+        self.failing = failing
+        self.build = build
+        self.steps = {}
+
+    def add_steps(self, **steps):
+        self.steps.update(steps)
+
+    def run(self):
+        for name, step in self.steps.items():
+            if name == 'builder' and self.build:
+                build = step.resolve_path(judge.BUILD_DIRECTORY)
+                build.mkdir(parents=True, exist_ok=True)
+                (build / 'a.out').write_text('binary')
+            if name == self.failing:
+                return types.SimpleNamespace(status='CME' if name == 'builder' else 'RUL')
+            step.execute()
+        return types.SimpleNamespace(status='OK')
+
+
+class JudgeBuildOnceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.solution = self.root / 'solution.cpp'
+        self.solution.write_text('int main() {}')
+        self.cache_dir = self.root / 'cache'
+        patch_cache = mock.patch.object(judge, 'BUILD_CACHE_DIR', self.cache_dir)
+        patch_cwd = mock.patch.object(TaskStub, 'cwd', self.root / 'test1')
+        patch_cache.start()
+        patch_cwd.start()
+        self.addCleanup(patch_cache.stop)
+        self.addCleanup(patch_cwd.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_judge(self, test: dict | None = None, **kwargs) -> ArgsStub:
+        args = ArgsStub(self.solution, test or {}, **kwargs)
+        judge.judge(args)
+        return args
+
+    def test_build_key(self):
+        key = judge.build_key(ArgsStub(self.solution, {}), ('main.cpp', None))
+        self.assertEqual(key, judge.build_key(ArgsStub(self.solution, {}), ('main.cpp', None)))
+        self.assertNotEqual(key, judge.build_key(ArgsStub(self.solution, {}), ('other.cpp', None)))
+        self.solution.write_text('int main() { return 1; }')
+        self.assertNotEqual(key, judge.build_key(ArgsStub(self.solution, {}), ('main.cpp', None)))
+
+    def test_cache_miss_and_hit(self):
+        first = self.run_judge()
+        self.assertIn('builder', first.steps)
+        self.assertNotIn('restore', first.steps)
+        self.assertEqual(len(list(self.cache_dir.iterdir())), 1)
+
+        with mock.patch.object(TaskStub, 'cwd', self.root / 'test2'):
+            second = self.run_judge(build=False)
+        self.assertIn('restore', second.steps)
+        self.assertNotIn('builder', second.steps)
+        self.assertNotIn('build_rules', second.steps)
+        restored = self.root / 'test2' / judge.BUILD_DIRECTORY / 'a.out'
+        self.assertEqual(restored.read_text(), 'binary')
+
+    def test_rule_limits_in_key(self):
+        self.run_judge()
+        # the cached build passed other rules
+        for test in ({'binary_size': '1K'}, {'source_size': '1K'}, {'regex_count': 'goto,1'}):
+            with self.subTest(test=test):
+                self.assertIn('builder', self.run_judge(test).steps)
+
+    def test_failure_not_cached(self):
+        for failing in ('source_rules', 'builder', 'build_rules'):
+            with self.subTest(failing=failing):
+                self.run_judge(failing=failing)
+                self.assertFalse(self.cache_dir.exists())
+                self.assertIn('builder', self.run_judge(failing=failing).steps)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import types
+import unittest
+import zipfile
+from pathlib import Path
+from unittest import mock
+
+import yaml
+
+JUDGE_PATH = Path(__file__).absolute().parent.parent.parent / 'judges' / 'judge_parallel.py'
+
+
+def parse_memory(value: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip()
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def kolejka_stubs() -> dict[str, types.ModuleType]:
+    """Modules of kolejka-judge used by the judge (it is available only on Kolejka)."""
+    modules = {name: types.ModuleType(name) for name in ('kolejka', 'kolejka.judge', 'kolejka.judge.commands',
+                                                          'kolejka.judge.parse', 'kolejka.judge.tasks')}
+    modules['kolejka.judge.parse'].parse_memory = parse_memory
+    return modules
+
+
+def load_judge() -> types.ModuleType:
+    spec = importlib.util.spec_from_file_location('judge_parallel', JUDGE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.dict(sys.modules, kolejka_stubs()):
+        spec.loader.exec_module(module)
+    return module
+
+
+judge = load_judge()
+
+
+class JudgeParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_claim(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop(judge.CLAIMS_ENV, None)
+            self.assertTrue(judge.claim('1'))  # not run by workers
+
+            os.environ[judge.CLAIMS_ENV] = str(self.root)
+            os.environ[judge.WORKER_ENV] = '3'
+            self.assertTrue(judge.claim('set/1'))
+            self.assertFalse(judge.claim('set/1'))
+            self.assertEqual((self.root / 'set%2F1').read_text(), '3')
+
+    def make_worker(self, index: int, results: dict | None) -> tuple[Path, Path]:
+        worker_cwd = self.root / f'worker{index}'
+        worker_output = worker_cwd / 'out'
+        worker_output.mkdir(parents=True)
+        if results is not None:
+            with open(worker_output / judge.RESULTS_YAML, 'w') as f:
+                yaml.safe_dump(results, f)
+        with zipfile.ZipFile(worker_cwd / 'log.zip', 'w') as log_zip:
+            log_zip.writestr(f'worker{index}.log', 'log')
+        return worker_cwd, worker_output
+
+    def test_merge(self):
+        first = self.make_worker(0, {1: {'satori': {'status': 'OK', 'logs': f'{self.root}/worker0/out/1/logs'}},
+                                     2: {'satori': {'status': 'OK'}}})
+        second = self.make_worker(1, {2: {'satori': {'status': 'WA'}}})
+        (first[1] / '1').mkdir()
+        (first[1] / '2').mkdir()  # left to the other worker
+        (second[1] / '2').mkdir()
+        (second[1] / '2' / 'answer').write_text('answer')
+        cwd = self.root / 'task'
+        cwd.mkdir()
+        output = cwd / 'out'
+
+        judge.merge(['1', '2', '3'], [first, second], output, cwd, {'1': 0, '2': 1, '3': 1})
+        with open(output / judge.RESULTS_YAML) as f:
+            results = yaml.safe_load(f)
+        self.assertEqual(results['1'], {'satori': {'status': 'OK', 'logs': f'{output}/1/logs'}})
+        # results of the worker that claimed the test are used
+        self.assertEqual(results['2'], {'satori': {'status': 'WA'}})
+        self.assertEqual((output / '2' / 'answer').read_text(), 'answer')
+        # claimed, but never judged
+        self.assertEqual(results['3'], {'satori': {'status': 'INT'}})
+        with zipfile.ZipFile(cwd / 'log.zip') as log_zip:
+            self.assertEqual(sorted(log_zip.namelist()), ['worker0.log', 'worker1.log'])
+
+    def test_merge_missing_results(self):
+        workers = [self.make_worker(0, None)]
+        cwd = self.root / 'task'
+        cwd.mkdir()
+        judge.merge(['1'], workers, cwd / 'out', cwd, {})
+        with open(cwd / 'out' / judge.RESULTS_YAML) as f:
+            self.assertEqual(yaml.safe_load(f), {'1': {'satori': {'status': 'INT'}}})
+
+    def test_worker_count(self):
+        tests = {str(i): {'memory': '1G'} for i in range(3)}
+        with mock.patch.dict(sys.modules, kolejka_stubs()), \
+                mock.patch.object(judge, 'memory_limit', lambda: None):
+            self.assertEqual(judge.worker_count(tests, [0, 1, 2, 3]), 3)
+            self.assertEqual(judge.worker_count(tests, [0, 1]), 2)
+            tests['0']['parallel'] = 1
+            self.assertEqual(judge.worker_count(tests, [0, 1, 2, 3]), 1)
+            del tests['0']['parallel']
+            with mock.patch.object(judge, 'memory_limit', lambda: judge.RESERVED_MEMORY + 2 * 1024 ** 3):
+                self.assertEqual(judge.worker_count(tests, [0, 1, 2, 3]), 2)
+
+    def test_set_settings(self):
+        (self.root / 'common').mkdir()
+        (self.root / 'common' / 'test.yaml').write_text("memory: 512MB\n")
+        set_dir = self.root / 'set0'
+        set_dir.mkdir()
+        (set_dir / 'test.yaml').write_text("!include : ../common/test.yaml\nparallel: 2\nmemory: 1G\n")
+        (set_dir / 'tests.yaml').write_text(
+            "'1':\n  !include : test.yaml\n  input: !file '1.in'\n"
+            "'2':\n  !include : test.yaml\n  memory: 2G\n"
+            "'3':\n  !include : test.yaml\n"
+        )
+        tests = judge.load_tests(set_dir / 'tests.yaml')
+        self.assertEqual(list(tests), ['1', '2', '3'])
+        self.assertEqual(tests['1'], {'memory': '1G', 'parallel': 2, 'input': None})
+        self.assertEqual(tests['2']['memory'], '2G')
+        with mock.patch.dict(sys.modules, kolejka_stubs()), \
+                mock.patch.object(judge, 'memory_limit', lambda: None):
+            # set-level value is the default
+            self.assertEqual(judge.worker_count(tests, [0, 1, 2, 3]), 2)
+            # and tests override it
+            tests['3']['parallel'] = 1
+            self.assertEqual(judge.worker_count(tests, [0, 1, 2, 3]), 1)
+
+    def test_allotted_cores(self):
+        # cpus 0 and 2, 1 and 3 are SMT siblings
+        files = {f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list': f'{cpu % 2},{cpu % 2 + 2}'
+                 for cpu in range(4)}
+
+        def read_first(*paths):
+            return next((files[p] for p in paths if p in files), None)
+
+        with mock.patch.object(judge, 'read_first', read_first), \
+                mock.patch.object(judge.os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3}):
+            self.assertEqual(judge.allotted_cores(), [0, 1])
+            files['/sys/fs/cgroup/cpu.max'] = '50000 100000'
+            self.assertEqual(judge.allotted_cores(), [0])
+            files['/sys/fs/cgroup/cpu.max'] = 'max 100000'
+            self.assertEqual(judge.allotted_cores(), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
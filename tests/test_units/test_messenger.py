@@ -1,16 +1,22 @@
 import asyncio
 import logging
+import tempfile
 import unittest
+from pathlib import Path
 from threading import Thread
-from time import sleep
+from time import monotonic, sleep
 
 from fastapi import FastAPI, HTTPException
 import uvicorn
 from baca2PackageManager import Package
-from baca2PackageManager.broker_communication import BrokerToBaca
+from baca2PackageManager.broker_communication import BrokerToBaca, SetResult, TestResult
 
-from app.broker.messenger import BacaMessenger
+from app.broker.commands import CommandResult, CommandRunner
+from app.broker.messenger import BacaMessenger, KolejkaMessenger, BrokerToBacaPartial, encode_message
 from app.broker.datamaster import TaskSubmitInterface, SetSubmitInterface
+from app.broker.metrics import MetricsRegistry
+from app.broker.planner import TaskPlan
+from app.broker.work_units import parse_results
 
 
 app = FastAPI()
@@ -21,11 +27,22 @@ async def success():
     return {"message": "Success"}
 
 
+@app.post("/partial")
+async def partial(message: BrokerToBacaPartial):
+    return {"sequence": message.sequence}
+
+
 @app.post("/success_error")
 async def success_error():
     raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+@app.post("/slow")
+async def slow():
+    await asyncio.sleep(2)
+    return {"message": "Success"}
+
+
 @app.post("/failure")
 async def failure():
     return {"message": "Failure"}
@@ -37,10 +54,17 @@ class MockTaskSubmit(TaskSubmitInterface):
     def results(self) -> dict[str, BrokerToBaca]:
         return {}
 
+    def finished_results(self) -> dict[str, BrokerToBaca]:
+        return {}
+
     @property
     def set_submits(self) -> list[SetSubmitInterface]:
         return []
 
+    @property
+    def plan(self) -> TaskPlan:
+        return TaskPlan.identity([])
+
     @property
     def package(self) -> Package:
         return None
@@ -94,6 +118,53 @@ class BacaMessengerTest(unittest.TestCase):
         with self.assertRaises(Exception):
             asyncio.run(self.baca_messenger.send(task_submit))
 
+    def test_baca_send_encoded(self):
+        task_submit = MockTaskSubmit(master=None, task_submit_id="submit_id", package_path=None,
+                                     commit_id="commit_id",
+                                     submit_path=None)
+        data = asyncio.run(self.baca_messenger.encode(task_submit))
+        self.assertEqual(BrokerToBaca.model_validate_json(data).submit_id, "submit_id")
+        self.assertEqual(asyncio.run(self.baca_messenger.send_encoded("submit_id", data)), 200)
+        self.baca_messenger.baca_success_url = f"http://localhost:{self.TEST_PORT}/success_error"
+        self.assertEqual(asyncio.run(self.baca_messenger.send_encoded("submit_id", data)), 500)
+        self.baca_messenger.baca_success_url = "http://localhost:1/success"
+        with self.assertRaises(BacaMessenger.BacaMessengerError):
+            asyncio.run(self.baca_messenger.send_encoded("submit_id", data))
+
+    def test_baca_send_partial(self):
+        task_submit = MockTaskSubmit(master=None, task_submit_id="submit_id", package_path=None,
+                                     commit_id="commit_id",
+                                     submit_path=None)
+        results = {'set0': SetResult(name='set0', tests={})}
+        # disabled without partial url
+        asyncio.run(self.baca_messenger.send_partial(task_submit, results, 1))
+        self.baca_messenger.baca_partial_url = f"http://localhost:{self.TEST_PORT}/partial"
+        asyncio.run(self.baca_messenger.send_partial(task_submit, results, 1))
+        self.baca_messenger.baca_partial_url = f"http://localhost:{self.TEST_PORT}/success_error"
+        with self.assertRaises(BacaMessenger.BacaMessengerError):
+            asyncio.run(self.baca_messenger.send_partial(task_submit, results, 2))
+
+    def test_baca_timeouts(self):
+        metrics = MetricsRegistry()
+        baca_messenger = BacaMessenger(
+            baca_success_url=f"http://localhost:{self.TEST_PORT}/slow",
+            baca_failure_url=f"http://localhost:{self.TEST_PORT}/slow",
+            password="password",
+            logger=self.logger,
+            timeouts={'send': 0.1, 'error': 0.1},
+            metrics=metrics
+        )
+        task_submit = MockTaskSubmit(master=None, task_submit_id="submit_id", package_path=None,
+                                     commit_id="commit_id",
+                                     submit_path=None)
+        start = monotonic()
+        with self.assertRaises(BacaMessenger.BacaMessengerError):
+            asyncio.run(baca_messenger.send(task_submit))
+        self.assertFalse(asyncio.run(baca_messenger.send_error(task_submit, Exception('test'))))
+        self.assertLess(monotonic() - start, 1.5)
+        self.assertEqual(metrics.counter('timeouts.baca.send').value, 1)
+        self.assertEqual(metrics.counter('timeouts.baca.error').value, 1)
+
     def test_baca_error(self):
         task_submit = MockTaskSubmit(master=None, task_submit_id="submit_id", package_path=None,
                                      commit_id="commit_id",
@@ -102,5 +173,108 @@ class BacaMessengerTest(unittest.TestCase):
         self.assertTrue(out)
 
 
+class EncodeMessageTest(unittest.TestCase):
+
+    def test_encode_message(self):
+        results = {'set0': SetResult(name='set0', tests={
+            '1': TestResult(name='1', status='OK', time_real=0.5, logs={'compile_log': 'ok'}),
+        })}
+        message = BrokerToBaca(pass_hash='x', submit_id='submit_id', results=results)
+        data, digest = encode_message(BrokerToBaca.model_construct(pass_hash='x', submit_id='submit_id',
+                                                                   results=results))
+        self.assertEqual(data, message.model_dump_json().encode())
+        self.assertEqual(BrokerToBaca.model_validate_json(data), message)
+        self.assertEqual(len(digest), 64)
+
+
+class ParseResultsTest(unittest.TestCase):
+
+    RESULTS_YAML = """
+'1':
+  satori:
+    status: OK
+    execute_time_real: 0.5s
+    execute_time_cpu: 0.4s
+    execute_memory: 1024B
+    compile_log: ''
+    compile_time: '1.25s'
+'2':
+  satori:
+    status: ANS
+    execute_time_real: 0.1s
+    execute_time_cpu: 0.1s
+    execute_memory: 2048B
+"""
+
+    def test_parse_results(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            result_dir = Path(tmp)
+            (result_dir / 'results').mkdir()
+            (result_dir / 'results' / 'results.yaml').write_text(self.RESULTS_YAML)
+            result = parse_results('set0', result_dir)
+        self.assertEqual(result.name, 'set0')
+        self.assertEqual(result.tests['1'].status, 'OK')
+        self.assertEqual(result.tests['1'].time_real, 0.5)
+        self.assertEqual(result.tests['1'].runtime_memory, 1024)
+        self.assertEqual(result.tests['1'].logs['compile_time'], '1.25s')
+        self.assertEqual(result.tests['2'].status, 'ANS')
+        self.assertNotIn('compile_time', result.tests['2'].logs)
+
+
+class KolejkaPollTest(unittest.TestCase):
+
+    class RunnerStub(CommandRunner):
+        def __init__(self):
+            self.finished = False
+            self.calls = 0
+
+        async def run(self, script: Path, *args, stdout: bool = True, stderr: bool = True) -> CommandResult:
+            self.calls += 1
+            if not self.finished:
+                return CommandResult(1, b'', b'')
+            result_dir = Path(args[-1])
+            (result_dir / 'results').mkdir(parents=True)
+            (result_dir / 'results' / 'results.yaml').write_text(ParseResultsTest.RESULTS_YAML)
+            return CommandResult(0, b'', b'')
+
+    class PackageStub:
+        def build_path(self, namespace: str) -> Path:
+            return Path('build')
+
+    class SetSubmitStub:
+        submit_id = 'submit_set0'
+        set_name = 'set0'
+        result = None
+
+        def __init__(self):
+            self.task_submit = type('TaskSubmitStub', (), {'submit_id': 'submit',
+                                                          'package': KolejkaPollTest.PackageStub()})
+
+        def get_status_code(self) -> str:
+            return 'code'
+
+        def set_result(self, result: SetResult):
+            self.result = result
+
+    def test_poll(self):
+        runner = self.RunnerStub()
+        set_submit = self.SetSubmitStub()
+        with tempfile.TemporaryDirectory() as tmp:
+            submits_dir = Path(tmp)
+            (submits_dir / 'submit').mkdir()
+            messenger = KolejkaMessenger(submits_dir, 'ns', Path('conf'), 'url', logging.Logger('test'),
+                                         runner=runner)
+            self.assertFalse(asyncio.run(messenger.poll(set_submit)))
+            self.assertEqual(list((submits_dir / 'submit').iterdir()), [])
+
+            runner.finished = True
+            self.assertTrue(asyncio.run(messenger.poll(set_submit)))
+            self.assertEqual([p.name for p in (submits_dir / 'submit').iterdir()], ['set0.poll'])
+            # results downloaded by poll are used
+            asyncio.run(messenger.get_results(set_submit))
+            self.assertEqual(runner.calls, 2)
+        self.assertEqual(set_submit.result.tests['2'].status, 'ANS')
+
+
 if __name__ == '__main__':
     unittest.main()
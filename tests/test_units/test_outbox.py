@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from app.broker.durable_queue import DurableQueue
+from app.broker.messenger import BacaMessengerInterface
+from app.broker.metrics import MetricsRegistry
+from app.broker.outbox import AdaptiveLimit, ResultOutbox
+from app.broker.retry import RetryPolicy
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def test_aimd(self):
+        limit = AdaptiveLimit(initial=4, maximum=5)
+
+        async def inner():
+            for _ in range(4):
+                await limit.acquire()
+            waiter = asyncio.create_task(limit.acquire())
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+            limit.release(False)  # 4 -> 2, 3 still in flight
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+            limit.release(None)
+            limit.release(None)
+            await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(inner())
+        self.assertEqual(limit.limit, 2)
+        for _ in range(100):
+            limit.in_flight += 1
+            limit.release(True)
+        self.assertEqual(limit.limit, 5)
+        for _ in range(10):
+            limit.in_flight += 1
+            limit.release(False)
+        self.assertEqual(limit.limit, 1)
+
+
+class ResultOutboxTest(unittest.TestCase):
+
+    class TaskSubmitStub:
+        def __init__(self, submit_id: str):
+            self.submit_id = submit_id
+
+    class BacaMessengerMock(BacaMessengerInterface):
+
+        def __init__(self):
+            self.statuses: list[int | None] = []  # None - connection error, then 200
+            self.sent: list[tuple[str, bytes]] = []
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        async def send(self, task_submit):
+            pass
+
+        async def send_error(self, task_submit, error: Exception) -> bool:
+            return True
+
+        async def encode(self, task_submit) -> bytes:
+            return f'{{"submit_id": "{task_submit.submit_id}"}}'.encode()
+
+        async def send_encoded(self, submit_id: str, data: bytes) -> int:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(0.01)
+            finally:
+                self.in_flight -= 1
+            status = self.statuses.pop(0) if self.statuses else 200
+            if status is None:
+                raise self.BacaMessengerError("Cannot communicate with baCa2.")
+            self.sent.append((submit_id, data))
+            return status
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.metrics = MetricsRegistry()
+        self.messenger = self.BacaMessengerMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_outbox(self, **kwargs) -> ResultOutbox:
+        queue = DurableQueue(self.tmp / 'pending', max_items=10, max_bytes=1000, name='outbox', fsync=False,
+                             metrics=self.metrics)
+        return ResultOutbox(self.messenger, queue, logging.Logger('test'),
+                            **{'workers': 4, 'initial_concurrency': 2, 'backoff': RetryPolicy(0, 0.01, 0.02),
+                               'rejected_dir': self.tmp / 'rejected', 'metrics': self.metrics, **kwargs})
+
+    async def drain(self, outbox: ResultOutbox):
+        await outbox.queue.load()
+        runner = asyncio.create_task(outbox.run())
+        for _ in range(200):
+            if len(outbox.queue) == 0:
+                break
+            await asyncio.sleep(0.01)
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+
+    def test_delivery(self):
+        self.messenger.statuses = [None, 500, 429]
+
+        async def inner():
+            outbox = self.make_outbox()
+            for i in range(8):
+                self.assertTrue(await outbox.put(self.TaskSubmitStub(f'submit{i}')))
+            await self.drain(outbox)
+
+        asyncio.run(inner())
+        # two failed attempts (500 and 429) got responses
+        self.assertEqual(len(self.messenger.sent), 10)
+        self.assertEqual({s for s, _ in self.messenger.sent}, {f'submit{i}' for i in range(8)})
+        self.assertEqual(self.metrics.counter('outbox.delivered').value, 8)
+        self.assertEqual(self.metrics.counter('outbox.retries').value, 3)
+        self.assertEqual(self.metrics.gauge('outbox.items').value, 0)
+        self.assertLessEqual(self.messenger.max_in_flight, 4)
+
+    def test_persistence(self):
+        async def store():
+            outbox = self.make_outbox()
+            await outbox.put(self.TaskSubmitStub('submit'))
+            self.messenger.statuses = [503] * 1000  # BaCa2 is down
+            runner = asyncio.create_task(outbox.run())
+            await asyncio.sleep(0.1)
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+
+        async def deliver():
+            self.messenger.statuses = []
+            await self.drain(self.make_outbox())
+
+        asyncio.run(store())
+        self.assertGreater(self.metrics.counter('outbox.retries').value, 0)
+        self.messenger.sent.clear()
+        asyncio.run(deliver())  # after restart
+        self.assertEqual([s for s, _ in self.messenger.sent], ['submit'])
+        self.assertEqual(self.metrics.counter('outbox.delivered').value, 1)
+
+    def test_rejected(self):
+        self.messenger.statuses = [400]
+
+        async def inner():
+            outbox = self.make_outbox()
+            await outbox.put(self.TaskSubmitStub('submit'))
+            await self.drain(outbox)
+
+        asyncio.run(inner())
+        self.assertEqual(self.metrics.counter('outbox.rejected').value, 1)
+        rejected, = (self.tmp / 'rejected').iterdir()
+        self.assertEqual(rejected.read_bytes(), b'{"submit_id": "submit"}')
+
+    def test_full(self):
+        async def inner():
+            outbox = self.make_outbox()
+            outbox.queue.max_items = 1
+            self.assertTrue(await outbox.put(self.TaskSubmitStub('submit1')))
+            self.assertFalse(await outbox.put(self.TaskSubmitStub('submit2')))
+
+        asyncio.run(inner())
+        self.assertEqual(self.metrics.counter('outbox.overflow').value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from baca2PackageManager import Package, set_base_dir, add_supported_extensions
+from baca2PackageManager.broker_communication import SetResult, TestResult
+
+from settings import BUILD_NAMESPACE
+from app.broker.builder import Builder
+from app.broker.datamaster import DataMaster, TaskSubmit, SetSubmit
+from app.broker.planner import TaskPlanner, TaskPlan
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class TaskPlannerTest(unittest.TestCase):
+    resource_dir = Path(__file__).absolute().parent.parent / 'resources'
+
+    def setUp(self):
+        self.package = Package(self.resource_dir / '1', '1')
+        # estimated costs of sets: set0 - 19, set1 - 22, set2 - 35
+
+    @staticmethod
+    def make_planner(shard_cost: float, bundle_cost: float) -> TaskPlanner:
+        return TaskPlanner(shard_cost=shard_cost, bundle_cost=bundle_cost, max_shards=8,
+                           test_overhead=1.0, cost_per_mb=0.0)
+
+    def test_identity(self):
+        plan = self.make_planner(100, 0).plan(self.package)
+        self.assertEqual([t.name for t in plan.tasks], ['set0', 'set1', 'set2'])
+        self.assertTrue(all(t.is_whole_set for t in plan.tasks))
+
+    def test_bundle(self):
+        plan = self.make_planner(45, 25).plan(self.package)
+        self.assertEqual(len(plan.tasks), 2)
+        self.assertEqual(plan.task('set2').set_names, ['set2'])
+        bundle = plan.task('bundle__0')
+        self.assertEqual(bundle.set_names, ['set0', 'set1'])
+        self.assertEqual(len(bundle.tests), 4)
+        self.assertEqual(bundle.locate('set1__2'), ('set1', '2'))
+
+    def test_shard(self):
+        plan = self.make_planner(30, 0).plan(self.package)
+        shards = plan.tasks_of_set('set2')
+        self.assertEqual([t.name for t in shards], ['set2__shard0', 'set2__shard1'])
+        self.assertEqual(sorted(t.test_name for s in shards for t in s.tests), ['1', '5', '6'])
+        self.assertTrue(plan.task('set0').is_whole_set)
+
+    def test_plan_names(self):
+        plan = self.make_planner(30, 25).plan(self.package)
+        for task in plan.tasks:
+            self.assertTrue(task.name.replace('_', '').isalnum())
+
+    def test_build(self):
+        plan = self.make_planner(45, 25).plan(self.package)
+        Builder(self.package, plan=plan).build()
+        build_path = self.package.build_path(BUILD_NAMESPACE)
+        for task in plan.tasks:
+            self.assertTrue((build_path / task.name / 'tests.yaml').is_file())
+        self.assertTrue((build_path / 'bundle__0' / 'set0__2.in').is_file())
+
+    def test_stored_plan(self):
+        planner = self.make_planner(45, 25)
+        plan = planner.plan(self.package)
+        Builder(self.package, plan=plan).build()
+        build_path = self.package.build_path(BUILD_NAMESPACE)
+        stored = planner.stored_plan(build_path)
+        self.assertEqual([(t.name, t.set_names, t.tests) for t in stored.tasks],
+                         [(t.name, t.set_names, t.tests) for t in plan.tasks])
+        self.assertEqual(stored.task('bundle__0').locate('set1__2'), ('set1', '2'))
+        # planned with other settings
+        self.assertIsNone(self.make_planner(30, 0).stored_plan(build_path))
+
+        # submits use the plan of the build instead of planning again
+        data_master = DataMaster(TaskSubmit, SetSubmit, logging.Logger('test'), planner,
+                                 build_namespace=BUILD_NAMESPACE)
+        with mock.patch.object(planner, 'plan', side_effect=AssertionError('planned again')):
+            task_submit = data_master.new_task_submit('submit', self.resource_dir / '1', '1', Path('x'))
+            asyncio.run(task_submit.initialise())
+        self.assertEqual([s.set_name for s in task_submit.set_submits], ['set2', 'bundle__0'])
+
+    def test_results(self):
+        planner = self.make_planner(30, 0)
+        data_master = DataMaster(TaskSubmit, SetSubmit, logging.Logger('test'), planner)
+        task_submit = data_master.new_task_submit('submit', self.resource_dir / '1', '1', Path('x'))
+        asyncio.run(task_submit.initialise())
+        self.assertEqual(len(task_submit.set_submits), 4)
+        for set_submit in task_submit.set_submits:
+            planned_task = task_submit.plan.task(set_submit.set_name)
+            if planned_task.is_whole_set:
+                tests = {'1': TestResult(name='1', status='OK')}
+            else:
+                tests = {t.kolejka_name: TestResult(name=t.kolejka_name, status='OK')
+                         for t in planned_task.tests}
+            set_submit.set_result(SetResult(name=set_submit.set_name, tests=tests))
+            set_submit.change_state(SetSubmit.SetState.DONE, requires=None)
+        results = task_submit.results
+        self.assertEqual(list(results), ['set0', 'set1', 'set2'])
+        self.assertEqual(sorted(results['set2'].tests), ['1', '5', '6'])
+        self.assertEqual(results['set2'].name, 'set2')
+
+    def test_identity_plan(self):
+        plan = TaskPlan.identity(['a', 'b'])
+        self.assertEqual(plan.task('a').locate('1'), ('a', '1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
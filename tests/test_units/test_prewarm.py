@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+import unittest
+from pathlib import Path
+
+from baca2PackageManager import Package, set_base_dir, add_supported_extensions
+
+from app.broker import BrokerMaster
+from app.broker.datamaster import DataMaster, TaskSubmit, SetSubmit
+from app.broker.messenger import PackageManagerInterface
+from app.broker.metrics import MetricsRegistry
+from app.broker.planner import TaskPlan
+from app.broker.prewarm import PackagePrewarmer
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class PackagePrewarmerTest(unittest.TestCase):
+    resource_dir = Path(__file__).absolute().parent.parent / 'resources'
+
+    class PackageManagerMock(PackageManagerInterface):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.built: list[Path] = []
+            self.building: set[Path] = set()
+
+        async def check_build(self, package: Package) -> bool:
+            # partially built package looks built
+            return package.commit_path in self.built or package.commit_path in self.building
+
+        async def build_package(self, package: Package, plan: TaskPlan | None = None):
+            self.building.add(package.commit_path)
+            await asyncio.sleep(0.01)
+            self.building.discard(package.commit_path)
+            self.built.append(package.commit_path)
+
+    def setUp(self):
+        self.logger = logging.Logger('test')
+        self.package_manager = self.PackageManagerMock(force_rebuild=False)
+        self.master = BrokerMaster(DataMaster(TaskSubmit, SetSubmit, self.logger),
+                                   None, None, self.package_manager, self.logger)
+        self.prewarmer = PackagePrewarmer(self.master, self.resource_dir, 2, self.logger,
+                                          metrics=MetricsRegistry())
+        self.old_commit = self.resource_dir / 'bid' / '1'
+        self.new_commit = self.resource_dir / '1' / '1'
+        os.utime(self.old_commit, (1000, 1000))
+        os.utime(self.new_commit, (2000, 2000))
+
+    def test_prewarm(self):
+        async def inner():
+            self.assertEqual(await self.prewarmer.scan(), 2)
+            self.assertEqual(self.prewarmer.status()['queued'], 2)
+            worker = asyncio.create_task(self.prewarmer._worker())
+            await self.prewarmer.join()
+            # nothing new
+            self.assertEqual(await self.prewarmer.scan(), 0)
+            # modified commit is checked again
+            os.utime(self.new_commit, (3000, 3000))
+            self.assertEqual(await self.prewarmer.scan(), 1)
+            await self.prewarmer.join()
+            worker.cancel()
+
+        asyncio.run(inner())
+        # newest first
+        self.assertEqual(self.package_manager.built, [self.new_commit, self.old_commit])
+        status = self.prewarmer.status()
+        self.assertEqual(status['built'], 2)
+        self.assertEqual(status['up_to_date'], 1)
+        self.assertEqual(status['failed'], {})
+
+    def test_single_build(self):
+        package = Package(self.resource_dir / '1', '1')
+
+        async def inner():
+            return await asyncio.gather(*[self.master.process_package(package) for _ in range(3)])
+
+        self.assertEqual(sorted(asyncio.run(inner())), [False, False, True])
+        self.assertEqual(self.package_manager.built, [self.new_commit])
+
+    def test_wait_for_build(self):
+        package = Package(self.resource_dir / '1', '1')
+
+        async def inner():
+            build = asyncio.create_task(self.master.process_package(package))
+            await asyncio.sleep(0)
+            self.assertIn(self.new_commit, self.package_manager.building)
+            # returns only once the package is fully built
+            self.assertFalse(await self.master.process_package(package))
+            self.assertEqual(self.package_manager.built, [self.new_commit])
+            self.assertTrue(await build)
+
+        asyncio.run(inner())
+
+
+if __name__ == '__main__':
+    unittest.main()
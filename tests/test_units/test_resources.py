@@ -0,0 +1,86 @@
+import unittest
+from pathlib import Path
+
+import yaml
+from baca2PackageManager import Package, set_base_dir, add_supported_extensions
+
+from settings import BUILD_NAMESPACE
+from app.broker.builder import Builder
+from app.broker.planner import TaskPlanner
+from app.broker.resources import ResourceEstimator, ResourceProfile, MB
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class ResourceEstimatorTest(unittest.TestCase):
+    resource_dir = Path(__file__).absolute().parent.parent / 'resources'
+
+    def setUp(self):
+        self.package = Package(self.resource_dir / '1', '1')
+        # set2: tests 1 (9s, 6M), 5 (10s, 10M - limits of the set) and 6 (13s, 1M)
+        self.tests = self.package.sets('set2').tests()
+        self.estimator = ResourceEstimator(time_factor=1.0, test_overhead=1.0, base_time=0.0,
+                                           memory_factor=1.0, compile_memory='0M', base_memory='0M',
+                                           base_storage='1M', min_time=0.0)
+
+    def test_profile(self):
+        profile = self.estimator.profile(self.tests)
+        self.assertEqual(profile, ResourceProfile(time=35.0, memory=10 * MB, storage=MB, workspace=MB))
+
+    def test_parallel(self):
+        profile = self.estimator.profile(self.tests, parallel=2)
+        self.assertEqual(profile.time, 17.5)
+        self.assertEqual(profile.memory, 20 * MB)
+        # never more tests at once than there are tests
+        self.assertEqual(self.estimator.profile(self.tests, parallel=8).memory, 30 * MB)
+
+    def test_bounds(self):
+        estimator = ResourceEstimator(min_time=60.0, max_memory='1G')
+        profile = estimator.profile(self.tests[:1], parallel=1)
+        self.assertEqual(profile.time, 93.0)  # 60 + 9 * 2 + 15
+        self.assertEqual(estimator.profile([]).time, 60.0)
+        self.assertEqual(estimator.profile(self.tests).memory, 1024 * MB)
+
+    def test_limits(self):
+        limits = ResourceProfile(time=17.5, memory=int(10.5 * MB), storage=MB, workspace=MB).limits()
+        self.assertEqual(limits, {'time': '18s', 'memory': '11M', 'storage': '1M', 'workspace': '1M'})
+
+    def load_yaml(self, path: Path) -> dict:
+        class Loader(yaml.SafeLoader):
+            pass
+        Loader.add_multi_constructor('!', lambda loader, suffix, node: None)
+        with open(path) as file:
+            return yaml.load(file, Loader=Loader)
+
+    def test_build(self):
+        self.package._settings['kolejka_limits'] = {'storage': '2G'}
+        Builder(self.package, resources=self.estimator).build()
+        build_path = self.package.build_path(BUILD_NAMESPACE)
+        limits = self.load_yaml(build_path / 'set2' / 'test.yaml')['kolejka']['limits']
+        self.assertEqual(limits['time'], '35s')
+        self.assertEqual(limits['memory'], '10M')
+        self.assertEqual(limits['storage'], '2G')
+        self.assertEqual(limits['cpus'], self.package['cpus'])
+        common = self.load_yaml(build_path / 'common' / 'test.yaml')['kolejka']['limits']
+        self.assertEqual(common['time'], '600s')
+
+    def test_build_without_resources(self):
+        Builder(self.package).build()
+        test_yaml = self.load_yaml(self.package.build_path(BUILD_NAMESPACE) / 'set2' / 'test.yaml')
+        self.assertNotIn('kolejka', test_yaml)
+
+    def test_build_shards(self):
+        planner = TaskPlanner(shard_cost=30, bundle_cost=0, max_shards=8, test_overhead=1.0, cost_per_mb=0.0)
+        plan = planner.plan(self.package)
+        Builder(self.package, plan=plan, resources=self.estimator).build()
+        build_path = self.package.build_path(BUILD_NAMESPACE)
+        for task in plan.tasks_of_set('set2'):
+            tests_yaml = self.load_yaml(build_path / task.name / 'tests.yaml')
+            expected = sum(self.package.sets('set2').tests(t.test_name)['time_limit'] + 1 for t in task.tests)
+            for test in tests_yaml.values():
+                self.assertEqual(test['kolejka']['limits']['time'], f'{expected}s')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import unittest
+
+from app.broker.messenger import KolejkaMessengerInterface
+from app.broker.metrics import MetricsRegistry
+from app.broker.retry import DeadlineExceeded, Retrier, RetryPolicy, RetryBudget
+
+
+class RetrierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.Logger('test')
+        self.metrics = MetricsRegistry()
+        self.policy = RetryPolicy(attempts=3, base_delay=0.001, max_delay=0.01)
+
+    def make_failing(self, failures: int, error: type[Exception]):
+        calls = []
+
+        async def func(value):
+            calls.append(value)
+            if len(calls) <= failures:
+                raise error('failure')
+            return value
+
+        return func, calls
+
+    def test_transient_retried(self):
+        retrier = Retrier({'put': self.policy}, None, self.logger, self.metrics)
+        func, calls = self.make_failing(2, KolejkaMessengerInterface.KolejkaTransientError)
+        self.assertEqual(asyncio.run(retrier.run('put', 'test', func, 'x')), 'x')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.metrics.counter('retry.put.retries').value, 2)
+
+    def test_attempts_exhausted(self):
+        retrier = Retrier({'put': self.policy}, None, self.logger, self.metrics)
+        func, calls = self.make_failing(3, ConnectionError)
+        with self.assertRaises(ConnectionError):
+            asyncio.run(retrier.run('put', 'test', func, 'x'))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.metrics.counter('retry.put.exhausted').value, 1)
+
+    def test_permanent_not_retried(self):
+        retrier = Retrier({'put': self.policy}, None, self.logger, self.metrics)
+        func, calls = self.make_failing(1, KolejkaMessengerInterface.KolejkaCommunicationError)
+        with self.assertRaises(KolejkaMessengerInterface.KolejkaCommunicationError):
+            asyncio.run(retrier.run('put', 'test', func, 'x'))
+        self.assertEqual(len(calls), 1)
+
+    def test_stage_without_policy(self):
+        retrier = Retrier({'put': self.policy}, None, self.logger, self.metrics)
+        func, calls = self.make_failing(1, ConnectionError)
+        with self.assertRaises(ConnectionError):
+            asyncio.run(retrier.run('get', 'test', func, 'x'))
+        self.assertEqual(len(calls), 1)
+
+    def test_budget(self):
+        retrier = Retrier({'put': self.policy}, RetryBudget(capacity=1, refill_rate=0),
+                          self.logger, self.metrics)
+        func, calls = self.make_failing(2, ConnectionError)
+        with self.assertRaises(ConnectionError):
+            asyncio.run(retrier.run('put', 'test', func, 'x'))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.metrics.counter('retry.budget_exhausted').value, 1)
+
+    def test_timeout(self):
+        retrier = Retrier({'put': self.policy}, None, self.logger, self.metrics, timeouts={'put': 0.05})
+        calls = []
+
+        async def func():
+            calls.append(1)
+            if len(calls) == 1:
+                await asyncio.sleep(10)  # hangs, cancelled at the deadline
+            return 'x'
+
+        self.assertEqual(asyncio.run(retrier.run('put', 'test', func)), 'x')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.metrics.counter('timeouts.kolejka.put').value, 1)
+
+    def test_no_retry_after_deadline(self):
+        retrier = Retrier({'execute': self.policy}, None, self.logger, self.metrics,
+                          timeouts={'execute': 0.05}, no_retry_after_deadline={'execute'})
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(10)
+
+        with self.assertRaises(DeadlineExceeded):
+            asyncio.run(retrier.run('execute', 'test', func))
+        self.assertEqual(len(calls), 1)
+        # other transient errors are still retried
+        func, calls = self.make_failing(1, ConnectionError)
+        self.assertEqual(asyncio.run(retrier.run('execute', 'test', func, 'x')), 'x')
+
+    def test_timeout_of_func(self):
+        retrier = Retrier({'put': self.policy}, None, self.logger, self.metrics, timeouts={'put': 10})
+        func, calls = self.make_failing(1, TimeoutError)
+        self.assertEqual(asyncio.run(retrier.run('put', 'test', func, 'x')), 'x')
+        self.assertEqual(self.metrics.counter('timeouts.kolejka.put').value, 0)
+
+    def test_delay(self):
+        policy = RetryPolicy(attempts=10, base_delay=1.0, max_delay=5.0)
+        for retry in range(10):
+            self.assertTrue(0 <= policy.delay(retry) <= min(5.0, 2 ** retry))
+
+
+if __name__ == '__main__':
+    unittest.main()
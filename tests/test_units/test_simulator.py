@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from aiohttp import web
+from baca2PackageManager import set_base_dir, add_supported_extensions
+
+from app.broker.datamaster import DataMaster, SetSubmit, TaskSubmit
+from app.broker.messenger import KolejkaMessengerInterface
+from app.broker.metrics import MetricsRegistry
+from app.broker.simulator import KolejkaSimulator, SimulationProfile
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class KolejkaSimulatorTest(unittest.TestCase):
+    resource_dir = Path(__file__).absolute().parent.parent / 'resources'
+    TEST_PORT = 9433
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.logger = logging.Logger('test')
+        self.metrics = MetricsRegistry()
+        self.data_master = DataMaster(TaskSubmit, SetSubmit, self.logger)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_simulator(self, **profile) -> KolejkaSimulator:
+        profile = SimulationProfile(**{'workers': 2, 'queue_delay': 0.5, 'time_scale': 0.01, 'seed': 1,
+                                       **profile})
+        return KolejkaSimulator(Path(self.tmp), f'http://127.0.0.1:{self.TEST_PORT}/kolejka', profile,
+                                self.logger, metrics=self.metrics)
+
+    def run_simulation(self, simulator: KolejkaSimulator, timeout: float = 0.5) -> tuple[TaskSubmit, list[str]]:
+        callbacks = []
+
+        async def callback(request: web.Request):
+            callbacks.append(request.match_info['submit_id'])
+            return web.json_response({'message': 'Success'})
+
+        async def inner():
+            app = web.Application()
+            app.router.add_post('/kolejka/{submit_id}', callback)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', self.TEST_PORT).start()
+            try:
+                task_submit = self.data_master.new_task_submit('submit1', self.resource_dir / '1', '1',
+                                                               self.resource_dir / '1' / '1' / 'prog' / 'solution.cpp')
+                await task_submit.initialise()
+                for set_submit in task_submit.set_submits:
+                    await simulator.send(set_submit)
+                await asyncio.sleep(timeout)
+                return task_submit
+            finally:
+                await simulator.close()
+                await runner.cleanup()
+
+        return asyncio.run(inner()), callbacks
+
+    def test_simulation(self):
+        simulator = self.make_simulator(wrong_answer_rate=0.0, time_fraction=0.01)
+        task_submit, callbacks = self.run_simulation(simulator)
+        self.assertEqual(sorted(callbacks), sorted(s.submit_id for s in task_submit.set_submits))
+        self.assertEqual(self.metrics.counter('simulator.completed').value, 3)
+
+        async def results():
+            for set_submit in task_submit.set_submits:
+                await simulator.get_results(set_submit)
+
+        asyncio.run(results())
+        for set_submit in task_submit.set_submits:
+            result = set_submit.get_result()
+            t_set = next(s for s in task_submit.package.sets() if s['name'] == set_submit.set_name)
+            self.assertEqual(sorted(result.tests), sorted(t['name'] for t in t_set.tests()))
+            self.assertTrue(all(t.status == 'OK' and t.time_real > 0 for t in result.tests.values()))
+
+    def test_lost_callbacks(self):
+        simulator = self.make_simulator(lost_callback_rate=1.0)
+        task_submit, callbacks = self.run_simulation(simulator)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.metrics.counter('simulator.lost_callbacks').value, 3)
+        # finished tasks can still be found by polling
+        self.assertTrue(all(asyncio.run(simulator.poll(s)) for s in task_submit.set_submits))
+
+    def test_compile_error(self):
+        simulator = self.make_simulator(compile_error_rate=1.0)
+        task_submit, _ = self.run_simulation(simulator)
+        asyncio.run(simulator.get_results(task_submit.set_submits[0]))
+        statuses = {t.status for t in task_submit.set_submits[0].get_result().tests.values()}
+        self.assertEqual(statuses, {'CME'})
+
+    def test_failures(self):
+        simulator = self.make_simulator(failure_rate=1.0)
+
+        async def inner():
+            task_submit = self.data_master.new_task_submit('submit1', self.resource_dir / '1', '1',
+                                                           self.resource_dir / '1' / '1' / 'prog' / 'solution.cpp')
+            await task_submit.initialise()
+            try:
+                await simulator.send(task_submit.set_submits[0])
+            finally:
+                await simulator.close()
+
+        with self.assertRaises(KolejkaMessengerInterface.KolejkaTransientError):
+            asyncio.run(inner())
+        self.assertEqual(self.metrics.counter('simulator.failures').value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import unittest
+from pathlib import Path
+
+from baca2PackageManager import set_base_dir, add_supported_extensions
+from baca2PackageManager.broker_communication import SetResult, TestResult
+
+from app.broker import BrokerMaster
+from app.broker.datamaster import DataMaster, SetSubmit, TaskSubmit, SetSubmitInterface, TaskSubmitInterface
+from app.broker.messenger import KolejkaMessengerInterface, BacaMessengerInterface, PackageManagerInterface
+from app.broker.metrics import MetricsRegistry
+from app.broker.planner import TaskPlanner
+from app.broker.streaming import ResultStreamer
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class StreamingTest(unittest.TestCase):
+    resource_dir = Path(__file__).absolute().parent.parent / 'resources'
+
+    class KolejkaMessengerMock(KolejkaMessengerInterface):
+
+        async def get_results(self, set_submit: SetSubmitInterface):
+            planned_task = set_submit.task_submit.plan.task(set_submit.set_name)
+            names = [t.kolejka_name for t in planned_task.tests] if planned_task.tests else ['1']
+            set_submit.set_result(SetResult(name=set_submit.set_name,
+                                            tests={n: TestResult(name=n, status='OK') for n in names}))
+
+        async def send(self, set_submit: SetSubmitInterface):
+            set_submit.set_status_code('200')
+
+    class BacaMessengerMock(BacaMessengerInterface):
+
+        def __init__(self):
+            self.messages = []
+            self.failures = 0
+
+        async def send(self, task_submit: TaskSubmitInterface):
+            self.messages.append(('final', sorted(task_submit.results)))
+
+        async def send_error(self, task_submit: TaskSubmitInterface, error: Exception) -> bool:
+            return True
+
+        async def send_partial(self, task_submit: TaskSubmitInterface, results: dict[str, SetResult],
+                               sequence: int):
+            await asyncio.sleep(0.01)
+            if self.failures:
+                self.failures -= 1
+                raise self.BacaMessengerError('failure')
+            self.messages.append((sequence, sorted(results)))
+
+        async def encode(self, task_submit: TaskSubmitInterface) -> bytes:
+            return task_submit.submit_id.encode()
+
+        async def send_encoded(self, submit_id: str, data: bytes) -> int:
+            return 200
+
+    class PackageManagerMock(PackageManagerInterface):
+
+        async def check_build(self, package) -> bool:
+            return True
+
+        async def build_package(self, package, plan=None):
+            pass
+
+    def setUp(self):
+        self.logger = logging.Logger('test')
+        self.metrics = MetricsRegistry()
+        self.baca_messenger = self.BacaMessengerMock()
+
+    def make_master(self, min_sets: int, planner: TaskPlanner | None = None) -> BrokerMaster:
+        return BrokerMaster(DataMaster(TaskSubmit, SetSubmit, self.logger, planner=planner),
+                            self.KolejkaMessengerMock(),
+                            self.baca_messenger,
+                            self.PackageManagerMock(force_rebuild=False),
+                            self.logger,
+                            streamer=ResultStreamer(self.baca_messenger, min_sets, self.logger, self.metrics))
+
+    def run_submit(self, master: BrokerMaster, concurrent: bool = False):
+        async def inner():
+            task_submit = master.data_master.new_task_submit('submit1', self.resource_dir / '1', '1',
+                                                             self.resource_dir / '1' / '1' / 'prog' / 'solution.cpp')
+            await task_submit.initialise()
+            await master.process_new_task_submit(task_submit)
+            set_submits = sorted(task_submit.set_submits, key=lambda s: s.set_name)
+            if concurrent:
+                await asyncio.gather(*[master.process_finished_set_submit(s) for s in set_submits])
+            else:
+                for set_submit in set_submits:
+                    await master.process_finished_set_submit(set_submit)
+            await master.if_all_checked_process_finished_task_submit(task_submit)
+
+        asyncio.run(inner())
+
+    def test_streaming(self):
+        self.run_submit(self.make_master(min_sets=3))
+        self.assertEqual(self.baca_messenger.messages, [
+            (1, ['set0']),
+            (2, ['set1']),
+            ('final', ['set0', 'set1', 'set2']),
+        ])
+        self.assertEqual(self.metrics.counter('streaming.sent').value, 2)
+        self.assertEqual(self.metrics.histogram('streaming.first_verdict_seconds').count, 1)
+
+    def test_failed_delivery(self):
+        self.baca_messenger.failures = 1
+        self.run_submit(self.make_master(min_sets=3))
+        # set0 goes with the next message
+        self.assertEqual(self.baca_messenger.messages, [
+            (1, ['set0', 'set1']),
+            ('final', ['set0', 'set1', 'set2']),
+        ])
+        self.assertEqual(self.metrics.counter('streaming.failed').value, 1)
+
+    def test_concurrent(self):
+        self.run_submit(self.make_master(min_sets=3), concurrent=True)
+        sequences = [m[0] for m in self.baca_messenger.messages[:-1]]
+        self.assertEqual(sequences, list(range(1, len(sequences) + 1)))
+        self.assertEqual(self.baca_messenger.messages[-1], ('final', ['set0', 'set1', 'set2']))
+        sent = [name for m in self.baca_messenger.messages[:-1] for name in m[1]]
+        self.assertEqual(len(sent), len(set(sent)))
+
+    def test_small_package(self):
+        self.run_submit(self.make_master(min_sets=4))
+        self.assertEqual(self.baca_messenger.messages, [('final', ['set0', 'set1', 'set2'])])
+
+    def test_sharded_sets(self):
+        # every set is split into two shards - set is sent when both of them are done
+        planner = TaskPlanner(shard_cost=0.5, bundle_cost=0.1, max_shards=2, test_overhead=1.0, cost_per_mb=0.0)
+        self.run_submit(self.make_master(min_sets=3, planner=planner))
+        self.assertEqual(self.baca_messenger.messages, [
+            (1, ['set0']),
+            (2, ['set1']),
+            ('final', ['set0', 'set1', 'set2']),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import time
+import unittest
+from datetime import timedelta
+from pathlib import Path
+
+from baca2PackageManager import set_base_dir, add_supported_extensions
+
+from app.broker.datamaster import DataMaster, SetSubmit, TaskSubmit
+from app.broker.executors import Executors
+from app.broker.metrics import MetricsRegistry
+from app.broker.watchdog import LoopWatchdog, LoopBlockedError
+
+set_base_dir(Path(__file__).parent.parent / 'resources')
+add_supported_extensions('cpp')
+
+
+class LoopWatchdogTest(unittest.TestCase):
+    resource_dir = Path(__file__).absolute().parent.parent / 'resources'
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.watchdog = LoopWatchdog(interval=timedelta(milliseconds=10),
+                                     threshold=timedelta(milliseconds=100),
+                                     logger=logging.Logger('test'),
+                                     metrics=self.metrics)
+
+    def test_blocking(self):
+        def blocking_function():
+            time.sleep(0.3)
+
+        async def inner():
+            async with self.watchdog.guard():
+                await asyncio.sleep(0.05)
+                blocking_function()
+                await asyncio.sleep(0.05)
+
+        with self.assertRaises(LoopBlockedError) as cm:
+            asyncio.run(inner())
+        self.assertIn('blocking_function', str(cm.exception))
+        self.assertEqual(self.metrics.counter('loop.blocked').value, 1)
+        self.assertGreaterEqual(self.watchdog.blocks[0].duration, 0.1)
+        self.assertGreater(self.metrics.histogram('loop.lag_seconds').snapshot()['max'], 0.2)
+
+    def test_not_blocking(self):
+        async def inner():
+            async with self.watchdog.guard():
+                await asyncio.sleep(0.2)
+                await asyncio.to_thread(time.sleep, 0.2)
+
+        asyncio.run(inner())
+        self.assertEqual(self.metrics.counter('loop.blocked').value, 0)
+        self.assertGreater(self.metrics.histogram('loop.lag_seconds').count, 10)
+
+    def test_submit_initialisation(self):
+        # package loading and planning must not block the loop
+        executors = Executors(io_workers=2, cpu_workers=1, metrics=self.metrics)
+        data_master = DataMaster(TaskSubmit, SetSubmit, logging.Logger('test'), executors=executors)
+
+        async def inner():
+            async with self.watchdog.guard():
+                task_submit = data_master.new_task_submit('submit1', self.resource_dir / '1', '1',
+                                                          self.resource_dir / '1' / '1' / 'prog' / 'solution.cpp')
+                await task_submit.initialise()
+            return task_submit
+
+        try:
+            self.assertEqual(len(asyncio.run(inner()).set_submits), 3)
+        finally:
+            executors.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()